@@ -0,0 +1,267 @@
+from datetime import datetime
+from sqlalchemy import delete, func, insert, select
+from .database import db
+from . import models
+
+# Rollup periods: a day is stored as 'YYYY-MM-DD', a month as 'YYYY-MM'.
+GRAINS = {'day': '%Y-%m-%d', 'month': '%Y-%m'}
+
+# Dimensions /api/analytics/sales can break the totals down by.
+DIMENSIONS = {
+    'territory': models.SalesRollup.TerritoryID,
+    'category': models.SalesRollup.ProductCategoryID,
+}
+
+# Orders with no territory, and products with no category, are rolled up under 0.
+UNKNOWN = 0
+
+MAX_TOP_CUSTOMERS = 100
+
+
+class AnalyticsQueryError(Exception):
+    """Raised for analytics parameters that can't be understood."""
+
+
+def _facts(order_ids=None):
+    """One row per order line: the order, its day, territory, customer and the line's category and totals.
+
+    Orders without lines still get a row, with no LineTotal, so they count
+    towards their customer's orders.
+    """
+    header = models.SalesOrderHeader
+    detail = models.SalesOrderDetail
+    query = (
+        select(
+            header.SalesOrderID, header.OrderDate, header.TerritoryID, header.CustomerID,
+            models.ProductSubCategory.ProductCategoryID, detail.LineTotal, detail.OrderQty,
+        )
+        .select_from(header)
+        .outerjoin(detail, detail.SalesOrderID == header.SalesOrderID)
+        .outerjoin(models.Product, models.Product.ProductID == detail.ProductID)
+        .outerjoin(
+            models.ProductSubCategory,
+            models.ProductSubCategory.ProductSubcategoryID == models.Product.ProductSubcategoryID,
+        )
+    )
+    if order_ids is not None:
+        query = query.where(header.SalesOrderID.in_(order_ids))
+    return query
+
+
+def _aggregate(rows, sign=1):
+    """Sums fact rows into {rollup key: [revenue, quantity, lines]} and {customer: [revenue, orders, quantity]}."""
+    sales, customers = {}, {}
+    seen = set()
+    for order_id, order_date, territory_id, customer_id, category_id, line_total, quantity in rows:
+        customer = customers.setdefault(customer_id, [0.0, 0, 0])
+        if order_id not in seen:
+            seen.add(order_id)
+            customer[1] += sign
+        if line_total is None or order_date is None:
+            continue
+        quantity = quantity or 0
+        customer[0] += sign * line_total
+        customer[2] += sign * quantity
+        for grain, period_format in GRAINS.items():
+            key = (grain, order_date.strftime(period_format), territory_id or UNKNOWN, category_id or UNKNOWN)
+            entry = sales.setdefault(key, [0.0, 0, 0])
+            entry[0] += sign * line_total
+            entry[1] += sign * quantity
+            entry[2] += sign
+    return sales, customers
+
+
+def _rows(sales, customers):
+    sales_rows = [
+        {'Grain': grain, 'Period': period, 'TerritoryID': territory_id, 'ProductCategoryID': category_id,
+         'Revenue': revenue, 'Quantity': quantity, 'Lines': lines}
+        for (grain, period, territory_id, category_id), (revenue, quantity, lines) in sales.items()
+    ]
+    customer_rows = [
+        {'CustomerID': customer_id, 'Revenue': revenue, 'Orders': orders, 'Quantity': quantity}
+        for customer_id, (revenue, orders, quantity) in customers.items()
+        if customer_id is not None
+    ]
+    return sales_rows, customer_rows
+
+
+def _add_statement(session, model):
+    """INSERT ... ON CONFLICT (pk) DO UPDATE that adds the new values to the stored ones."""
+    if session.get_bind().dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    table = model.__table__
+    statement = dialect_insert(table)
+    primary_keys = [column.name for column in table.primary_key.columns]
+    return statement.on_conflict_do_update(
+        index_elements=primary_keys,
+        set_={
+            column.name: column + statement.excluded[column.name]
+            for column in table.columns if column.name not in primary_keys
+        },
+    )
+
+
+def update_rollups(order_ids, sign, session=None):
+    """Adds (sign=1) or takes away (sign=-1) the given orders' lines in the rollup tables.
+
+    Call it with -1 before changing or deleting an order and with 1 after
+    saving one, in the same transaction, so the rollups commit or roll back
+    with the change. Rows are never deleted, so a period or customer whose
+    orders are all gone stays behind with zero lines; the queries skip those.
+    """
+    session = db.session if session is None else session
+    sales_rows, customer_rows = _rows(*_aggregate(session.execute(_facts(order_ids)), sign))
+    if sales_rows:
+        session.execute(_add_statement(session, models.SalesRollup), sales_rows)
+    if customer_rows:
+        session.execute(_add_statement(session, models.CustomerRollup), customer_rows)
+
+
+def rebuild_rollups(session=None, chunk_size=5000):
+    """Recomputes the rollup tables from every order; returns (sales rows, customer rows).
+
+    The caller commits.
+    """
+    session = db.session if session is None else session
+    facts = session.execute(_facts().execution_options(yield_per=chunk_size))
+    sales_rows, customer_rows = _rows(*_aggregate(facts))
+    session.execute(delete(models.SalesRollup))
+    session.execute(delete(models.CustomerRollup))
+    for model, rows in ((models.SalesRollup, sales_rows), (models.CustomerRollup, customer_rows)):
+        for start in range(0, len(rows), chunk_size):
+            session.execute(insert(model), rows[start:start + chunk_size])
+    return len(sales_rows), len(customer_rows)
+
+
+def _period(args, name, grain):
+    value = args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').strftime(GRAINS[grain])
+    except ValueError:
+        raise AnalyticsQueryError(f"'{name}' must be a date in YYYY-MM-DD format.")
+
+
+def _int(args, name):
+    value = args.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise AnalyticsQueryError(f"'{name}' must be a whole number.")
+
+
+def _names(session, model, key):
+    return dict(session.execute(select(key, model.Name)).all())
+
+
+def sales_summary(args, session=None):
+    """Revenue, quantity and line counts per period, read from the rollups.
+
+    `args` holds the request's query parameters: `grain` ('day' or
+    'month', the default), `date_from` and `date_to` (inclusive,
+    YYYY-MM-DD), `group_by` (a comma-separated list of 'territory' and
+    'category', both by default; empty for one total per period),
+    `territory_id` and `category_id`. Territory 0 and category 0 hold
+    orders and products that have none.
+    """
+    session = db.session if session is None else session
+    rollup = models.SalesRollup
+    grain = args.get('grain', 'month')
+    if grain not in GRAINS:
+        raise AnalyticsQueryError(f"'grain' must be one of: {', '.join(GRAINS)}.")
+    group_by = [name.strip() for name in args.get('group_by', ','.join(DIMENSIONS)).split(',') if name.strip()]
+    unknown = [name for name in group_by if name not in DIMENSIONS]
+    if unknown:
+        raise AnalyticsQueryError(f"Can't group by {', '.join(unknown)}; use {', '.join(DIMENSIONS)}.")
+
+    columns = [rollup.Period, *(DIMENSIONS[name] for name in group_by)]
+    query = select(
+        *columns, func.sum(rollup.Revenue), func.sum(rollup.Quantity), func.sum(rollup.Lines)
+    ).where(rollup.Grain == grain)
+    period_from = _period(args, 'date_from', grain)
+    if period_from:
+        query = query.where(rollup.Period >= period_from)
+    period_to = _period(args, 'date_to', grain)
+    if period_to:
+        query = query.where(rollup.Period <= period_to)
+    territory_id = _int(args, 'territory_id')
+    if territory_id is not None:
+        query = query.where(rollup.TerritoryID == territory_id)
+    category_id = _int(args, 'category_id')
+    if category_id is not None:
+        query = query.where(rollup.ProductCategoryID == category_id)
+    query = query.group_by(*columns).having(func.sum(rollup.Lines) > 0).order_by(*columns)
+
+    territories = _names(session, models.SalesTerritory, models.SalesTerritory.TerritoryID) if 'territory' in group_by else {}
+    categories = _names(session, models.ProductCategory, models.ProductCategory.ProductCategoryID) if 'category' in group_by else {}
+    rows = []
+    for row in session.execute(query):
+        period, *keys, revenue, quantity, lines = row
+        result = {'period': period}
+        for name, key in zip(group_by, keys):
+            if name == 'territory':
+                result.update(TerritoryID=key, Territory=territories.get(key))
+            else:
+                result.update(ProductCategoryID=key, Category=categories.get(key))
+        result.update(Revenue=round(revenue, 2), Quantity=quantity, Lines=lines)
+        rows.append(result)
+    return {
+        'grain': grain,
+        'group_by': group_by,
+        'rows': rows,
+        'totals': {
+            'Revenue': round(sum(row['Revenue'] for row in rows), 2),
+            'Quantity': sum(row['Quantity'] for row in rows),
+            'Lines': sum(row['Lines'] for row in rows),
+        },
+    }
+
+
+def top_customers(args, session=None):
+    """The customers with the most revenue, all time, read from the customer rollup.
+
+    `limit` (default 10, at most 100) sets how many.
+    """
+    session = db.session if session is None else session
+    limit = max(1, min(_int(args, 'limit') or 10, MAX_TOP_CUSTOMERS))
+    rollup = models.CustomerRollup
+    top = session.execute(
+        select(rollup.CustomerID, rollup.Revenue, rollup.Orders, rollup.Quantity)
+        .where(rollup.Orders > 0)
+        .order_by(rollup.Revenue.desc())
+        .limit(limit)
+    ).all()
+
+    # Names for just these customers: a person's, or failing that the store's.
+    customer_ids = [row.CustomerID for row in top]
+    names = {}
+    people = (
+        select(models.Customer.CustomerID, models.IndividualCustomer.FirstName, models.IndividualCustomer.LastName)
+        .join(models.IndividualCustomer, models.IndividualCustomer.BusinessEntityID == models.Customer.PersonID)
+        .where(models.Customer.CustomerID.in_(customer_ids))
+    )
+    for customer_id, first_name, last_name in session.execute(people):
+        names.setdefault(customer_id, f"{first_name or ''} {last_name or ''}".strip())
+    stores = (
+        select(models.Customer.CustomerID, models.StoreCustomers.Name)
+        .join(models.StoreCustomers, models.StoreCustomers.BusinessEntityID == models.Customer.StoreID)
+        .where(models.Customer.CustomerID.in_(customer_ids))
+    )
+    for customer_id, name in session.execute(stores):
+        names.setdefault(customer_id, name)
+
+    return [
+        {
+            'CustomerID': row.CustomerID,
+            'Name': names.get(row.CustomerID),
+            'Revenue': round(row.Revenue, 2),
+            'Orders': row.Orders,
+            'Quantity': row.Quantity,
+        }
+        for row in top
+    ]
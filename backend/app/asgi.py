@@ -0,0 +1,224 @@
+"""ASGI entry point: the upload, update and delete routes on asyncio, the rest served by the Flask app.
+
+An upload spends nearly all its time waiting on the model. Under WSGI each
+of those waits holds a thread; here it is a suspended coroutine, so one
+process can keep hundreds of extractions in flight. Every other route is
+passed through to the Flask app unchanged.
+
+    cd backend
+    poetry run uvicorn app.asgi:create_app --factory --workers 4 --host 0.0.0.0 --port 5000
+"""
+import asyncio
+import functools
+from contextlib import asynccontextmanager
+from a2wsgi import WSGIMiddleware
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse
+from starlette.routing import Mount, Route
+from flask import current_app
+from werkzeug.utils import secure_filename
+from .database import async_database_url, tune_sqlite
+from .extraction import (
+    ExtractionError, extract_document_async, get_extraction_cache, get_page_splitter,
+    get_preprocessor, save_extracted_data, transient_model_errors
+)
+from .jobs import get_worker_pool
+from .lookup import get_lookup_index, use_lookups
+from .main import _is_truthy, create_app as create_flask_app
+from .metrics import finish_request, instrument_engine, log_exception, span, start_request_trace, use_trace
+from .orders import OrderUpdateError, delete_order, update_order
+
+
+class FlaskJSONResponse(JSONResponse):
+    """Serializes like Flask's jsonify, so both halves of the API return the same JSON."""
+
+    def render(self, content):
+        return current_app.json.dumps(content).encode('utf-8')
+
+
+def json_error(message, status_code, headers=None):
+    return FlaskJSONResponse({'error': message}, status_code, headers)
+
+
+def create_engine(flask_app):
+    """The asyncio engine for the Flask app's database, tuned like its own."""
+    url = flask_app.config['SQLALCHEMY_DATABASE_URI']
+    engine = create_async_engine(async_database_url(url), **flask_app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+    tune_sqlite(engine.sync_engine, flask_app.config['SQLITE_PRAGMAS'], flask_app.config['SQLITE_BEGIN'])
+    instrument_engine(engine.sync_engine)
+    return engine
+
+
+@asynccontextmanager
+async def lifespan(app):
+    flask_app = app.state.flask_app
+    engine = create_engine(flask_app)
+    app.state.sessions = async_sessionmaker(engine, expire_on_commit=False)
+    # Transactions wait their turn here rather than in the pool or, on SQLite,
+    # in busy_timeout: SQLite has one writer at a time, and with hundreds of
+    # uploads in flight the rest would time out waiting for it.
+    options = flask_app.config['SQLALCHEMY_ENGINE_OPTIONS']
+    slots = 1 if engine.dialect.name == 'sqlite' else options.get('pool_size', 5) + options.get('max_overflow', 10)
+    app.state.transactions = asyncio.Semaphore(slots)
+    try:
+        yield
+    finally:
+        await engine.dispose()
+
+
+def route(endpoint):
+    """Runs a handler the way Flask runs a view: in an app context, traced and logged under `endpoint`."""
+
+    def decorate(handler):
+        @functools.wraps(handler)
+        async def run(request):
+            flask_app = request.app.state.flask_app
+            trace = start_request_trace(flask_app, request.headers.get('X-Request-ID'))
+            with use_trace(trace), flask_app.app_context():
+                response = await handler(request)
+            response.headers['X-Request-ID'] = trace.request_id
+            finish_request(flask_app, trace, request.method, endpoint, request.url.path, response.status_code)
+            return response
+        return run
+    return decorate
+
+
+@asynccontextmanager
+async def transaction(request):
+    """A session for one transaction, once a slot is free; the caller commits."""
+    async with request.app.state.transactions, request.app.state.sessions() as session:
+        yield session
+
+
+async def lookup_snapshot():
+    """A snapshot of the lookup index (see LookupIndex.snapshot), loaded on a worker thread.
+
+    Validation, hydration and order edits all consult the index, and here
+    they run on the event loop (hydration inside the save transaction).
+    Under use_lookups they see the snapshot, so a reload, and with it sync
+    SQL, never happens on the loop or while that transaction holds the
+    SQLite write lock. The index loads on a connection of its own, so this
+    needs no transaction slot.
+    """
+    return await asyncio.to_thread(get_lookup_index().snapshot)
+
+
+@route('/api/upload')
+async def upload_file(request):
+    form = await request.form()
+    file = form.get('file')
+    if file is None or isinstance(file, str):
+        return json_error('No file part', 400)
+    if not file.filename:
+        return json_error('No selected file', 400)
+    with span('read_upload'):
+        data = await file.read()
+
+    if _is_truthy(request.query_params.get('async')):
+        pool = get_worker_pool(request.app.state.flask_app)
+        job_id = await asyncio.to_thread(pool.queue.enqueue, data, secure_filename(file.filename))
+        return FlaskJSONResponse({
+            "status": "queued",
+            "job_id": job_id,
+            "status_url": f"/api/jobs/{job_id}",
+            "result_url": f"/api/jobs/{job_id}/result",
+        }, 202)
+
+    try:
+        report = {}
+        with use_lookups(await lookup_snapshot()):
+            extracted_data = await extract_document_async(
+                data,
+                cache=get_extraction_cache(),
+                preprocessor=get_preprocessor(),
+                splitter=get_page_splitter(),
+                report=report,
+            )
+            with span('save'):
+                async with transaction(request) as session:
+                    final_response = await session.run_sync(
+                        lambda sync_session: save_extracted_data(extracted_data, commit=False, session=sync_session)
+                    )
+                    with span('commit'):
+                        await session.commit()
+        return FlaskJSONResponse({
+            "status": "success",
+            "message": "Data saved to database.",
+            "data": final_response,
+            "preprocessing": report.get('preprocessing'),
+            "tokens": report.get('tokens'),
+            "model": report.get('model'),
+        })
+    except ExtractionError as e:
+        return json_error(e.message, e.status_code)
+    except transient_model_errors() as e:
+        return json_error(f'The model is busy, please try again shortly: {str(e)}', 503, {
+            'Retry-After': str(current_app.config['MODEL_RETRY_AFTER']),
+        })
+    except Exception as e:
+        log_exception(e)
+        return json_error(f'An error occurred: {str(e)}', 500)
+
+
+@route('/api/sales_order/<int:order_id>')
+async def update_sales_order(request):
+    """Applies an edit as a diff against the stored order (see orders.update_order)."""
+    order_id = request.path_params['order_id']
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    if not data:
+        return json_error('Invalid data', 400)
+
+    try:
+        with use_lookups(await lookup_snapshot()):
+            async with transaction(request) as session:
+                order = await session.run_sync(lambda sync_session: update_order(order_id, data, sync_session))
+                with span('commit'):
+                    await session.commit()
+        return FlaskJSONResponse({"status": "success", "message": f"Order {order_id} updated.", "data": order})
+    except OrderUpdateError as e:
+        return json_error(e.message, e.status_code)
+    except Exception as e:
+        log_exception(e)
+        return json_error(f'An error occurred: {str(e)}', 500)
+
+
+@route('/api/sales_order/<int:order_id>')
+async def delete_sales_order(request):
+    order_id = request.path_params['order_id']
+    try:
+        async with transaction(request) as session:
+            await session.run_sync(lambda sync_session: delete_order(order_id, sync_session))
+            with span('commit'):
+                await session.commit()
+        return FlaskJSONResponse({"status": "success", "message": f"Order {order_id} deleted."})
+    except Exception as e:
+        log_exception(e)
+        return json_error(f'An error occurred: {str(e)}', 500)
+
+
+# The same CORS headers Flask-CORS adds to the Flask routes. Preflight
+# requests don't match these routes' methods and are answered by Flask.
+CORS = [Middleware(CORSMiddleware, allow_origins=['*'])]
+
+
+def create_app():
+    """Builds the ASGI app around a new Flask app (see main.create_app)."""
+    flask_app = create_flask_app()
+    app = Starlette(
+        routes=[
+            Route('/api/upload', upload_file, methods=['POST'], middleware=CORS),
+            Route('/api/sales_order/{order_id:int}', update_sales_order, methods=['PUT', 'PATCH'], middleware=CORS),
+            Route('/api/sales_order/{order_id:int}', delete_sales_order, methods=['DELETE'], middleware=CORS),
+            # Everything else, including CORS preflight requests for the routes above.
+            Mount('/', app=WSGIMiddleware(flask_app)),
+        ],
+        lifespan=lifespan,
+    )
+    app.state.flask_app = flask_app
+    return app
@@ -0,0 +1,130 @@
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from werkzeug.utils import secure_filename
+from .database import begin_write, db
+from .metrics import bind_trace
+from .extraction import (
+    ExtractionError, extract_document, get_extraction_cache, get_models,
+    get_page_splitter, get_preprocessor, save_extracted_data, transient_model_errors
+)
+
+
+class BatchError(Exception):
+    """Raised when a batch as a whole is rejected before any extraction runs."""
+
+
+def collect_documents(files, max_files, max_bytes):
+    """Flattens the uploaded files (and the members of any ZIP archives) into
+    a list of (filename, bytes) pairs, enforcing the batch limits."""
+    documents = []
+    total_bytes = 0
+
+    def add(name, data):
+        nonlocal total_bytes
+        total_bytes += len(data)
+        if len(documents) >= max_files:
+            raise BatchError(f'A batch may contain at most {max_files} documents.')
+        if total_bytes > max_bytes:
+            raise BatchError(f'A batch may contain at most {max_bytes} bytes of documents.')
+        documents.append((name, data))
+
+    for file in files:
+        if not file or file.filename == '':
+            continue
+        filename = secure_filename(file.filename)
+        if filename.lower().endswith('.zip'):
+            try:
+                archive = zipfile.ZipFile(file.stream)
+            except zipfile.BadZipFile:
+                raise BatchError(f"'{filename}' is not a valid ZIP archive.")
+            with archive:
+                for member in archive.infolist():
+                    if member.is_dir() or os.path.basename(member.filename).startswith('.'):
+                        continue
+                    # Check the declared size before inflating anything.
+                    if total_bytes + member.file_size > max_bytes:
+                        raise BatchError(f'A batch may contain at most {max_bytes} bytes of documents.')
+                    add(f"{filename}/{member.filename}", archive.read(member))
+        else:
+            add(filename, file.read())
+    return documents
+
+
+def _record_error(result, error):
+    """Fills in `result` for a document that failed to extract or save."""
+    if isinstance(error, ExtractionError):
+        result.update({'status': 'error', 'error': error.message, 'status_code': error.status_code})
+    elif isinstance(error, transient_model_errors()):
+        result.update({'status': 'error', 'error': f'The model is busy, please try again shortly: {str(error)}', 'status_code': 503})
+    else:
+        result.update({'status': 'error', 'error': f'An error occurred: {str(error)}', 'status_code': 500})
+    result.pop('data', None)
+
+
+def process_batch(documents, parallelism=4, commit_size=20):
+    """Extracts every document and saves the results.
+
+    Model calls run concurrently on `parallelism` threads and share the same
+    model objects. Each thread gets its own app context, since validating a
+    result against the Product table needs the database.
+
+    Results are saved in document order, `commit_size` at a time. A group is
+    only written once all of its extractions have finished, in one short
+    write transaction, so the database is never locked while a model call
+    is still running. Each document is saved in its own savepoint, so a bad
+    document is rolled back on its own. On SQLite the savepoints rely on
+    tune_sqlite (see database.py) handing transactions to SQLAlchemy. With
+    the sqlite3 module's own handling, RELEASE SAVEPOINT would commit each
+    document on its own.
+    """
+    app = current_app._get_current_object()
+    models = get_models()
+    cache = get_extraction_cache()
+    preprocessor = get_preprocessor()
+    splitter = get_page_splitter()
+    results = []
+    group = []
+
+    def write_group():
+        saved = []
+        try:
+            begin_write(db.session)
+            for result, extracted_data, report in group:
+                try:
+                    with db.session.begin_nested():
+                        result['data'] = save_extracted_data(extracted_data, commit=False)
+                except Exception as e:
+                    _record_error(result, e)
+                    continue
+                result.update({'status': 'success', 'status_code': 200, 'model': report.get('model')})
+                saved.append(result)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            for result in saved:
+                _record_error(result, e)
+        group.clear()
+
+    def extract(data, report):
+        with app.app_context():
+            return extract_document(data, models, cache, preprocessor, splitter, report)
+
+    reports = [{} for _ in documents]
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        futures = [executor.submit(bind_trace(extract), data, report) for (_, data), report in zip(documents, reports)]
+        for (filename, _), future, report in zip(documents, futures, reports):
+            result = {'filename': filename}
+            results.append(result)
+            try:
+                group.append((result, future.result(), report))
+            except Exception as e:
+                _record_error(result, e)
+
+            if len(group) >= commit_size:
+                write_group()
+
+    if group:
+        write_group()
+    return results
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing
+
+
+def cache_key(data, model_name, prompt):
+    """Identifies an extraction by image bytes, model and prompt.
+
+    Changing the prompt or switching models invalidates old entries without
+    having to clear the cache.
+    """
+    digest = hashlib.sha256()
+    for part in (model_name.encode(), b'\0', prompt.encode(), b'\0', data):
+        digest.update(part)
+    return digest.hexdigest()
+
+
+class ExtractionCache:
+    """Parsed model output keyed by `cache_key`.
+
+    An in-memory LRU of at most `max_entries` items sits in front of an
+    optional SQLite file at `path`, which survives restarts and is shared by
+    every worker process. Entries older than `ttl` seconds are ignored in both
+    tiers. Values are stored as JSON text so every hit hands out a fresh copy
+    that the caller is free to mutate.
+    """
+
+    def __init__(self, max_entries=256, ttl=None, path=None, max_disk_entries=10000):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.max_disk_entries = max_disk_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_writes = 0
+        self._stats = {'hits': 0, 'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+        if path:
+            with closing(self._connect()) as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS extraction_cache "
+                    "(key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+                )
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS ix_extraction_cache_created_at ON extraction_cache (created_at)"
+                )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def _expired(self, created_at):
+        return self.ttl is not None and time.time() - created_at > self.ttl
+
+    def _remember(self, key, value, created_at):
+        self._entries[key] = (value, created_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and self._expired(entry[1]):
+                del self._entries[key]
+                entry = None
+            if entry:
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                self._stats['memory_hits'] += 1
+                return json.loads(entry[0])
+
+        if self.path:
+            with closing(self._connect()) as conn:
+                row = conn.execute(
+                    "SELECT value, created_at FROM extraction_cache WHERE key = ?", (key,)
+                ).fetchone()
+            if row and not self._expired(row[1]):
+                with self._lock:
+                    self._remember(key, row[0], row[1])
+                    self._stats['hits'] += 1
+                    self._stats['disk_hits'] += 1
+                return json.loads(row[0])
+
+        with self._lock:
+            self._stats['misses'] += 1
+        return None
+
+    def set(self, key, value):
+        text = json.dumps(value)
+        created_at = time.time()
+        with self._lock:
+            self._remember(key, text, created_at)
+            self._disk_writes += 1
+            trim = self._disk_writes % 100 == 0
+
+        if self.path:
+            with closing(self._connect()) as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO extraction_cache (key, value, created_at) VALUES (?, ?, ?)",
+                    (key, text, created_at),
+                )
+                if trim:
+                    self._trim_disk(conn)
+
+    def _trim_disk(self, conn):
+        if self.ttl is not None:
+            conn.execute("DELETE FROM extraction_cache WHERE created_at < ?", (time.time() - self.ttl,))
+        conn.execute(
+            "DELETE FROM extraction_cache WHERE key NOT IN "
+            "(SELECT key FROM extraction_cache ORDER BY created_at DESC LIMIT ?)",
+            (self.max_disk_entries,),
+        )
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.path:
+            with closing(self._connect()) as conn:
+                conn.execute("DELETE FROM extraction_cache")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        stats['max_entries'] = self.max_entries
+        stats['ttl'] = self.ttl
+        stats['disk'] = bool(self.path)
+        return stats
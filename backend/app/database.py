@@ -1,3 +1,154 @@
+import os
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import scoped_session
 
-db = SQLAlchemy() 
\ No newline at end of file
+db = SQLAlchemy()
+
+
+def database_url(url, default_path):
+    """The SQLAlchemy URL to use: `url` if set, else a SQLite file at `default_path`."""
+    if not url:
+        return 'sqlite:///' + default_path
+    # Hosting providers still hand out the old postgres:// scheme, which SQLAlchemy rejects.
+    if url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+
+# The asyncio driver used for each database by the ASGI app (see asgi.py).
+ASYNC_DRIVERS = {'sqlite': 'aiosqlite', 'postgresql': 'asyncpg'}
+
+
+def async_database_url(url):
+    """`url` with its driver swapped for the asyncio one, e.g. sqlite+aiosqlite://."""
+    url = make_url(url)
+    driver = ASYNC_DRIVERS.get(url.get_backend_name())
+    if driver is None:
+        raise ValueError(f'No asyncio driver known for {url.get_backend_name()} databases.')
+    return url.set(drivername=f'{url.get_backend_name()}+{driver}').render_as_string(hide_password=False)
+
+
+def _is_file_sqlite(url):
+    url = make_url(url)
+    return url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:')
+
+
+def engine_options(url, pool_size=10, max_overflow=20, pool_timeout=30):
+    """Engine options for a multi-threaded server.
+
+    Every worker thread (request threads, extraction workers, batch
+    executors) may hold a connection at once, so the pool is sized for that
+    rather than SQLAlchemy's default of five. Server databases also get
+    pre-ping and recycling so connections dropped by the server are replaced.
+    """
+    if make_url(url).get_backend_name() == 'sqlite':
+        if not _is_file_sqlite(url):
+            return {}
+        return {'pool_size': pool_size, 'max_overflow': max_overflow, 'pool_timeout': pool_timeout}
+    return {
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_timeout': pool_timeout,
+        'pool_pre_ping': True,
+        'pool_recycle': 1800,
+    }
+
+
+def sqlite_pragmas(journal_mode='WAL', synchronous='NORMAL', busy_timeout=5000,
+                   mmap_size=256 * 1024 * 1024, cache_size=-64000):
+    """The PRAGMAs set on every new SQLite connection.
+
+    WAL lets readers carry on while a write is in progress, and with
+    synchronous=NORMAL a commit no longer waits for an fsync (a crash can
+    lose the last transactions but never corrupts the file). busy_timeout
+    (ms) makes a blocked writer wait instead of failing with "database is
+    locked". mmap_size (bytes) and cache_size (pages, or KiB when negative)
+    keep hot pages in memory.
+    """
+    return {
+        'journal_mode': journal_mode,
+        'synchronous': synchronous,
+        'busy_timeout': busy_timeout,
+        'mmap_size': mmap_size,
+        'cache_size': cache_size,
+    }
+
+
+def tune_sqlite(engine, pragmas, begin='DEFERRED'):
+    """Applies `pragmas` to each new connection of a SQLite `engine`.
+
+    Transactions are opened with BEGIN `begin`. The default, DEFERRED,
+    takes no lock until the first write, so under WAL reads never wait for
+    a writer. Transactions that write should start with `begin_write`
+    instead, which opens them with BEGIN IMMEDIATE. The sqlite3 module's
+    own transaction handling is turned off so SQLAlchemy emits the BEGIN,
+    which also makes SAVEPOINTs behave.
+    """
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def _on_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+    @event.listens_for(engine, 'begin')
+    def _on_begin(connection):
+        mode = connection.get_execution_options().get('sqlite_begin', begin)
+        connection.exec_driver_sql(f'BEGIN {mode}' if mode else 'BEGIN')
+
+
+# Connection execution options that open the next transaction as a write
+# transaction; see tune_sqlite and begin_write.
+WRITE_OPTIONS = {'sqlite_begin': 'IMMEDIATE'}
+
+
+def begin_write(session):
+    """Starts `session`'s next transaction as a write transaction.
+
+    On SQLite (see tune_sqlite) that is BEGIN IMMEDIATE, which takes the
+    write lock up front. A transaction that reads first and writes later
+    (like saving an order) can otherwise fail outright with "database is
+    locked" when another writer commits in between, because busy_timeout
+    can't help with that lock upgrade. Call it before the transaction's
+    first query; once the session is in a transaction it does nothing.
+    Other databases ignore the option.
+    """
+    if isinstance(session, scoped_session):
+        session = session()
+    if not session.in_transaction():
+        session.connection(execution_options=WRITE_OPTIONS)
+
+
+def configure_database(app, default_path):
+    """Reads the database settings from the environment and binds `db` to `app`.
+
+    Used by create_app and by database_setup.py, which only needs the
+    database and so builds a bare Flask app rather than the whole API.
+    DATABASE_URL switches to another database, e.g. Postgres; without it
+    the SQLite file at `default_path` is used.
+    """
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_url(os.getenv('DATABASE_URL'), default_path)
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(
+        app.config['SQLALCHEMY_DATABASE_URI'],
+        pool_size=int(os.getenv('DB_POOL_SIZE', '10')),
+        max_overflow=int(os.getenv('DB_MAX_OVERFLOW', '20')),
+        pool_timeout=float(os.getenv('DB_POOL_TIMEOUT', '30')),
+    )
+    app.config['SQLITE_PRAGMAS'] = sqlite_pragmas(
+        journal_mode=os.getenv('SQLITE_JOURNAL_MODE', 'WAL'),
+        synchronous=os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL'),
+        busy_timeout=int(os.getenv('SQLITE_BUSY_TIMEOUT', '5000')),
+        mmap_size=int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024))),
+        cache_size=int(os.getenv('SQLITE_CACHE_SIZE', '-64000')),
+    )
+    app.config['SQLITE_BEGIN'] = os.getenv('SQLITE_BEGIN', 'DEFERRED')
+    db.init_app(app)
+    with app.app_context():
+        tune_sqlite(db.engine, app.config['SQLITE_PRAGMAS'], app.config['SQLITE_BEGIN'])
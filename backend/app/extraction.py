@@ -0,0 +1,614 @@
+import asyncio
+import os
+import io
+import json
+import threading
+import time
+from datetime import datetime
+from functools import cache
+from flask import current_app
+from sqlalchemy import insert
+from .database import begin_write, db
+from . import models
+from .analytics import update_rollups
+from .cache import cache_key
+from .lookup import get_lookup_index
+from .metrics import count, log, span, tag
+from .model_client import ModelBusyError, get_model_client
+from .prompt import build_prompt, generation_config
+from .validation import validate_extraction
+
+DEFAULT_MODEL_NAME = 'gemini-2.5-pro'
+# Tried first by default; the pro model only sees documents it gets wrong.
+FAST_MODEL_NAME = 'gemini-2.5-flash'
+
+# Columns the client may set on a detail row; IDs are always generated here.
+DETAIL_COLUMNS = set(models.SalesOrderDetail.__table__.columns.keys()) - {'SalesOrderDetailID'}
+
+# Python-side column defaults, applied when a line leaves the column empty.
+DETAIL_DEFAULTS = {
+    column.name: column.default.arg
+    for column in models.SalesOrderDetail.__table__.columns
+    if column.default is not None and column.default.is_scalar
+}
+
+
+class TransientModelError(Exception):
+    """Raised for model failures that are worth retrying (quota, timeouts, outages)."""
+
+
+class ExtractionError(Exception):
+    """An extraction failure that maps directly onto an HTTP error response."""
+
+    def __init__(self, message, status_code=500):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+@cache
+def transient_model_errors():
+    """Errors from the Gemini API that usually go away on their own.
+
+    A function rather than a constant so that the Google API client, which
+    is slow to import, is only loaded once it is needed: `except
+    transient_model_errors()` is only evaluated when something was raised.
+    """
+    from google.api_core import exceptions as google_exceptions
+
+    return (
+        TransientModelError,
+        ModelBusyError,
+        google_exceptions.ResourceExhausted,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.InternalServerError,
+        google_exceptions.TooManyRequests,
+    )
+
+
+_gemini_lock = threading.Lock()
+_gemini_configured = False
+
+
+def gemini_model(model_name, **kwargs):
+    """Builds a `genai.GenerativeModel`, importing and configuring the SDK on first use.
+
+    The SDK takes about half a second to import, so processes that never
+    call Gemini (the fake backend, database scripts) don't pay for it.
+    """
+    global _gemini_configured
+    import google.generativeai as genai
+
+    with _gemini_lock:
+        if not _gemini_configured:
+            genai.configure(api_key=current_app.config.get('GOOGLE_API_KEY'))
+            _gemini_configured = True
+    return genai.GenerativeModel(model_name, **kwargs)
+
+
+def extract_json_from_response(text):
+    """Extracts JSON object from a string."""
+    try:
+        # Structured output mode returns the bare object, so try that first.
+        try:
+            return json.loads(text)
+        except json.JSONDecodeError:
+            pass
+        # Otherwise find the start and end of a fenced JSON block
+        json_start = text.find('```json')
+        if json_start == -1:
+            log('json_decode_error', level='warning', error='no JSON object in the response')
+            return None
+
+        json_start += len('```json')
+        json_end = text.find('```', json_start)
+
+        # Extract and parse the JSON string
+        json_str = text[json_start:json_end].strip()
+        return json.loads(json_str)
+    except (json.JSONDecodeError, AttributeError, ValueError) as e:
+        log('json_decode_error', level='warning', error=str(e))
+        return None
+
+
+def get_model(model_name=DEFAULT_MODEL_NAME):
+    """Returns a model object exposing `generate_content`.
+
+    `MODEL_FACTORY` in the app config lets tests and benchmarks swap in a
+    local fake instead of `gemini_model`. With `STRUCTURED_OUTPUT`
+    on, the model is asked to answer with bare JSON matching the schema from
+    prompt.py. The model is shared, and its calls are rate limited and
+    retried by the app's `ModelClient`.
+    """
+    factory = current_app.config.get('MODEL_FACTORY') or gemini_model
+    if current_app.config.get('STRUCTURED_OUTPUT'):
+        return get_model_client().model(model_name, factory, generation_config=generation_config())
+    return get_model_client().model(model_name, factory)
+
+
+def record_usage(response, usage):
+    """Adds the response's token counts to the `usage` dict."""
+    metadata = getattr(response, 'usage_metadata', None)
+    usage['input_tokens'] = usage.get('input_tokens', 0) + (getattr(metadata, 'prompt_token_count', 0) or 0)
+    usage['output_tokens'] = usage.get('output_tokens', 0) + (getattr(metadata, 'candidates_token_count', 0) or 0)
+
+
+def _stream_text(model, contents, on_text):
+    """Runs a streaming generation, passing each text chunk to `on_text`.
+
+    Returns the full text and the last chunk, which carries the usage totals.
+    """
+    parts = []
+    last = None
+    for chunk in model.generate_content(contents, stream=True):
+        last = chunk
+        try:
+            text = chunk.text
+        except ValueError:
+            # Chunks with no text parts (e.g. only a finish reason) raise here.
+            continue
+        if text:
+            parts.append(text)
+            on_text(text)
+    return ''.join(parts), last
+
+
+def extract_invoice(image, model=None, usage=None, on_text=None):
+    """Sends the invoice image to the model and returns the parsed JSON.
+
+    `image` is anything `generate_content` accepts as an image part: a PIL
+    image or a {'mime_type': ..., 'data': ...} blob. When `usage` is a dict,
+    the call's input and output token counts are added to it. With
+    `on_text`, the response is streamed and each chunk of text is passed to
+    it as it arrives.
+    """
+    if model is None:
+        model = get_model()
+    contents = [build_prompt(), image]
+    count('model_calls')
+    with span('model_call'):
+        if on_text is None:
+            response = model.generate_content(contents)
+            text = response.text
+        else:
+            text, response = _stream_text(model, contents, on_text)
+    return _parse_invoice(response, text, usage)
+
+
+async def extract_invoice_async(image, model, usage=None):
+    """`extract_invoice` through the model's `generate_content_async`, without streaming."""
+    count('model_calls')
+    with span('model_call'):
+        response = await model.generate_content_async([build_prompt(), image])
+        text = response.text
+    return _parse_invoice(response, text, usage)
+
+
+def _parse_invoice(response, text, usage):
+    if usage is not None:
+        record_usage(response, usage)
+    with span('parse_json'):
+        extracted_data = extract_json_from_response(text)
+    if not extracted_data:
+        raise ExtractionError('Failed to extract data from document.')
+    return extracted_data
+
+
+def get_extraction_cache(app=None):
+    """Returns the app's extraction cache, or None when caching is disabled."""
+    app = app or current_app
+    return app.extensions.get('extraction_cache')
+
+
+def get_preprocessor(app=None):
+    """Returns the app's image preprocessor, or None when it is disabled."""
+    app = app or current_app
+    return app.extensions.get('preprocessor')
+
+
+def get_page_splitter(app=None):
+    """Returns the app's splitter for multi-page PDFs and TIFFs."""
+    app = app or current_app
+    return app.extensions.get('page_splitter')
+
+
+def get_models():
+    """The models to try in turn, cheapest first, from `MODEL_CASCADE`."""
+    return [get_model(name) for name in current_app.config.get('MODEL_CASCADE') or [DEFAULT_MODEL_NAME]]
+
+
+def _model_name(model):
+    return getattr(model, 'model_name', DEFAULT_MODEL_NAME)
+
+
+class _Cascade:
+    """The bookkeeping `run_cascade` and `run_cascade_async` share: usage, attempts and the report."""
+
+    def __init__(self, models, usage, report, progress):
+        self.models = models
+        self.usage = usage
+        self.report = report
+        self.progress = progress
+        self.tolerance = current_app.config.get('CASCADE_TOLERANCE', 0.01)
+        self.attempts = []
+
+    def add_usage(self, tokens):
+        for key, value in tokens.items():
+            self.usage[key] = self.usage.get(key, 0) + value
+
+    def accept(self, tier, start, tokens, extracted_data, error=None):
+        """Records model `tier`'s attempt; returns True if its result is the one to use."""
+        name = _model_name(self.models[tier])
+        last = tier == len(self.models) - 1
+        self.add_usage(tokens)
+        if error is not None:
+            problems = [error.message]
+        else:
+            with span('validate'):
+                problems = validate_extraction(extracted_data, tolerance=self.tolerance)
+        self.attempts.append({
+            'model': name,
+            'ms': round((time.perf_counter() - start) * 1000, 2),
+            'tokens': tokens,
+            'problems': problems,
+        })
+        if problems and not last:
+            next_name = _model_name(self.models[tier + 1])
+            log('escalation', from_model=name, to_model=next_name, problems=problems)
+            count('escalations')
+            if self.progress is not None:
+                self.progress('escalated', {'from': name, 'to': next_name, 'problems': problems})
+            return False
+
+        count('extractions', model=name)
+        tag(model=name, escalations=len(self.attempts) - 1)
+        if self.report is not None:
+            self.report['model'] = {'served_by': name, 'escalated': len(self.attempts) > 1, 'attempts': self.attempts}
+        return True
+
+
+def run_cascade(models, extract, usage, report=None, progress=None):
+    """Calls extract(model, tokens) with each model in turn until a result passes validation.
+
+    Every result is checked with `validate_extraction`. A result that passes,
+    or the last model's result whatever its problems, is returned. A model
+    that fails to produce JSON at all also counts as failing validation,
+    unless it is the last one. Token counts from every call are added to
+    `usage`, and `report['model']` records which model served the document
+    and why any earlier ones were passed over.
+    """
+    cascade = _Cascade(models, usage, report, progress)
+    for tier, model in enumerate(models):
+        tokens = {}
+        start = time.perf_counter()
+        try:
+            extracted_data, error = extract(model, tokens), None
+        except ExtractionError as e:
+            if tier == len(models) - 1:
+                cascade.add_usage(tokens)
+                raise
+            extracted_data, error = None, e
+        if cascade.accept(tier, start, tokens, extracted_data, error):
+            return extracted_data
+
+
+async def run_cascade_async(models, extract, usage, report=None):
+    """`run_cascade` for a coroutine function extract(model, tokens)."""
+    cascade = _Cascade(models, usage, report, None)
+    for tier, model in enumerate(models):
+        tokens = {}
+        start = time.perf_counter()
+        try:
+            extracted_data, error = await extract(model, tokens), None
+        except ExtractionError as e:
+            if tier == len(models) - 1:
+                cascade.add_usage(tokens)
+                raise
+            extracted_data, error = None, e
+        if cascade.accept(tier, start, tokens, extracted_data, error):
+            return extracted_data
+
+
+def _prepare_image(data, preprocessor, report, progress):
+    """The single-page image to send to the model: preprocessed, or decoded as it is."""
+    if preprocessor is None:
+        from PIL import Image
+
+        image = Image.open(io.BytesIO(data))
+        with span('decode'):
+            image.load()
+        return image
+    with span('preprocess'):
+        image_data, mime_type, preprocessing = preprocessor.process(data)
+    report['preprocessing'] = preprocessing
+    if progress is not None:
+        progress('preprocessed', preprocessing)
+    return {'mime_type': mime_type, 'data': image_data}
+
+
+def _record_tokens(usage, report):
+    count('model_input_tokens', usage.get('input_tokens', 0))
+    count('model_output_tokens', usage.get('output_tokens', 0))
+    report['tokens'] = usage
+
+
+def _extract_uncached(data, models, preprocessor, splitter, report, progress):
+    """The model side of `extract_document`, filling in `report`."""
+    usage = {}
+    on_text = None if progress is None else lambda text: progress('text', text)
+    image = None
+    try:
+        if splitter is not None and splitter.is_multipage(data):
+            def extract(model, tokens):
+                return splitter.extract(data, model, preprocessor, report, tokens)
+        else:
+            image = _prepare_image(data, preprocessor, report, progress)
+
+            def extract(model, tokens):
+                return extract_invoice(image, model, tokens, on_text)
+        extracted_data = run_cascade(models, extract, usage, report, progress)
+    finally:
+        if image is not None and not isinstance(image, dict):
+            image.close()
+    _record_tokens(usage, report)
+    return extracted_data
+
+
+async def _extract_uncached_async(data, models, preprocessor, splitter, report):
+    """The model side of `extract_document_async`, filling in `report`."""
+    if splitter is not None and splitter.is_multipage(data):
+        # Pages are already extracted concurrently on the splitter's threads.
+        return await asyncio.to_thread(_extract_uncached, data, models, preprocessor, splitter, report, None)
+    usage = {}
+    image = await asyncio.to_thread(_prepare_image, data, preprocessor, report, None)
+    try:
+        extracted_data = await run_cascade_async(
+            models, lambda model, tokens: extract_invoice_async(image, model, tokens), usage, report
+        )
+    finally:
+        if image is not None and not isinstance(image, dict):
+            image.close()
+    _record_tokens(usage, report)
+    return extracted_data
+
+
+def _document_key(data, models):
+    return cache_key(data, '>'.join(_model_name(model) for model in models), build_prompt())
+
+
+def _check_cache(cache, key, report):
+    """Looks `key` up in `cache`, recording the outcome; returns the cached extraction or None."""
+    if cache is None:
+        return None
+    with span('cache_lookup'):
+        cached = cache.get(key)
+    count('cache_hits' if cached is not None else 'cache_misses')
+    if report is not None:
+        report['cache'] = 'hit' if cached is not None else 'miss'
+    return cached
+
+
+def _finish_document(key, extracted_data, details, shared, cache, report):
+    if report is not None:
+        report.update(details)
+        if shared:
+            # The tokens were spent, and counted, by the upload this one waited for.
+            report.update(cache='coalesced', tokens={})
+    if cache is not None and not shared:
+        cache.set(key, extracted_data)
+    return extracted_data
+
+
+def extract_document(data, models=None, cache=None, preprocessor=None, splitter=None, report=None, progress=None):
+    """Extracts an invoice from raw document bytes, consulting `cache` first.
+
+    A cache hit skips preprocessing and the model call entirely; the caller
+    goes straight on to `save_extracted_data`. So does an upload of the same
+    document while it is already being extracted: it waits for that
+    extraction instead of starting its own (see `ModelClient.coalesce`).
+    Multi-page PDFs and TIFFs are handed to `splitter`, which extracts the
+    pages concurrently and merges them into one invoice. `models` (by
+    default the `MODEL_CASCADE`) are tried in turn by `run_cascade`; the
+    image is only prepared once. When `report` is a dict it is filled in
+    with the cache outcome ('hit', 'miss' or 'coalesced'), the
+    preprocessing report, the model that served the document and the token
+    usage.
+
+    `progress`, if given, is called as progress(event, payload) with a
+    'preprocessed' event, for single images a 'text' event for each chunk of
+    the streamed model response, and an 'escalated' event whenever a result
+    is thrown away for the next model's.
+    """
+    if models is None:
+        models = get_models()
+    key = _document_key(data, models)
+    cached = _check_cache(cache, key, report)
+    if cached is not None:
+        return cached
+
+    def extract():
+        details = {}
+        return _extract_uncached(data, models, preprocessor, splitter, details, progress), details
+
+    (extracted_data, details), shared = get_model_client().coalesce(key, extract)
+    return _finish_document(key, extracted_data, details, shared, cache, report)
+
+
+async def extract_document_async(data, models=None, cache=None, preprocessor=None, splitter=None, report=None):
+    """`extract_document` for the event loop, without progress events.
+
+    Single images are prepared on a worker thread and sent with the models'
+    `generate_content_async`, so waiting on the model holds no thread.
+    Multi-page documents go through the threaded path on a worker thread.
+    """
+    if models is None:
+        models = get_models()
+    key = _document_key(data, models)
+    cached = _check_cache(cache, key, report)
+    if cached is not None:
+        return cached
+
+    async def extract():
+        details = {}
+        return await _extract_uncached_async(data, models, preprocessor, splitter, details), details
+
+    (extracted_data, details), shared = await get_model_client().coalesce_async(key, extract)
+    return _finish_document(key, extracted_data, details, shared, cache, report)
+
+
+def insert_details(rows, session=None):
+    """Bulk-inserts SalesOrderDetail rows and returns their new IDs in order.
+
+    executemany takes its columns from the first row, so every row is given
+    the same keys, with column defaults standing in for missing values.
+    """
+    session = db.session if session is None else session
+    if not rows:
+        return []
+    columns = set().union(*rows)
+    rows = [{name: row.get(name) for name in columns} for row in rows]
+    for row in rows:
+        for name, default in DETAIL_DEFAULTS.items():
+            if row.get(name) is None:
+                row[name] = default
+    statement = insert(models.SalesOrderDetail).returning(
+        models.SalesOrderDetail.SalesOrderDetailID, sort_by_parameter_order=True
+    )
+    return list(session.scalars(statement, rows))
+
+
+def save_extracted_data(extracted_data, commit=True, progress=None, session=None):
+    """Writes the extracted header and details to the database.
+
+    Returns the response payload the frontend expects. The caller owns the
+    session (by default the app's) and is responsible for rolling back if
+    this raises. The order is added to the analytics rollups in the same
+    transaction. With `commit=False` the rows are only flushed, so several
+    documents can share one transaction. `progress`, if given, is called as
+    progress('hydrated', {'index': ..., 'detail': ...}) for each stored line
+    before the commit, where index is the line's position in the extraction.
+    """
+    session = db.session if session is None else session
+    header_data = extracted_data.get('SalesOrderHeader')
+    details_data = extracted_data.get('SalesOrderDetail')
+    customer_name_str = extracted_data.get('CustomerName')
+
+    if not header_data or not details_data:
+        raise ExtractionError('Extracted data is missing required sections.')
+    begin_write(session)
+    # -- I have put this here because I cannot create multiple invoices just to test so random assignment
+    if os.getenv('TESTING', 'false').lower() == 'true':
+        # Find the highest existing sales order number to generate a new one.
+        last_order_num_str = session.query(db.func.max(db.func.substr(models.SalesOrderHeader.SalesOrderNumber, 3))).filter(models.SalesOrderHeader.SalesOrderNumber.like('SO%')).scalar()
+
+        last_known_max = 75123
+        last_order_num = 0
+        if last_order_num_str:
+            try:
+                last_order_num = int(last_order_num_str)
+            except (ValueError, TypeError):
+                pass # Keep it at 0 if conversion fails
+
+        # Use the greater of the DB max or the known last number from previous data
+        new_number = max(last_known_max, last_order_num) + 1
+        new_sales_order_number = f"SO{new_number}"
+
+        log('testing_override', sales_order_number=new_sales_order_number)
+        header_data['SalesOrderNumber'] = new_sales_order_number
+
+    # Explicitly remove any SalesOrderID from LLM to ensure DB generates a new one.
+    header_data.pop('SalesOrderID', None)
+    # Edits must quote the revision they started from (see orders.update_order).
+    header_data['RevisionNumber'] = 0
+
+    # Check if an order with this SalesOrderNumber already exists
+    sales_order_number = header_data.get('SalesOrderNumber')
+    if sales_order_number:
+        with span('duplicate_check'):
+            existing_order = session.query(models.SalesOrderHeader).filter_by(SalesOrderNumber=sales_order_number).first()
+        if existing_order:
+            raise ExtractionError(f"An order with SalesOrderNumber '{sales_order_number}' already exists.", 409) # HTTP 409 Conflict
+
+    # Find customer
+    if customer_name_str:
+        lookup_index = get_lookup_index()
+        with span('customer_lookup'):
+            customer_id = lookup_index.resolve_customer(customer_name_str)
+            if customer_id is None:
+                match = lookup_index.fuzzy_customer(
+                    customer_name_str, extracted_data.get('BillingAddress') or extracted_data.get('ShippingAddress')
+                )
+                if match:
+                    customer_id = match[0]
+        if customer_id is not None:
+            header_data['CustomerID'] = customer_id
+
+    # Convert date strings
+    for field in ['OrderDate', 'DueDate', 'ShipDate']:
+        if header_data.get(field) and isinstance(header_data[field], str):
+            try:
+                header_data[field] = datetime.strptime(header_data[field], '%Y-%m-%d')
+            except ValueError:
+                header_data[field] = None
+
+    with span('insert_header'):
+        new_header = models.SalesOrderHeader(**header_data)
+        session.add(new_header)
+        session.flush() # This is sufficient to get the ID on new_header
+
+    # Update the original header dict with the new ID for the response
+    header_data['SalesOrderID'] = new_header.SalesOrderID
+
+    # Resolve every line's product at once, then insert the details in one statement.
+    with span('product_hydration'):
+        products = get_lookup_index().resolve_products(d.get('ProductNumber') for d in details_data)
+        hydrated_details = []
+        hydrated_lines = []
+        rows = []
+        for line, detail_data in enumerate(details_data):
+            product = products.get(detail_data.get('ProductNumber'))
+            if not product:
+                # Recover OCR slips such as 0/O or a dropped hyphen without another model call.
+                match = get_lookup_index().fuzzy_product(detail_data.get('ProductNumber'))
+                if match:
+                    product, score = match
+                    detail_data['ExtractedProductNumber'] = detail_data.get('ProductNumber')
+                    detail_data['ProductNumber'] = product.ProductNumber
+                    detail_data['MatchScore'] = round(score, 3)
+            if product:
+                row = {key: value for key, value in detail_data.items() if key in DETAIL_COLUMNS}
+                row['ProductID'] = product.ProductID
+                row['SalesOrderID'] = new_header.SalesOrderID
+                rows.append(row)
+
+                detail_data['SalesOrderID'] = new_header.SalesOrderID
+                detail_data['Name'] = product.Name
+                detail_data['Color'] = product.Color
+                detail_data['Size'] = product.Size
+                detail_data['ListPrice'] = product.ListPrice
+                hydrated_details.append(detail_data)
+                hydrated_lines.append(line)
+
+    with span('insert_details'):
+        detail_ids = insert_details(rows, session)
+    for line, detail_data, detail_id in zip(hydrated_lines, hydrated_details, detail_ids):
+        detail_data['SalesOrderDetailID'] = detail_id
+        if progress is not None:
+            progress('hydrated', {'index': line, 'detail': detail_data})
+
+    with span('rollups'):
+        update_rollups([new_header.SalesOrderID], 1, session)
+
+    if commit:
+        with span('commit'):
+            session.commit()
+
+    # --- Construct Detailed Response for Frontend ---
+    return {
+        "SalesOrderHeader": header_data,
+        "CustomerInfo": extracted_data.get('CustomerName'),
+        "BillingAddress": extracted_data.get('BillingAddress'),
+        "ShippingAddress": extracted_data.get('ShippingAddress'),
+        "SalesOrderDetail": hydrated_details,
+    }
@@ -0,0 +1,129 @@
+import asyncio
+import json
+import random
+import threading
+import time
+from collections import deque
+from types import SimpleNamespace
+from .extraction import TransientModelError
+
+# A small, valid invoice in the shape the real prompt asks for.
+DEFAULT_RESPONSE = {
+    "SalesOrderHeader": {
+        "SalesOrderNumber": "SO99001",
+        "OrderDate": "2024-01-15",
+        "DueDate": "2024-01-27",
+        "ShipDate": "2024-01-22",
+        "AccountNumber": "10-4030-000001",
+        "CustomerID": 1,
+        "SubTotal": 100.0,
+        "TaxAmt": 8.0,
+        "Freight": 2.5,
+        "TotalDue": 110.5,
+    },
+    "SalesOrderDetail": [
+        {"ProductNumber": "BK-R93R-62", "OrderQty": 1, "UnitPrice": 100.0, "LineTotal": 100.0},
+    ],
+    "CustomerName": "Jon Yang",
+    "BillingAddress": "3761 N. 14th St, Rockhampton, Queensland 4700",
+    "ShippingAddress": "3761 N. 14th St, Rockhampton, Queensland 4700",
+}
+
+
+# Gemini bills each image part as a flat number of tokens.
+IMAGE_TOKENS = 258
+
+
+def estimate_tokens(text):
+    """Rough token count for text, at about four characters per token."""
+    return max(1, len(text) // 4)
+
+
+class FakeResponse:
+    def __init__(self, text, input_tokens=0):
+        self.text = text
+        self.usage_metadata = SimpleNamespace(
+            prompt_token_count=input_tokens,
+            candidates_token_count=estimate_tokens(text),
+        )
+
+
+class FakeGenerativeModel:
+    """Drop-in stand-in for `genai.GenerativeModel` that never leaves the process.
+
+    Returns canned JSON after `latency` seconds and raises
+    `TransientModelError` with probability `failure_rate`. With `quota_rpm`
+    it also enforces a requests-per-minute quota the way the API does,
+    answering calls over it with a 429 `ResourceExhausted`. Like Gemini, it
+    answers with bare JSON when `generation_config` asks for
+    `application/json`, and in a fenced block otherwise. With `stream=True`
+    the text arrives in `chunk_size` pieces spread over the latency.
+    `generate_content_async` waits with `asyncio.sleep` instead.
+    """
+
+    def __init__(self, model_name='fake', response=None, latency=0.0, failure_rate=0.0, generation_config=None,
+                 chunk_size=32, quota_rpm=None):
+        self.model_name = model_name
+        self.generation_config = generation_config or {}
+        self.response = DEFAULT_RESPONSE if response is None else response
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.chunk_size = chunk_size
+        self.quota_rpm = quota_rpm
+        self.calls = 0
+        self._recent = deque()
+        self._lock = threading.Lock()
+
+    def _check_quota(self):
+        if not self.quota_rpm:
+            return
+        with self._lock:
+            now = time.monotonic()
+            while self._recent and now - self._recent[0] >= 60:
+                self._recent.popleft()
+            if len(self._recent) >= self.quota_rpm:
+                from google.api_core import exceptions as google_exceptions
+
+                raise google_exceptions.ResourceExhausted('Fake model: quota exceeded')
+            self._recent.append(now)
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        self.calls += 1
+        self._check_quota()
+        if stream:
+            return self._stream(contents)
+        if self.latency:
+            time.sleep(self.latency)
+        return self._respond(contents)
+
+    async def generate_content_async(self, contents, **kwargs):
+        self.calls += 1
+        self._check_quota()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._respond(contents)
+
+    def _stream(self, contents):
+        # Half the latency before the first chunk, the rest spread over the others.
+        if self.latency:
+            time.sleep(self.latency / 2)
+        response = self._respond(contents)
+        pieces = [response.text[i:i + self.chunk_size] for i in range(0, len(response.text), self.chunk_size)]
+        for number, piece in enumerate(pieces, start=1):
+            if self.latency and number > 1:
+                time.sleep(self.latency / 2 / len(pieces))
+            chunk = FakeResponse(piece, response.usage_metadata.prompt_token_count)
+            if number == len(pieces):
+                # As with Gemini, the last chunk carries the totals.
+                chunk.usage_metadata = response.usage_metadata
+            yield chunk
+
+    def _respond(self, contents):
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise TransientModelError('Fake model: simulated quota error')
+        payload = self.response() if callable(self.response) else self.response
+        text = payload if isinstance(payload, str) else json.dumps(payload)
+        input_tokens = sum(estimate_tokens(part) if isinstance(part, str) else IMAGE_TOKENS for part in contents)
+        if self.generation_config.get('response_mime_type') == 'application/json':
+            return FakeResponse(text, input_tokens)
+        return FakeResponse(f"```json\n{text}\n```", input_tokens)
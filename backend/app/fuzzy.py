@@ -0,0 +1,213 @@
+import heapq
+import re
+from collections import Counter, defaultdict
+from sqlalchemy import select
+from .database import db
+from . import models
+
+# Characters OCR commonly mistakes for one another, folded to one form so
+# "BK-R93R-62", "BKR93R62" and "8K-R93R-6Z" all normalize to the same key.
+_CODE_CONFUSABLES = str.maketrans({
+    'O': '0', 'Q': '0', 'D': '0',
+    'I': '1', 'L': '1', '|': '1',
+    'Z': '2', 'S': '5', 'B': '8', 'G': '6',
+})
+_NON_ALNUM = re.compile(r'[^0-9a-z]+')
+
+
+def literal_code(value):
+    """A product number uppercase and without separators, confusables left as written."""
+    return re.sub(r'[^0-9A-Z|]', '', (value or '').upper())
+
+
+def normalize_code(value):
+    """Normalizes a product number: uppercase, no separators, confusables folded."""
+    return literal_code(value).translate(_CODE_CONFUSABLES)
+
+
+def normalize_text(value):
+    """Normalizes free text such as names and addresses."""
+    return _NON_ALNUM.sub(' ', (value or '').lower()).strip()
+
+
+def trigrams(value):
+    padded = f"  {value} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def dice(a, b):
+    if not a or not b:
+        return 0.0
+    return 2 * len(a & b) / (len(a) + len(b))
+
+
+class TrigramIndex:
+    """An inverted index from character trigrams to documents.
+
+    Each document is a piece of text attached to a key; a key may have
+    several documents (e.g. a customer with more than one address). `search`
+    ranks keys by the Dice coefficient of their best document's trigrams
+    against the query's, counting shared trigrams through the postings lists
+    so only documents sharing at least one trigram are ever scored.
+
+    When several keys normalize to the same text as the query (e.g.
+    BK-0100 and BK-O100 once confusables are folded), normalizing can't
+    tell them apart, so they are ranked on their `literal` form instead, the
+    text as written: only a key whose literal form equals the query's scores
+    1.0, and the rest score their literal similarity.
+    """
+
+    def __init__(self, normalize=normalize_text, literal=None):
+        self.normalize = normalize
+        self.literal = literal or normalize
+        self._postings = defaultdict(list)
+        self._keys = []
+        self._sizes = []
+        self._exact = defaultdict(dict)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, key, text):
+        normalized = self.normalize(text)
+        if not normalized:
+            return
+        grams = trigrams(normalized)
+        doc = len(self._keys)
+        self._keys.append(key)
+        self._sizes.append(len(grams))
+        self._exact[normalized].setdefault(key, self.literal(text))
+        for gram in grams:
+            self._postings[gram].append(doc)
+
+    def search(self, text, limit=5, min_score=0.0):
+        """Returns up to `limit` (key, score) pairs, best first."""
+        normalized = self.normalize(text)
+        if not normalized:
+            return []
+        grams = trigrams(normalized)
+        counts = Counter()
+        for gram in grams:
+            postings = self._postings.get(gram)
+            if postings:
+                counts.update(postings)
+
+        best = {}
+        query_size = len(grams)
+        for doc, shared in counts.items():
+            score = 2 * shared / (query_size + self._sizes[doc])
+            key = self._keys[doc]
+            if score >= min_score and score > best.get(key, 0.0):
+                best[key] = score
+        # A normalized exact match (e.g. only a confusable differed) always wins,
+        # unless several keys share it; then the literal forms decide.
+        exact = self._exact.get(normalized, {})
+        if len(exact) == 1:
+            best[next(iter(exact))] = 1.0
+        elif exact:
+            literal = self.literal(text)
+            literal_grams = trigrams(literal)
+            for key, written in exact.items():
+                score = 1.0 if written == literal else dice(literal_grams, trigrams(written))
+                if score >= min_score:
+                    best[key] = score
+                else:
+                    best.pop(key, None)
+        return heapq.nlargest(limit, best.items(), key=lambda item: item[1])
+
+
+class MatchEngine:
+    """Approximate matching over products and customers.
+
+    Products are indexed by ProductNumber (with OCR confusables folded) and
+    by Name. Customers are indexed by the names of IndividualCustomers and
+    StoreCustomers, with their addresses kept to break ties.
+    """
+
+    def __init__(self, products):
+        self.products = {row.ProductID: row for row in products.values()}
+        self.product_numbers = TrigramIndex(normalize_code, literal_code)
+        self.product_names = TrigramIndex()
+        for row in self.products.values():
+            self.product_numbers.add(row.ProductID, row.ProductNumber)
+            self.product_names.add(row.ProductID, row.Name)
+
+        self.customers = {}
+        self.customer_names = TrigramIndex()
+        self._addresses = defaultdict(list)
+        self._load_customers()
+
+    def _load_customers(self):
+        # On a connection of its own, like the lookup index (see lookup.py), so
+        # building the engine never leaves a transaction open on a session.
+        with db.engine.connect() as connection:
+            individuals = connection.execute(
+                select(
+                    models.IndividualCustomer.BusinessEntityID,
+                    models.IndividualCustomer.FirstName,
+                    models.IndividualCustomer.MiddleName,
+                    models.IndividualCustomer.LastName,
+                    models.IndividualCustomer.AddressLine1,
+                    models.IndividualCustomer.City,
+                    models.IndividualCustomer.StateProvinceName,
+                    models.IndividualCustomer.PostalCode,
+                    models.Customer.CustomerID,
+                )
+                .outerjoin(models.Customer, models.Customer.PersonID == models.IndividualCustomer.BusinessEntityID)
+            )
+            for row in individuals:
+                name = ' '.join(part for part in (row.FirstName, row.MiddleName, row.LastName) if part)
+                short_name = ' '.join(part for part in (row.FirstName, row.LastName) if part)
+                self._add_customer(('individual', row.BusinessEntityID), row.CustomerID, name, row, short_name)
+
+            stores = connection.execute(
+                select(
+                    models.StoreCustomers.BusinessEntityID,
+                    models.StoreCustomers.Name,
+                    models.StoreCustomers.AddressLine1,
+                    models.StoreCustomers.City,
+                    models.StoreCustomers.StateProvinceName,
+                    models.StoreCustomers.PostalCode,
+                    models.Customer.CustomerID,
+                )
+                .outerjoin(models.Customer, models.Customer.StoreID == models.StoreCustomers.BusinessEntityID)
+            )
+            for row in stores:
+                self._add_customer(('store', row.BusinessEntityID), row.CustomerID, row.Name, row)
+
+    def _add_customer(self, key, customer_id, name, row, *aliases):
+        address = ', '.join(str(part) for part in (row.AddressLine1, row.City, row.StateProvinceName, row.PostalCode) if part)
+        if key not in self.customers:
+            self.customers[key] = {
+                'CustomerID': customer_id,
+                'Type': key[0],
+                'BusinessEntityID': key[1],
+                'Name': name,
+                'Address': address,
+            }
+            for text in {name, *aliases}:
+                self.customer_names.add(key, text)
+        if address:
+            self._addresses[key].append(trigrams(normalize_text(address)))
+
+    def match_products(self, query, limit=5, min_score=0.0):
+        """Ranks products against a ProductNumber or product name."""
+        scores = {}
+        for index in (self.product_numbers, self.product_names):
+            for product_id, score in index.search(query, limit, min_score):
+                scores[product_id] = max(score, scores.get(product_id, 0.0))
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return [(self.products[product_id], score) for product_id, score in ranked]
+
+    def match_customers(self, name, address=None, limit=5, min_score=0.0):
+        """Ranks customers by name; a matching address can only raise a score."""
+        # Over-fetch so an address can promote a slightly weaker name match.
+        candidates = self.customer_names.search(name, limit * 4 if address else limit, min_score)
+        if address:
+            address_grams = trigrams(normalize_text(address))
+            candidates = [
+                (key, max(score, 0.75 * score + 0.25 * max((dice(address_grams, grams) for grams in self._addresses[key]), default=0.0)))
+                for key, score in candidates
+            ]
+            candidates.sort(key=lambda item: item[1], reverse=True)
+        return [(self.customers[key], score) for key, score in candidates[:limit]]
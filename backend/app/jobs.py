@@ -0,0 +1,359 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import closing
+from .database import db
+from .extraction import (
+    ExtractionError, extract_document, get_extraction_cache,
+    get_page_splitter, get_preprocessor, save_extracted_data, transient_model_errors
+)
+from .metrics import count, get_metrics, log, log_exception, start_trace, use_trace
+from .model_client import ModelBusyError, get_model_client
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class JobQueue:
+    """A persistent extraction queue stored in its own SQLite file.
+
+    Kept separate from the main database so that queue bookkeeping never
+    competes with order inserts for the write lock.
+
+    Several processes (e.g. uvicorn workers) can share one queue file. A
+    claimed job is leased to the claiming queue's `worker_id`, which renews
+    the lease with `heartbeat` while it works. A running job is only taken
+    over by another worker once `lease` seconds pass without a heartbeat,
+    i.e. when its process has died, and a worker that lost its lease can no
+    longer record an outcome for the job. A job whose lease has expired
+    `max_attempts` times is marked failed instead of being leased again, so
+    a document that crashes its worker doesn't take down one after another.
+    """
+
+    def __init__(self, path, lease=60.0, max_attempts=3):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._lock = threading.Lock()
+        self._changed = threading.Condition()
+        with closing(self._connect()) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    filename TEXT,
+                    payload BLOB,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    result TEXT,
+                    error TEXT,
+                    status_code INTEGER,
+                    worker_id TEXT,
+                    heartbeat_at REAL,
+                    run_after REAL NOT NULL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            # Queue files created before leases were added lack their columns.
+            columns = {row['name'] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, kind in (('worker_id', 'TEXT'), ('heartbeat_at', 'REAL')):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_jobs_status_run_after ON jobs (status, run_after)")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _update(self, job_id, **fields):
+        """Updates a job this worker holds the lease on; returns False if it no longer does."""
+        fields['updated_at'] = time.time()
+        assignments = ', '.join(f"{key} = ?" for key in fields)
+        with closing(self._connect()) as conn:
+            updated = conn.execute(
+                f"UPDATE jobs SET {assignments} WHERE id = ? AND status = ? AND worker_id = ?",
+                (*fields.values(), job_id, RUNNING, self.worker_id),
+            ).rowcount
+        if not updated:
+            log('job_lease_lost', level='warning', job_id=job_id, worker_id=self.worker_id)
+        with self._changed:
+            self._changed.notify_all()
+        return updated > 0
+
+    def enqueue(self, payload, filename=None):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, status, filename, payload, run_after, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, QUEUED, filename, payload, now, now, now),
+            )
+        with self._changed:
+            self._changed.notify_all()
+        return job_id
+
+    def claim(self):
+        """Atomically takes the oldest runnable job, or returns None.
+
+        Runnable means queued and due, or running under a lease that has
+        expired because its worker stopped sending heartbeats.
+        """
+        abandoned = []
+        with self._lock, closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            while True:
+                row = conn.execute(
+                    "SELECT * FROM jobs WHERE (status = ? AND run_after <= ?) "
+                    "OR (status = ? AND (heartbeat_at IS NULL OR heartbeat_at < ?)) "
+                    "ORDER BY created_at LIMIT 1",
+                    (QUEUED, now, RUNNING, now - self.lease),
+                ).fetchone()
+                if row is None or row['status'] == QUEUED or row['attempts'] < self.max_attempts:
+                    break
+                conn.execute(
+                    "UPDATE jobs SET status = ?, error = ?, status_code = ?, payload = NULL, worker_id = NULL, "
+                    "updated_at = ? WHERE id = ?",
+                    (FAILED, f"The job's worker stopped responding on each of {row['attempts']} attempts.", 500,
+                     now, row['id']),
+                )
+                abandoned.append(row)
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET status = ?, worker_id = ?, heartbeat_at = ?, attempts = attempts + 1, "
+                    "updated_at = ? WHERE id = ?",
+                    (RUNNING, self.worker_id, now, now, row['id']),
+                )
+            conn.execute("COMMIT")
+        for job in abandoned:
+            log('job_abandoned', level='error', job_id=job['id'], attempts=job['attempts'],
+                previous_worker=job['worker_id'])
+        if abandoned:
+            with self._changed:
+                self._changed.notify_all()
+        if row is None:
+            return None
+        if row['status'] == RUNNING:
+            log('job_lease_expired', level='warning', job_id=row['id'], previous_worker=row['worker_id'])
+        job = dict(row, status=RUNNING, worker_id=self.worker_id, heartbeat_at=now)
+        job['attempts'] += 1
+        return job
+
+    def heartbeat(self):
+        """Renews the lease on every job this worker is running."""
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "UPDATE jobs SET heartbeat_at = ? WHERE status = ? AND worker_id = ?",
+                (now, RUNNING, self.worker_id),
+            )
+
+    def complete(self, job_id, result, status_code=200):
+        # The image is no longer needed once the job has an outcome.
+        return self._update(job_id, status=DONE, result=result, status_code=status_code, payload=None)
+
+    def fail(self, job_id, error, status_code=500):
+        return self._update(job_id, status=FAILED, error=error, status_code=status_code, payload=None)
+
+    def retry(self, job_id, delay, error):
+        return self._update(job_id, status=QUEUED, error=error, run_after=time.time() + delay)
+
+    def get(self, job_id):
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT id, status, filename, attempts, result, error, status_code, created_at, updated_at "
+                "FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        return dict(row) if row else None
+
+    def wait(self, job_id, timeout):
+        """Blocks until the job is finished or `timeout` seconds have passed."""
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self.get(job_id)
+            remaining = deadline - time.monotonic()
+            if job is None or job['status'] in (DONE, FAILED) or remaining <= 0:
+                return job
+            with self._changed:
+                # Short waits so jobs finished by another process are still noticed.
+                self._changed.wait(min(remaining, 0.5))
+
+
+class WorkerPool:
+    """A fixed number of threads that drain the job queue.
+
+    The thread count is the concurrency bound on model calls. A job is put
+    back in the queue, with exponential backoff, up to `max_retries`
+    attempts, but only for transient errors the model client hasn't already
+    retried (see `_requeue`). One more thread renews the leases on the jobs
+    being worked on.
+    """
+
+    def __init__(self, app, queue, workers=2, max_retries=3, backoff=2.0, poll_interval=0.5):
+        self.app = app
+        self.queue = queue
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.poll_interval = poll_interval
+        self._threads = []
+        self._stop = threading.Event()
+
+    def start(self):
+        if self._threads:
+            return
+        self._stop.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"extraction-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        thread = threading.Thread(target=self._heartbeat, name="extraction-heartbeat", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        with self.queue._changed:
+            self.queue._changed.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _heartbeat(self):
+        # A few beats per lease, so one slow write doesn't let the lease lapse.
+        while not self._stop.wait(self.queue.lease / 3):
+            try:
+                self.queue.heartbeat()
+            except sqlite3.Error as e:
+                log('job_heartbeat_failed', level='error', error=str(e))
+
+    def _requeue(self, error):
+        """Whether a transient error should send the job back to the queue.
+
+        The model client has already retried errors from the API itself, so
+        retrying the job as well would multiply the calls per document to
+        max_retries x (MODEL_MAX_RETRIES + 1). Only a ModelBusyError, raised
+        before any call was made, is retried here, unless the client is set
+        not to retry at all.
+        """
+        return isinstance(error, ModelBusyError) or get_model_client(self.app).max_retries == 0
+
+    def _run(self):
+        while not self._stop.is_set():
+            job = self.queue.claim()
+            if job is None:
+                with self.queue._changed:
+                    self.queue._changed.wait(self.poll_interval)
+                continue
+            self.process(job)
+
+    def process(self, job):
+        # The job ID doubles as the request ID, tying the job's log lines together.
+        trace = start_trace(get_metrics(self.app), job['id'])
+        outcome = DONE
+        with self.app.app_context(), use_trace(trace):
+            try:
+                report = {}
+                extracted_data = extract_document(
+                    job['payload'],
+                    cache=get_extraction_cache(self.app),
+                    preprocessor=get_preprocessor(self.app),
+                    splitter=get_page_splitter(self.app),
+                    report=report,
+                )
+                response = {
+                    "status": "success",
+                    "message": "Data saved to database.",
+                    "data": save_extracted_data(extracted_data),
+                    "model": report.get('model'),
+                }
+                self.queue.complete(job['id'], self.app.json.dumps(response))
+            except transient_model_errors() as e:
+                db.session.rollback()
+                if job['attempts'] < self.max_retries and self._requeue(e):
+                    delay = self.backoff * 2 ** (job['attempts'] - 1)
+                    log('job_retry', level='warning', job_id=job['id'], attempt=job['attempts'], delay=delay,
+                        error=str(e))
+                    count('model_retries')
+                    outcome = QUEUED
+                    self.queue.retry(job['id'], delay, str(e))
+                else:
+                    outcome = FAILED
+                    self.queue.fail(job['id'], f'An error occurred: {str(e)}', 503)
+            except ExtractionError as e:
+                db.session.rollback()
+                outcome = FAILED
+                self.queue.fail(job['id'], e.message, e.status_code)
+            except Exception as e:
+                db.session.rollback()
+                outcome = FAILED
+                log_exception(e)
+                self.queue.fail(job['id'], f'An error occurred: {str(e)}')
+            finally:
+                db.session.remove()
+                if self.app.config.get('REQUEST_LOG'):
+                    log('job', level='error' if outcome == FAILED else 'info', status=outcome,
+                        attempt=job['attempts'], ms=round(trace.elapsed() * 1000, 2), **trace.summary())
+
+
+_pool_lock = threading.Lock()
+
+
+def get_worker_pool(app):
+    """Returns the app's worker pool, starting it on first use.
+
+    create_app calls this unless EXTRACTION_AUTOSTART is off, so jobs
+    still queued from before a restart are processed straight away.
+    """
+    with _pool_lock:
+        return _get_worker_pool(app)
+
+
+def _get_worker_pool(app):
+    pool = app.extensions.get('extraction_jobs')
+    if pool is None:
+        queue = JobQueue(
+            app.config['JOBS_DATABASE'],
+            lease=app.config['EXTRACTION_JOB_LEASE'],
+            max_attempts=app.config['EXTRACTION_MAX_RETRIES'],
+        )
+        pool = WorkerPool(
+            app,
+            queue,
+            workers=app.config['EXTRACTION_WORKERS'],
+            max_retries=app.config['EXTRACTION_MAX_RETRIES'],
+            backoff=app.config['EXTRACTION_RETRY_BACKOFF'],
+        )
+        app.extensions['extraction_jobs'] = pool
+    pool.start()
+    return pool
+
+
+def job_status(job):
+    """The public view of a job row."""
+    return {
+        'job_id': job['id'],
+        'status': job['status'],
+        'filename': job['filename'],
+        'attempts': job['attempts'],
+        'error': job['error'],
+        'created_at': job['created_at'],
+        'updated_at': job['updated_at'],
+    }
+
+
+def job_result(job):
+    """Returns (body, status_code) for a finished job."""
+    if job['status'] == DONE:
+        return json.loads(job['result']), job['status_code'] or 200
+    return {'error': job['error']}, job['status_code'] or 500
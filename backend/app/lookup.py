@@ -0,0 +1,208 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from itertools import chain
+from flask import current_app, has_app_context
+from sqlalchemy import event, select
+from .database import db
+from . import models
+from .fuzzy import MatchEngine
+from .metrics import log
+
+# Set by use_lookups; get_lookup_index returns it instead of the app's index.
+_current_index = contextvars.ContextVar('lookup_index', default=None)
+
+# Committing changes to any of these rows makes the index stale.
+WATCHED_MODELS = (models.Product, models.Customer, models.IndividualCustomer, models.StoreCustomers)
+
+
+def normalize_name(name):
+    """Case- and whitespace-insensitive (first, last) key for a customer name.
+
+    Like the original lookup, only the first and last tokens are used, so
+    middle names and initials don't prevent a match.
+    """
+    parts = (name or '').lower().split()
+    if not parts:
+        return None
+    return (parts[0], parts[-1]) if len(parts) > 1 else (parts[0], '')
+
+
+class LookupIndex:
+    """Preloaded Product and customer lookups used while hydrating orders.
+
+    Loaded on first use and kept until `invalidate` is called, which happens
+    automatically after a commit that touched a watched model. `ttl` bounds how
+    long edits made by other processes can go unnoticed.
+
+    When an exact lookup fails, `fuzzy_product` and `fuzzy_customer` fall back
+    to the trigram `MatchEngine`, accepting the best candidate only if it
+    scores at least `fuzzy_min_score`.
+    """
+
+    def __init__(self, ttl=300.0, fuzzy_min_score=0.75):
+        self.ttl = ttl
+        self.fuzzy_min_score = fuzzy_min_score
+        self._lock = threading.Lock()
+        self._products = None
+        self._customers = None
+        self._matcher = None
+        self._loaded_at = 0.0
+
+    def invalidate(self):
+        with self._lock:
+            self._products = None
+            self._customers = None
+            self._matcher = None
+
+    def load(self):
+        """Loads the lookups now if they are missing or stale, so the next lookups don't hit the database."""
+        self._ensure_loaded()
+
+    def _ensure_loaded(self):
+        with self._lock:
+            fresh = self.ttl is None or time.monotonic() - self._loaded_at < self.ttl
+            if self._products is not None and fresh:
+                return self._products, self._customers
+
+            # On a connection of its own that is closed straight away, so loading
+            # never leaves a transaction open on the caller's session, which may
+            # be about to wait on a model call or start a write.
+            with db.engine.connect() as connection:
+                products = {
+                    row.ProductNumber: row
+                    for row in connection.execute(select(
+                        models.Product.ProductID,
+                        models.Product.ProductNumber,
+                        models.Product.Name,
+                        models.Product.Color,
+                        models.Product.Size,
+                        models.Product.ListPrice,
+                    ))
+                }
+
+                customers = {}
+                rows = connection.execute(
+                    select(
+                        models.IndividualCustomer.FirstName,
+                        models.IndividualCustomer.LastName,
+                        models.Customer.CustomerID,
+                    )
+                    .join(models.Customer, models.Customer.PersonID == models.IndividualCustomer.BusinessEntityID)
+                    .order_by(models.IndividualCustomer.IndividualCustomerID)
+                )
+                for first_name, last_name, customer_id in rows:
+                    key = normalize_name(f"{first_name or ''} {last_name or ''}")
+                    if key:
+                        customers.setdefault(key, customer_id)
+
+            self._products, self._customers = products, customers
+            self._matcher = None
+            self._loaded_at = time.monotonic()
+            return products, customers
+
+    def matcher(self):
+        """Returns the fuzzy `MatchEngine`, building it on first use."""
+        products, _ = self._ensure_loaded()
+        with self._lock:
+            if self._matcher is None:
+                self._matcher = MatchEngine(products)
+            return self._matcher
+
+    def snapshot(self):
+        """A copy of the lookups as loaded now, fuzzy matcher included, that never reloads.
+
+        Loads them first if needed. Lookups on the copy never touch the
+        database, so it is what code that mustn't query part-way through
+        uses, such as the async routes on the event loop (see use_lookups).
+        """
+        while True:
+            matcher = self.matcher()
+            with self._lock:
+                # A reload in between clears the matcher; then go round again.
+                if self._matcher is matcher:
+                    snapshot = LookupIndex(ttl=None, fuzzy_min_score=self.fuzzy_min_score)
+                    snapshot._products, snapshot._customers = self._products, self._customers
+                    snapshot._matcher = matcher
+                    snapshot._loaded_at = self._loaded_at
+                    return snapshot
+
+    def resolve_products(self, product_numbers):
+        """Maps each known ProductNumber to its Product row in one step.
+
+        Unknown numbers are left out of the result.
+        """
+        products, _ = self._ensure_loaded()
+        return {number: products[number] for number in product_numbers if number in products}
+
+    def resolve_customer(self, name):
+        """Returns the CustomerID for a full customer name, or None."""
+        key = normalize_name(name)
+        if key is None:
+            return None
+        _, customers = self._ensure_loaded()
+        return customers.get(key)
+
+    def fuzzy_product(self, product_number):
+        """Returns (Product row, score) for the closest ProductNumber, or None.
+
+        None too when the best candidates tie, e.g. a misread that could be
+        either of two products differing only by a confusable (0/O, 1/I):
+        guessing would attach the line to the wrong product.
+        """
+        if not product_number:
+            return None
+        matches = self.matcher().match_products(product_number, limit=2, min_score=self.fuzzy_min_score)
+        if len(matches) > 1 and matches[0][1] == matches[1][1]:
+            log('fuzzy_match_ambiguous', level='warning', query=product_number, score=round(matches[0][1], 3),
+                candidates=[product.ProductNumber for product, _ in matches])
+            return None
+        return matches[0] if matches else None
+
+    def fuzzy_customer(self, name, address=None):
+        """Returns (CustomerID, score) for the closest named customer, or None."""
+        if not name:
+            return None
+        for candidate, score in self.matcher().match_customers(name, address, limit=5, min_score=self.fuzzy_min_score):
+            if candidate['CustomerID'] is not None and score >= self.fuzzy_min_score:
+                return candidate['CustomerID'], score
+        return None
+
+
+def get_lookup_index(app=None):
+    if app is None and _current_index.get() is not None:
+        return _current_index.get()
+    app = app or current_app
+    return app.extensions['lookup_index']
+
+
+@contextmanager
+def use_lookups(index):
+    """Makes get_lookup_index return `index`, e.g. a snapshot, for the duration of the block."""
+    token = _current_index.set(index)
+    try:
+        yield index
+    finally:
+        _current_index.reset(token)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _track_watched_changes(session, flush_context):
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, WATCHED_MODELS):
+            session.info['lookup_index_stale'] = True
+            return
+
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_after_commit(session):
+    if session.info.pop('lookup_index_stale', False) and has_app_context():
+        index = current_app.extensions.get('lookup_index')
+        if index is not None:
+            index.invalidate()
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _forget_after_rollback(session):
+    session.info.pop('lookup_index_stale', None)
@@ -1,67 +1,153 @@
 import os
-import json
-from flask import Flask, request, jsonify
+from flask import Blueprint, Flask, Response, current_app, request, jsonify
 from flask_cors import CORS
+from sqlalchemy.exc import OperationalError
 from werkzeug.utils import secure_filename
-import google.generativeai as genai
-from PIL import Image
 from dotenv import load_dotenv
-from .database import db
-from . import models
-from datetime import datetime
-
-# This will be populated with the content of models.py
-MODELS_SCHEMA = ""
-try:
-    with open(os.path.join(os.path.dirname(__file__), 'models.py'), 'r') as f:
-        MODELS_SCHEMA = f.read()
-except Exception as e:
-    print(f"Could not read models.py: {e}")
-
-
-load_dotenv()
+from .database import configure_database, db
+from .extraction import (
+    DEFAULT_MODEL_NAME, FAST_MODEL_NAME, ExtractionError, extract_document,
+    get_extraction_cache, get_page_splitter, get_preprocessor, save_extracted_data,
+    transient_model_errors
+)
+from .analytics import AnalyticsQueryError, sales_summary, top_customers
+from .batch import BatchError, collect_documents, process_batch
+from .cache import ExtractionCache
+from .fake_model import FakeGenerativeModel
+from .jobs import get_worker_pool, job_result, job_status
+from .lookup import LookupIndex, get_lookup_index
+from .model_client import ModelClient, parse_rpm
+from .metrics import Metrics, get_metrics, init_request_tracing, instrument_engine, log, log_exception, span
+from .pages import PageSplitter
+from .orders import OrderQueryError, OrderUpdateError, delete_order, get_order, list_orders, update_order
+from .preprocessing import Preprocessor
+from .prompt import build_prompt
+from .streaming import stream_upload
+
+# The routes; create_app registers them on each app it builds.
+api = Blueprint('api', __name__)
+
+def _is_truthy(value):
+    return (value or '').lower() in ('1', 'true', 'yes')
 
 def create_app():
+    """Builds the Flask app from the environment (and a .env file, if there is one).
+
+    Nothing happens at import time: the app, its database engine and the
+    model client only exist once this is called, and the Gemini SDK is only
+    imported when the first model is made (see extraction.gemini_model).
+    """
+    load_dotenv()
     app = Flask(__name__)
     CORS(app)
     
     basedir = os.path.abspath(os.path.dirname(__file__))
-    app.config['UPLOAD_FOLDER'] = os.path.join(basedir, '..', 'uploads')
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'database.db')
-    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-    db.init_app(app)
+    # Database (see database.py)
+    configure_database(app, os.path.join(basedir, 'database.db'))
+    # Retry-After (seconds) sent with the 503 when a read times out on a locked database
+    app.config['DATABASE_RETRY_AFTER'] = int(os.getenv('DATABASE_RETRY_AFTER', '1'))
+    # Background extraction jobs (see jobs.py)
+    app.config['JOBS_DATABASE'] = os.getenv('JOBS_DATABASE', os.path.join(basedir, 'jobs.db'))
+    app.config['EXTRACTION_WORKERS'] = int(os.getenv('EXTRACTION_WORKERS', '2'))
+    app.config['EXTRACTION_MAX_RETRIES'] = int(os.getenv('EXTRACTION_MAX_RETRIES', '3'))
+    app.config['EXTRACTION_RETRY_BACKOFF'] = float(os.getenv('EXTRACTION_RETRY_BACKOFF', '2.0'))
+    # Start the workers with the app, so jobs left in the queue by a restart are
+    # picked up without waiting for the next job request
+    app.config['EXTRACTION_AUTOSTART'] = _is_truthy(os.getenv('EXTRACTION_AUTOSTART', 'true'))
+    # Seconds without a heartbeat before another worker takes over a running job
+    app.config['EXTRACTION_JOB_LEASE'] = float(os.getenv('EXTRACTION_JOB_LEASE', '60'))
+    # Batch uploads (see batch.py)
+    app.config['BATCH_PARALLELISM'] = int(os.getenv('BATCH_PARALLELISM', '4'))
+    app.config['BATCH_COMMIT_SIZE'] = int(os.getenv('BATCH_COMMIT_SIZE', '20'))
+    app.config['BATCH_MAX_FILES'] = int(os.getenv('BATCH_MAX_FILES', '500'))
+    app.config['BATCH_MAX_BYTES'] = int(os.getenv('BATCH_MAX_BYTES', str(500 * 1024 * 1024)))
+    # Extraction cache (see cache.py). EXTRACTION_CACHE_SIZE=0 turns it off.
+    cache_size = int(os.getenv('EXTRACTION_CACHE_SIZE', '256'))
+    if cache_size > 0:
+        cache_ttl = os.getenv('EXTRACTION_CACHE_TTL')
+        app.extensions['extraction_cache'] = ExtractionCache(
+            max_entries=cache_size,
+            ttl=float(cache_ttl) if cache_ttl else None,
+            path=os.getenv('EXTRACTION_CACHE_PATH') or None,
+        )
+    # Product/customer lookups used while hydrating orders (see lookup.py)
+    app.extensions['lookup_index'] = LookupIndex(
+        ttl=float(os.getenv('LOOKUP_INDEX_TTL', '300')),
+        fuzzy_min_score=float(os.getenv('FUZZY_MATCH_MIN_SCORE', '0.75')),
+    )
+    # Image preprocessing before the model call (see preprocessing.py)
+    if _is_truthy(os.getenv('PREPROCESS_ENABLED', 'true')):
+        app.extensions['preprocessor'] = Preprocessor(
+            grayscale=_is_truthy(os.getenv('PREPROCESS_GRAYSCALE', 'true')),
+            max_pixels=int(os.getenv('PREPROCESS_MAX_PIXELS', '2500000')),
+            target_dpi=int(os.getenv('PREPROCESS_TARGET_DPI', '200')),
+            crop=_is_truthy(os.getenv('PREPROCESS_CROP', 'true')),
+            deskew=_is_truthy(os.getenv('PREPROCESS_DESKEW', 'true')),
+            output_format=os.getenv('PREPROCESS_FORMAT', 'JPEG'),
+            quality=int(os.getenv('PREPROCESS_QUALITY', '80')),
+        )
+    # Multi-page PDF and TIFF uploads (see pages.py)
+    app.extensions['page_splitter'] = PageSplitter(
+        max_pages=int(os.getenv('MAX_PAGES', '50')),
+        memory_limit=int(os.getenv('PAGE_MEMORY_LIMIT', str(256 * 1024 * 1024))),
+        parallelism=int(os.getenv('PAGE_PARALLELISM', '4')),
+        dpi=int(os.getenv('PAGE_RENDER_DPI', '200')),
+    )
+    # Seconds between keep-alive comments on /api/upload/stream
+    app.config['STREAM_HEARTBEAT'] = float(os.getenv('STREAM_HEARTBEAT', '15'))
+    # Ask Gemini for bare JSON that follows the schema in prompt.py
+    app.config['STRUCTURED_OUTPUT'] = _is_truthy(os.getenv('STRUCTURED_OUTPUT', 'true'))
+    # Models tried in turn, cheapest first. A later one is only called when the
+    # earlier result fails validation (see validation.py); set a single name to
+    # always use that model.
+    app.config['MODEL_CASCADE'] = [
+        name.strip()
+        for name in os.getenv('MODEL_CASCADE', f'{FAST_MODEL_NAME},{DEFAULT_MODEL_NAME}').split(',')
+        if name.strip()
+    ]
+    # Allowed difference between the stated and recomputed totals
+    app.config['CASCADE_TOLERANCE'] = float(os.getenv('CASCADE_TOLERANCE', '0.01'))
+    # Every model call goes through one shared client (see model_client.py).
+    # MODEL_RPM is the requests-per-minute quota, overall or per model; 0 is unlimited.
+    app.extensions['model_client'] = ModelClient(
+        rpm=parse_rpm(os.getenv('MODEL_RPM', 'gemini-2.5-flash:1000,gemini-2.5-pro:150')),
+        burst=int(os.getenv('MODEL_BURST', '10')),
+        max_concurrency=int(os.getenv('MODEL_MAX_CONCURRENCY', '16')),
+        max_retries=int(os.getenv('MODEL_MAX_RETRIES', '4')),
+        backoff=float(os.getenv('MODEL_RETRY_BACKOFF', '1.0')),
+        max_backoff=float(os.getenv('MODEL_RETRY_MAX_BACKOFF', '30')),
+        queue_timeout=float(os.getenv('MODEL_QUEUE_TIMEOUT', '60')),
+        retry_on=transient_model_errors,
+        # Cap on model calls in flight from the async routes (see asgi.py)
+        max_async_concurrency=int(os.getenv('MODEL_MAX_ASYNC_CONCURRENCY', '256')),
+    )
+    # Retry-After (seconds) sent with the 503 when the model stays unavailable
+    app.config['MODEL_RETRY_AFTER'] = int(os.getenv('MODEL_RETRY_AFTER', '30'))
+    # Passed to genai.configure before the first Gemini model is made
+    app.config['GOOGLE_API_KEY'] = os.getenv('GOOGLE_API_KEY')
+    # MODEL_BACKEND=fake runs extraction against a local canned model, no API key needed.
+    if os.getenv('MODEL_BACKEND', 'gemini').lower() == 'fake':
+        app.config['MODEL_FACTORY'] = FakeGenerativeModel
+    # Per-request stage timings and counters, served on /metrics (see metrics.py).
+    # REQUEST_LOG=false stops the JSON line written for every request and job.
+    app.extensions['metrics'] = Metrics()
+    app.config['REQUEST_LOG'] = _is_truthy(os.getenv('REQUEST_LOG', 'true'))
+    init_request_tracing(app)
+
+    with app.app_context():
+        instrument_engine(db.engine)
+    # Build the prompt once up front instead of on the first upload.
+    build_prompt()
+    app.register_blueprint(api)
+    if app.config['EXTRACTION_AUTOSTART']:
+        get_worker_pool(app)
     return app
 
-app = create_app()
-
-# Configure Gemini API
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-
-def extract_json_from_response(text):
-    """Extracts JSON object from a string."""
-    try:
-        # Find the start and end of the JSON block
-        json_start = text.find('```json')
-        if json_start == -1:
-            # Fallback for plain JSON without backticks
-            return json.loads(text)
-
-        json_start += len('```json')
-        json_end = text.find('```', json_start)
-        
-        # Extract and parse the JSON string
-        json_str = text[json_start:json_end].strip()
-        return json.loads(json_str)
-    except (json.JSONDecodeError, AttributeError, ValueError) as e:
-        print(f"Error decoding JSON: {e}")
-        return None
-
-@app.route("/")
+@api.route("/")
 def hello_world():
     return "Hello, from Flask backend!"
 
-@app.route("/test_db")
+@api.route("/test_db")
 def test_db():
     try:
         # Try to execute a simple query
@@ -73,7 +159,12 @@ def test_db():
     except Exception as e:
         return f"Database connection failed: {e}"
 
-@app.route('/api/upload', methods=['POST'])
+@api.route('/metrics')
+def metrics():
+    """Request, stage, token, cache and query metrics in the Prometheus text format."""
+    return Response(get_metrics().render(), mimetype='text/plain; version=0.0.4')
+
+@api.route('/api/upload', methods=['POST'])
 def upload_file():
     if 'file' not in request.files:
         return jsonify({'error': 'No file part'}), 400
@@ -81,251 +172,280 @@ def upload_file():
     if file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
 
+    if _is_truthy(request.args.get('async')):
+        pool = get_worker_pool(current_app._get_current_object())
+        job_id = pool.queue.enqueue(file.read(), secure_filename(file.filename))
+        return jsonify({
+            "status": "queued",
+            "job_id": job_id,
+            "status_url": f"/api/jobs/{job_id}",
+            "result_url": f"/api/jobs/{job_id}/result",
+        }), 202
+
     if file:
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        
         try:
-            img = Image.open(filepath)
-            model = genai.GenerativeModel('gemini-2.5-pro')
-            
-            prompt = f"""
-            You are an expert invoice data extractor. Your goal is to extract all possible information from the invoice image to provide a detailed, structured response.
-
-            First, extract the following information from the invoice:
-            - Customer's Full Name
-            - Billing Address (if different from shipping, otherwise use shipping)
-            - Shipping Address
-            - Invoice Number (map to SalesOrderNumber)
-            - Order Date
-            - Due Date
-            - Ship Date
-            - Account Number
-            - Subtotal
-            - Tax Amount (map to TaxAmt)
-            - Shipping & Handling cost (map to Freight)
-            - Total Due
-            - A list of all products, including their Product Code/Number, Quantity, and Unit Price.
-
-            Based on this, construct a single JSON object with keys: "SalesOrderHeader", "SalesOrderDetail", "CustomerName", "BillingAddress", "ShippingAddress".
-
-            - For "SalesOrderHeader" and "SalesOrderDetail", use the field names from the models below.
-            - Calculate `LineTotal` for each item in "SalesOrderDetail".
-            - For product details in "SalesOrderDetail", only include `ProductNumber`, `OrderQty`, `UnitPrice`, and `LineTotal`. The system will look up the rest.
-
-            Here are the database models for context:
-            {MODELS_SCHEMA}
-
-            Return ONLY the JSON object.
-            """
-            
-            response = model.generate_content([prompt, img])
-            img.close()
-            os.remove(filepath)
-
-            extracted_data = extract_json_from_response(response.text)
-            
-            if not extracted_data:
-                return jsonify({'error': 'Failed to extract data from document.'}), 500
-
-            # --- Process and Save to Database ---
-            header_data = extracted_data.get('SalesOrderHeader')
-            details_data = extracted_data.get('SalesOrderDetail')
-            customer_name_str = extracted_data.get('CustomerName')
-
-            if not header_data or not details_data:
-                return jsonify({'error': 'Extracted data is missing required sections.'}), 500
-            # -- I have put this here because I cannot create multiple invoices just to test so random assignment
-            if os.getenv('TESTING', 'false').lower() == 'true':
-                # Find the highest existing sales order number to generate a new one.
-                last_order_num_str = db.session.query(db.func.max(db.func.substr(models.SalesOrderHeader.SalesOrderNumber, 3))).filter(models.SalesOrderHeader.SalesOrderNumber.like('SO%')).scalar()
-                
-                last_known_max = 75123
-                last_order_num = 0
-                if last_order_num_str:
-                    try:
-                        last_order_num = int(last_order_num_str)
-                    except (ValueError, TypeError):
-                        pass # Keep it at 0 if conversion fails
-
-                # Use the greater of the DB max or the known last number from previous data
-                new_number = max(last_known_max, last_order_num) + 1
-                new_sales_order_number = f"SO{new_number}"
-                
-                print(f"TESTING MODE: Overriding SalesOrderNumber with {new_sales_order_number}")
-                header_data['SalesOrderNumber'] = new_sales_order_number
-
-            # Explicitly remove any SalesOrderID from LLM to ensure DB generates a new one.
-            header_data.pop('SalesOrderID', None)
-
-            # Check if an order with this SalesOrderNumber already exists
-            sales_order_number = header_data.get('SalesOrderNumber')
-            if sales_order_number:
-                existing_order = db.session.query(models.SalesOrderHeader).filter_by(SalesOrderNumber=sales_order_number).first()
-                if existing_order:
-                    return jsonify({'error': f"An order with SalesOrderNumber '{sales_order_number}' already exists."}), 409 # HTTP 409 Conflict
-
-            # Find customer
-            if customer_name_str:
-                parts = customer_name_str.split()
-                first_name, last_name = (parts[0], parts[-1]) if len(parts) > 1 else (parts[0], "")
-                customer_info = db.session.query(models.IndividualCustomer).filter_by(FirstName=first_name, LastName=last_name).first()
-                if customer_info:
-                    customer_record = db.session.query(models.Customer).filter_by(PersonID=customer_info.BusinessEntityID).first()
-                    if customer_record:
-                        header_data['CustomerID'] = customer_record.CustomerID
-
-            # Convert date strings
-            for field in ['OrderDate', 'DueDate', 'ShipDate']:
-                if header_data.get(field) and isinstance(header_data[field], str):
-                    try:
-                        header_data[field] = datetime.strptime(header_data[field], '%Y-%m-%d')
-                    except ValueError:
-                        header_data[field] = None
-            
-            new_header = models.SalesOrderHeader(**header_data)
-            db.session.add(new_header)
-            db.session.flush() # This is sufficient to get the ID on new_header
-
-            # Update the original header dict with the new ID for the response
-            header_data['SalesOrderID'] = new_header.SalesOrderID
-
-            hydrated_details = []
-            for detail_data in details_data:
-                product = db.session.query(models.Product).filter_by(ProductNumber=detail_data.get('ProductNumber')).first()
-                if product:
-                    model_init_data = detail_data.copy()
-                    model_init_data.pop('ProductNumber', None)
-                    model_init_data['ProductID'] = product.ProductID
-                    model_init_data['SalesOrderID'] = new_header.SalesOrderID
-                    
-                    new_detail = models.SalesOrderDetail(**model_init_data)
-                    db.session.add(new_detail)
-                    db.session.flush()
-
-                    detail_data['SalesOrderDetailID'] = new_detail.SalesOrderDetailID
-                    detail_data['SalesOrderID'] = new_header.SalesOrderID
-                    detail_data['Name'] = product.Name
-                    detail_data['Color'] = product.Color
-                    detail_data['Size'] = product.Size
-                    detail_data['ListPrice'] = product.ListPrice
-                    hydrated_details.append(detail_data)
-
-            db.session.commit()
-            
-            # --- Construct Detailed Response for Frontend ---
-            final_response = {
-                "SalesOrderHeader": header_data,
-                "CustomerInfo": extracted_data.get('CustomerName'),
-                "BillingAddress": extracted_data.get('BillingAddress'),
-                "ShippingAddress": extracted_data.get('ShippingAddress'),
-                "SalesOrderDetail": hydrated_details,
-            }
+            # The upload is processed in memory; nothing is written to disk.
+            with span('read_upload'):
+                data = file.read()
+            report = {}
+            extracted_data = extract_document(
+                data,
+                cache=get_extraction_cache(),
+                preprocessor=get_preprocessor(),
+                splitter=get_page_splitter(),
+                report=report,
+            )
+
+            with span('save'):
+                final_response = save_extracted_data(extracted_data)
 
             return jsonify({
                 "status": "success", 
                 "message": "Data saved to database.", 
-                "data": final_response
+                "data": final_response,
+                "preprocessing": report.get('preprocessing'),
+                "tokens": report.get('tokens'),
+                "model": report.get('model'),
             })
 
+        except ExtractionError as e:
+            db.session.rollback()
+            return jsonify({'error': e.message}), e.status_code
+        except transient_model_errors() as e:
+            # Still failing after the model client's retries; the client can try again later.
+            db.session.rollback()
+            return jsonify({'error': f'The model is busy, please try again shortly: {str(e)}'}), 503, {
+                'Retry-After': str(current_app.config['MODEL_RETRY_AFTER']),
+            }
         except Exception as e:
             db.session.rollback()
-            if 'img' in locals() and img:
-                img.close()
-            if os.path.exists(filepath):
-                os.remove(filepath)
+            log_exception(e)
             return jsonify({'error': f'An error occurred: {str(e)}'}), 500
         finally:
             db.session.remove()
 
     return jsonify({'error': 'File processing failed'}), 500
 
-@app.route('/api/sales_order/<int:order_id>', methods=['PUT'])
+@api.route('/api/upload/stream', methods=['POST'])
+def upload_file_stream():
+    """Like /api/upload, but reports progress as Server-Sent Events.
+
+    Events, in order: received, preprocessed, tokens (one per streamed chunk),
+    header, detail (one per line), hydrated (one per stored line) and
+    committed, whose data matches the /api/upload response. Any failure ends
+    the stream with an error event instead. If the first model's result fails
+    validation, an escalated event says so and the tokens, header and detail
+    events start over with the next model's response.
+    """
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file part'}), 400
+    file = request.files['file']
+    if file.filename == '':
+        return jsonify({'error': 'No selected file'}), 400
+
+    events = stream_upload(
+        current_app._get_current_object(), file.read(), secure_filename(file.filename),
+        current_app.config['STREAM_HEARTBEAT'],
+    )
+    return Response(events, mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # Stop nginx-style proxies from buffering the stream.
+        'X-Accel-Buffering': 'no',
+    })
+
+@api.route('/api/upload/batch', methods=['POST'])
+def upload_batch():
+    """Extracts many invoices at once, from several files and/or ZIP archives."""
+    files = request.files.getlist('files') + request.files.getlist('file')
+    if not files:
+        return jsonify({'error': 'No file part'}), 400
+
+    try:
+        documents = collect_documents(files, current_app.config['BATCH_MAX_FILES'], current_app.config['BATCH_MAX_BYTES'])
+    except BatchError as e:
+        return jsonify({'error': str(e)}), 400
+    if not documents:
+        return jsonify({'error': 'No selected file'}), 400
+
+    try:
+        results = process_batch(
+            documents,
+            parallelism=current_app.config['BATCH_PARALLELISM'],
+            commit_size=current_app.config['BATCH_COMMIT_SIZE'],
+        )
+    except Exception as e:
+        db.session.rollback()
+        log_exception(e)
+        return jsonify({'error': f'An error occurred: {str(e)}'}), 500
+    finally:
+        db.session.remove()
+
+    succeeded = sum(1 for result in results if result['status'] == 'success')
+    return jsonify({
+        "status": "success" if succeeded == len(results) else "partial" if succeeded else "error",
+        "message": f"{succeeded} of {len(results)} documents saved to database.",
+        "results": results,
+    }), 200 if succeeded else 500
+
+@api.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    cache = get_extraction_cache()
+    if cache is None:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, **cache.stats()})
+
+def _match_limit():
+    try:
+        return max(1, min(int(request.args.get('limit', 5)), 50))
+    except ValueError:
+        return 5
+
+@api.route('/api/match/products', methods=['GET'])
+def match_products():
+    """Ranks products against a (possibly misread) ProductNumber or name."""
+    query = request.args.get('q', '')
+    if not query:
+        return jsonify({'error': "Missing query parameter 'q'."}), 400
+    matches = get_lookup_index().matcher().match_products(query, limit=_match_limit())
+    return jsonify([
+        {
+            'ProductID': product.ProductID,
+            'ProductNumber': product.ProductNumber,
+            'Name': product.Name,
+            'score': round(score, 3),
+        }
+        for product, score in matches
+    ])
+
+@api.route('/api/match/customers', methods=['GET'])
+def match_customers():
+    """Ranks individual and store customers by name, and optionally address."""
+    query = request.args.get('q', '')
+    if not query:
+        return jsonify({'error': "Missing query parameter 'q'."}), 400
+    matches = get_lookup_index().matcher().match_customers(
+        query, request.args.get('address'), limit=_match_limit()
+    )
+    return jsonify([{**candidate, 'score': round(score, 3)} for candidate, score in matches])
+
+@api.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = get_worker_pool(current_app._get_current_object()).queue.get(job_id)
+    if not job:
+        return jsonify({'error': f'Job {job_id} not found.'}), 404
+    return jsonify(job_status(job))
+
+@api.route('/api/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    """Returns the extraction result, long-polling for up to `wait` seconds."""
+    queue = get_worker_pool(current_app._get_current_object()).queue
+    try:
+        wait = min(float(request.args.get('wait', 0)), 60.0)
+    except ValueError:
+        return jsonify({'error': "'wait' must be a number of seconds."}), 400
+
+    job = queue.wait(job_id, wait) if wait > 0 else queue.get(job_id)
+    if not job:
+        return jsonify({'error': f'Job {job_id} not found.'}), 404
+    if job['status'] not in ('done', 'failed'):
+        return jsonify(job_status(job)), 202
+    body, status_code = job_result(job)
+    return jsonify(body), status_code
+
+def database_busy(error):
+    """The 503 for a read that timed out waiting on the database, e.g. SQLite's "database is locked"."""
+    log('database_busy', level='warning', error=str(error.orig))
+    return jsonify({'error': 'The database is busy, please try again shortly.'}), 503, {
+        'Retry-After': str(current_app.config['DATABASE_RETRY_AFTER']),
+    }
+
+@api.route('/api/sales_orders', methods=['GET'])
+def list_sales_orders():
+    """Lists and filters sales orders with cursor pagination (see orders.py)."""
+    try:
+        orders, next_cursor = list_orders(request.args)
+    except OrderQueryError as e:
+        return jsonify({'error': str(e)}), 400
+    except OperationalError as e:
+        return database_busy(e)
+    finally:
+        db.session.remove()
+    return jsonify({'orders': orders, 'next_cursor': next_cursor})
+
+@api.route('/api/analytics/sales', methods=['GET'])
+def analytics_sales():
+    """Revenue and quantity by day or month, territory and product category (see analytics.py)."""
+    try:
+        summary = sales_summary(request.args)
+    except AnalyticsQueryError as e:
+        return jsonify({'error': str(e)}), 400
+    except OperationalError as e:
+        return database_busy(e)
+    finally:
+        db.session.remove()
+    return jsonify(summary)
+
+@api.route('/api/analytics/top_customers', methods=['GET'])
+def analytics_top_customers():
+    """The customers with the most revenue (see analytics.py)."""
+    try:
+        customers = top_customers(request.args)
+    except AnalyticsQueryError as e:
+        return jsonify({'error': str(e)}), 400
+    except OperationalError as e:
+        return database_busy(e)
+    finally:
+        db.session.remove()
+    return jsonify(customers)
+
+@api.route('/api/sales_order/<int:order_id>', methods=['GET'])
+def get_sales_order(order_id):
+    try:
+        order = get_order(order_id)
+    except OperationalError as e:
+        return database_busy(e)
+    finally:
+        db.session.remove()
+    if not order:
+        return jsonify({'error': f'SalesOrder with ID {order_id} not found.'}), 404
+    return jsonify(order)
+
+@api.route('/api/sales_order/<int:order_id>', methods=['PUT', 'PATCH'])
 def update_sales_order(order_id):
-    from . import models
+    """Applies an edit as a diff against the stored order (see orders.update_order)."""
     data = request.get_json()
     if not data:
         return jsonify({'error': 'Invalid data'}), 400
 
-    header_data = data.get('SalesOrderHeader')
-    details_data = data.get('SalesOrderDetail')
-
     try:
-        header = db.session.get(models.SalesOrderHeader, order_id)
-        if not header:
-            return jsonify({'error': f'SalesOrder with ID {order_id} not found.'}), 404
-
-        # Update Header
-        for key, value in header_data.items():
-            if hasattr(header, key):
-                if key in ['OrderDate', 'DueDate', 'ShipDate']:
-                    if isinstance(value, str):
-                        try:
-                            parsed_date = datetime.strptime(value, '%a, %d %b %Y %H:%M:%S %Z')
-                            setattr(header, key, parsed_date)
-                        except (ValueError, TypeError):
-                            # If that fails, try a standard ISO format (YYYY-MM-DD)
-                            try:
-                                parsed_date = datetime.strptime(value.split('T')[0], '%Y-%m-%d')
-                                setattr(header, key, parsed_date)
-                            except (ValueError, TypeError):
-                                if key == 'OrderDate': # OrderDate is not nullable
-                                    return jsonify({'error': f"Invalid date format for '{key}'. Please use YYYY-MM-DD."}), 400
-                                setattr(header, key, None)
-                    else:
-                        setattr(header, key, value)
-                else:
-                    setattr(header, key, value)
-
-        # Replace Details
-        db.session.query(models.SalesOrderDetail).filter_by(SalesOrderID=order_id).delete()
-        for detail in details_data:
-            product_number = detail.get('ProductNumber')
-
-            detail.pop('Name', None)
-            detail.pop('Color', None)
-            detail.pop('Size', None)
-            detail.pop('ListPrice', None)
-            detail.pop('ProductNumber', None)
-
-            # Re-fetch the ProductID using the ProductNumber, as it's not submitted directly
-            if product_number:
-                product = db.session.query(models.Product).filter_by(ProductNumber=product_number).first()
-                if product:
-                    detail['ProductID'] = product.ProductID
-                else:
-                    # If we can't find the product, we can't create the detail record.
-                    continue
-            else:
-                continue
-
-            new_detail = models.SalesOrderDetail(**detail)
-            db.session.add(new_detail)
-
-        db.session.commit()
-        return jsonify({"status": "success", "message": f"Order {order_id} updated."})
+        order = update_order(order_id, data)
+        with span('commit'):
+            db.session.commit()
+        return jsonify({"status": "success", "message": f"Order {order_id} updated.", "data": order})
+    except OrderUpdateError as e:
+        db.session.rollback()
+        return jsonify({'error': e.message}), e.status_code
     except Exception as e:
         db.session.rollback()
+        log_exception(e)
         return jsonify({'error': f'An error occurred: {str(e)}'}), 500
     finally:
         db.session.close()
 
 
-@app.route('/api/sales_order/<int:order_id>', methods=['DELETE'])
+@api.route('/api/sales_order/<int:order_id>', methods=['DELETE'])
 def delete_sales_order(order_id):
-    from . import models
     try:
-        # First delete the details, then the header
-        db.session.query(models.SalesOrderDetail).filter_by(SalesOrderID=order_id).delete()
-        db.session.query(models.SalesOrderHeader).filter_by(SalesOrderID=order_id).delete()
-        db.session.commit()
+        delete_order(order_id)
+        with span('commit'):
+            db.session.commit()
         return jsonify({"status": "success", "message": f"Order {order_id} deleted."})
     except Exception as e:
         db.session.rollback()
+        log_exception(e)
         return jsonify({'error': f'An error occurred: {str(e)}'}), 500
     finally:
         db.session.close()
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app().run(debug=True)
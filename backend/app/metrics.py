@@ -0,0 +1,302 @@
+import contextvars
+import json
+import re
+import threading
+import time
+import traceback
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from flask import current_app, g, request
+from sqlalchemy import event
+
+METRIC_PREFIX = 'invoice_'
+
+# Upper bounds (seconds) of the duration histogram buckets, from a fast
+# lookup up to a slow multi-page model call.
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+METRIC_HELP = {
+    'http_request_duration_seconds': ('histogram', 'Time from receiving a request to finishing its response.'),
+    'stage_duration_seconds': ('histogram', 'Time spent in each stage of the upload, update and delete pipelines.'),
+    'model_calls_total': ('counter', 'Model generate_content calls.'),
+    'model_input_tokens_total': ('counter', 'Prompt tokens sent to the model.'),
+    'model_output_tokens_total': ('counter', 'Tokens generated by the model.'),
+    'model_retries_total': ('counter', 'Jobs retried after a transient model error.'),
+    'model_call_retries_total': ('counter', 'Model calls retried by the model client after a transient error.'),
+    'coalesced_total': ('counter', 'Uploads that waited for an identical extraction already in progress.'),
+    'extractions_total': ('counter', 'Documents extracted, by the model whose result was used.'),
+    'escalations_total': ('counter', 'Extractions passed on to the next model after failing validation.'),
+    'cache_hits_total': ('counter', 'Extraction cache hits.'),
+    'cache_misses_total': ('counter', 'Extraction cache misses.'),
+    'db_queries_total': ('counter', 'SQL statements executed.'),
+    'errors_total': ('counter', 'Requests and jobs that failed with an unexpected error.'),
+}
+
+# Incoming X-Request-ID headers are reused only if they look like an ID.
+_REQUEST_ID = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+_current_trace = contextvars.ContextVar('trace', default=None)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=()):
+    pairs = [*labels, *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """Process-wide counters and histograms, rendered in the Prometheus text format."""
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def render(self):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, {**h, 'buckets': list(h['buckets'])}) for key, h in self._histograms.items())
+
+        lines = []
+        described = set()
+
+        def describe(name):
+            if name in described:
+                return
+            described.add(name)
+            kind, help_text = METRIC_HELP.get(name, ('untyped', name))
+            lines.append(f'# HELP {METRIC_PREFIX}{name} {help_text}')
+            lines.append(f'# TYPE {METRIC_PREFIX}{name} {kind}')
+
+        for (name, labels), value in counters:
+            describe(name)
+            lines.append(f'{METRIC_PREFIX}{name}{_format_labels(labels)} {_format_value(value)}')
+        for (name, labels), histogram in histograms:
+            describe(name)
+            for bound, count in zip((*self.buckets, float('inf')), (*histogram['buckets'], histogram['count'])):
+                lines.append(f"{METRIC_PREFIX}{name}_bucket{_format_labels(labels, [('le', _format_value(bound))])} {count}")
+            lines.append(f"{METRIC_PREFIX}{name}_sum{_format_labels(labels)} {_format_value(round(histogram['sum'], 6))}")
+            lines.append(f"{METRIC_PREFIX}{name}_count{_format_labels(labels)} {histogram['count']}")
+        return '\n'.join(lines) + '\n'
+
+
+class Trace:
+    """Timings and counters for one request or background job, tied together by its ID."""
+
+    def __init__(self, request_id, metrics):
+        self.request_id = request_id
+        self.metrics = metrics
+        self.started = time.perf_counter()
+        self.spans = []
+        self.counters = {}
+        self.tags = {}
+        self._lock = threading.Lock()
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def add_span(self, stage, start, seconds):
+        self.metrics.observe('stage_duration_seconds', seconds, stage=stage)
+        with self._lock:
+            self.spans.append({
+                'stage': stage,
+                'start_ms': round((start - self.started) * 1000, 2),
+                'ms': round(seconds * 1000, 2),
+            })
+
+    def add(self, name, value=1, **labels):
+        self.metrics.inc(f'{name}_total', value, **labels)
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def tag(self, **fields):
+        with self._lock:
+            self.tags.update(fields)
+
+    def summary(self):
+        with self._lock:
+            return {**self.tags, 'spans': list(self.spans), 'counters': dict(self.counters)}
+
+
+def get_metrics(app=None):
+    """Returns the app's metrics registry."""
+    app = app or current_app
+    return app.extensions['metrics']
+
+
+def current_trace():
+    """The trace of the request or job running on this thread, or None."""
+    return _current_trace.get()
+
+
+@contextmanager
+def use_trace(trace):
+    """Makes `trace` the current one for the duration of the block."""
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+def start_trace(metrics, request_id=None):
+    return Trace(request_id or uuid.uuid4().hex, metrics)
+
+
+def bind_trace(fn):
+    """Wraps `fn` to run under the current trace, for handing work to other threads.
+
+    Threads don't inherit context variables, so without this spans and
+    counters recorded on a worker thread would belong to no request.
+    """
+    trace = current_trace()
+    if trace is None:
+        return fn
+
+    def run(*args, **kwargs):
+        with use_trace(trace):
+            return fn(*args, **kwargs)
+    return run
+
+
+@contextmanager
+def span(stage):
+    """Times the block as pipeline stage `stage` of the current trace.
+
+    Outside a request or job this is a no-op. Spans may nest, e.g. 'commit'
+    inside 'save'; each is recorded on its own.
+    """
+    trace = current_trace()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_span(stage, start, time.perf_counter() - start)
+
+
+def count(name, value=1, **labels):
+    """Adds `value` to counter `name` on the current trace and the process totals.
+
+    `labels` only split up the process totals on /metrics; the trace keeps
+    one number per name.
+    """
+    trace = current_trace()
+    if trace is not None and value:
+        trace.add(name, value, **labels)
+
+
+def tag(**fields):
+    """Attaches `fields` to the current trace's log line."""
+    trace = current_trace()
+    if trace is not None:
+        trace.tag(**fields)
+
+
+def log(event_name, level='info', **fields):
+    """Writes one JSON log line, tagged with the current request ID."""
+    trace = current_trace()
+    record = {
+        'time': datetime.now(timezone.utc).isoformat(timespec='milliseconds'),
+        'level': level,
+        'event': event_name,
+        'request_id': trace.request_id if trace else None,
+        **fields,
+    }
+    print(json.dumps(record, default=str), flush=True)
+
+
+def log_exception(error, **fields):
+    """Logs an unexpected error with its traceback and counts it."""
+    count('errors')
+    log('error', level='error', error=str(error), error_type=type(error).__name__,
+        traceback=traceback.format_exc(), **fields)
+
+
+def instrument_engine(engine):
+    """Counts every SQL statement `engine` runs against the current trace."""
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _on_execute(conn, cursor, statement, parameters, context, executemany):
+        count('db_queries')
+
+
+def start_request_trace(app, request_id):
+    """Starts the trace for a request, keeping the client's X-Request-ID if it is usable."""
+    request_id = request_id or ''
+    return start_trace(get_metrics(app), request_id if _REQUEST_ID.match(request_id) else None)
+
+
+def finish_request(app, trace, method, endpoint, path, status):
+    """Observes the request's duration and writes its JSON log line."""
+    seconds = trace.elapsed()
+    trace.metrics.observe('http_request_duration_seconds', seconds,
+                          method=method, endpoint=endpoint, status=str(status))
+    if app.config.get('REQUEST_LOG') and endpoint != '/metrics':
+        with use_trace(trace):
+            log('request', level='error' if status >= 500 else 'info', method=method, path=path,
+                status=status, ms=round(seconds * 1000, 2), **trace.summary())
+
+
+def init_request_tracing(app):
+    """Gives every request a trace and request ID, and logs it as JSON when it finishes.
+
+    The ID comes from the X-Request-ID header if the client sent a usable
+    one and is echoed back in the response. The log line is written when
+    the response is closed, so a streamed response is logged once the
+    stream ends, with everything recorded on its worker thread.
+    """
+
+    @app.before_request
+    def _start_trace():
+        trace = start_request_trace(app, request.headers.get('X-Request-ID'))
+        g.trace_token = _current_trace.set(trace)
+
+    @app.after_request
+    def _finish_trace(response):
+        trace = current_trace()
+        if trace is None:
+            return response
+        response.headers['X-Request-ID'] = trace.request_id
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        method, path, status = request.method, request.path, response.status_code
+        response.call_on_close(lambda: finish_request(app, trace, method, endpoint, path, status))
+        return response
+
+    @app.teardown_request
+    def _end_trace(error=None):
+        token = g.pop('trace_token', None)
+        if token is not None:
+            _current_trace.reset(token)
@@ -0,0 +1,283 @@
+import asyncio
+import copy
+import json
+import random
+import threading
+import time
+from concurrent.futures import Future
+from flask import current_app
+from .metrics import count, log, span
+
+
+class ModelBusyError(Exception):
+    """Raised when a model call can't get a rate limit token or a call slot in time."""
+
+
+def parse_rpm(value):
+    """Parses a requests-per-minute quota: '150', or per model as 'gemini-2.5-flash:1000,gemini-2.5-pro:150'.
+
+    Returns {model name: rpm}, with the '*' entry applying to models not
+    listed. 0 means unlimited.
+    """
+    quotas = {}
+    for part in (value or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        name, _, rpm = part.rpartition(':')
+        quotas[name.strip() or '*'] = float(rpm)
+    return quotas
+
+
+class TokenBucket:
+    """Allows `rate` calls per second on average, and bursts of up to `capacity`.
+
+    Callers reserve a token up front and sleep until it is theirs, so
+    waiting callers are served in the order they arrived.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, timeout=None):
+        """Takes a token and returns the seconds until it may be used, or None if that is over `timeout`."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            wait = max(0.0, (1 - self._tokens) / self.rate)
+            if timeout is not None and wait > timeout:
+                return None
+            self._tokens -= 1
+            return wait
+
+    def acquire(self, timeout=None):
+        """Takes a token, waiting up to `timeout` seconds; returns False if that isn't long enough."""
+        wait = self.reserve(timeout)
+        if wait is None:
+            return False
+        if wait:
+            time.sleep(wait)
+        return True
+
+
+class LimitedModel:
+    """Wraps a model so every `generate_content` call goes through its `ModelClient`."""
+
+    def __init__(self, client, model):
+        self.client = client
+        self.model = model
+        self.model_name = getattr(model, 'model_name', None)
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        if stream:
+            return self.client.stream(self, contents, **kwargs)
+        return self.client.call(self, contents, **kwargs)
+
+    async def generate_content_async(self, contents, **kwargs):
+        return await self.client.call_async(self, contents, **kwargs)
+
+
+class ModelClient:
+    """The one place model calls go through, shared by every request and worker.
+
+    Each call takes a token from its model's `TokenBucket` (sized from
+    `rpm`, requests per minute per model, see `parse_rpm`) and one of
+    `max_concurrency` call slots, giving up with `ModelBusyError` after
+    `queue_timeout` seconds. Errors in `retry_on` (a tuple of exception
+    types, or a function returning one, so the SDK that defines them can be
+    imported on the first failure rather than up front) are retried up to
+    `max_retries` times, sleeping a random time of up to
+    backoff * 2^attempt seconds (capped at `max_backoff`) so that clients
+    throttled together don't retry together.
+
+    Calls made from asyncio (`call_async`) share the same token buckets but
+    wait without blocking the event loop, and are capped by their own
+    `max_async_concurrency`, since an in-flight coroutine costs far less
+    than a thread.
+
+    Model objects are built once per name and reused. `coalesce` lets
+    identical work that is already in flight be shared instead of repeated.
+    """
+
+    def __init__(self, rpm=None, burst=10, max_concurrency=16, max_retries=4, backoff=1.0, max_backoff=30.0,
+                 queue_timeout=60.0, retry_on=(), max_async_concurrency=256):
+        self.rpm = rpm or {}
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.queue_timeout = queue_timeout
+        self.retry_on = retry_on
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self.max_async_concurrency = max_async_concurrency
+        self._async_slots = None
+        self._lock = threading.Lock()
+        self._models = {}
+        self._buckets = {}
+        self._in_flight = {}
+
+    def model(self, model_name, factory, **kwargs):
+        """Returns the shared, rate-limited model for `model_name`, building it on first use."""
+        key = (model_name, factory, json.dumps(kwargs, sort_keys=True, default=str))
+        with self._lock:
+            model = self._models.get(key)
+            if model is None:
+                model = self._models[key] = LimitedModel(self, factory(model_name, **kwargs))
+            return model
+
+    def _bucket(self, model_name):
+        rpm = self.rpm.get(model_name, self.rpm.get('*', 0))
+        if not rpm:
+            return None
+        with self._lock:
+            bucket = self._buckets.get(model_name)
+            if bucket is None:
+                bucket = self._buckets[model_name] = TokenBucket(rpm / 60.0, min(self.burst, max(1, int(rpm))))
+            return bucket
+
+    def _acquire(self, model_name):
+        start = time.monotonic()
+        with span('model_queue'):
+            bucket = self._bucket(model_name)
+            if bucket is not None and not bucket.acquire(self.queue_timeout):
+                raise ModelBusyError(f'Rate limit for {model_name} reached; try again shortly.')
+            remaining = max(0.0, self.queue_timeout - (time.monotonic() - start))
+            if not self._slots.acquire(timeout=remaining):
+                raise ModelBusyError('Too many model calls in progress; try again shortly.')
+
+    async def _acquire_async(self, model_name):
+        start = time.monotonic()
+        with span('model_queue'):
+            bucket = self._bucket(model_name)
+            wait = None if bucket is None else bucket.reserve(self.queue_timeout)
+            if bucket is not None and wait is None:
+                raise ModelBusyError(f'Rate limit for {model_name} reached; try again shortly.')
+            if wait:
+                await asyncio.sleep(wait)
+            if self._async_slots is None:
+                # Created here rather than in __init__ so it belongs to the running event loop.
+                self._async_slots = asyncio.Semaphore(self.max_async_concurrency)
+            remaining = max(0.0, self.queue_timeout - (time.monotonic() - start))
+            try:
+                await asyncio.wait_for(self._async_slots.acquire(), remaining)
+            except asyncio.TimeoutError:
+                raise ModelBusyError('Too many model calls in progress; try again shortly.') from None
+
+    def _retryable(self):
+        return tuple(self.retry_on() if callable(self.retry_on) else self.retry_on)
+
+    def _retry_delay(self, limited, attempt, error):
+        """How long to wait before retrying a failed call; logs the retry."""
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        log('model_retry', level='warning', model=limited.model_name, attempt=attempt + 1,
+            delay=round(delay, 2), error=str(error))
+        return delay
+
+    def call(self, limited, contents, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            self._acquire(limited.model_name)
+            try:
+                return limited.model.generate_content(contents, **kwargs)
+            except self._retryable() as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self._retry_delay(limited, attempt, e)
+            finally:
+                self._slots.release()
+            count('model_call_retries')
+            time.sleep(delay)
+
+    async def call_async(self, limited, contents, **kwargs):
+        """Like `call`, for the model's `generate_content_async`."""
+        for attempt in range(self.max_retries + 1):
+            await self._acquire_async(limited.model_name)
+            try:
+                return await limited.model.generate_content_async(contents, **kwargs)
+            except self._retryable() as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self._retry_delay(limited, attempt, e)
+            finally:
+                self._async_slots.release()
+            count('model_call_retries')
+            await asyncio.sleep(delay)
+
+    def stream(self, limited, contents, **kwargs):
+        """Like `call` with stream=True. Only a failure before the first chunk is retried."""
+        for attempt in range(self.max_retries + 1):
+            self._acquire(limited.model_name)
+            started = False
+            try:
+                for chunk in limited.model.generate_content(contents, stream=True, **kwargs):
+                    started = True
+                    yield chunk
+                return
+            except self._retryable() as e:
+                if started or attempt == self.max_retries:
+                    raise
+                delay = self._retry_delay(limited, attempt, e)
+            finally:
+                self._slots.release()
+            count('model_call_retries')
+            time.sleep(delay)
+
+    def coalesce(self, key, fn):
+        """Runs fn(), unless a call with the same `key` is already running, and then waits for that.
+
+        Returns (result, shared). Callers that joined an earlier call get
+        their own deep copy of its result, taken when it finished, and see
+        its exception if it failed.
+        """
+        call, leader = self._join(key)
+        if not leader:
+            count('coalesced')
+            with span('coalesced_wait'):
+                return copy.deepcopy(call.result()), True
+        try:
+            result = fn()
+            call.set_result(copy.deepcopy(result))
+            return result, False
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    async def coalesce_async(self, key, fn):
+        """Like `coalesce` for a coroutine function. Sync and async callers coalesce with each other."""
+        call, leader = self._join(key)
+        if not leader:
+            count('coalesced')
+            with span('coalesced_wait'):
+                return copy.deepcopy(await asyncio.wrap_future(call)), True
+        try:
+            result = await fn()
+            call.set_result(copy.deepcopy(result))
+            return result, False
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def _join(self, key):
+        """Returns the in-flight call for `key`, and whether this caller started it."""
+        with self._lock:
+            call = self._in_flight.get(key)
+            if call is not None:
+                return call, False
+            call = self._in_flight[key] = Future()
+            return call, True
+
+
+def get_model_client(app=None):
+    """Returns the app's shared model client."""
+    app = app or current_app
+    return app.extensions['model_client']
@@ -1,5 +1,5 @@
 from sqlalchemy import (
-    Boolean, Column, DateTime, Float, ForeignKey, Integer, String
+    Boolean, Column, DateTime, Float, ForeignKey, Index, Integer, String, func
 )
 from sqlalchemy.orm import relationship
 from .database import db
@@ -30,11 +30,16 @@ class SalesOrderHeader(db.Model):
     Freight = Column(Float, nullable=False)
     TotalDue = Column(Float, nullable=False)
     details = relationship("SalesOrderDetail", backref="header")
+    __table_args__ = (
+        # Order listings page through (OrderDate, SalesOrderID), optionally per customer.
+        Index('ix_SalesOrderHeader_OrderDate', 'OrderDate', 'SalesOrderID'),
+        Index('ix_SalesOrderHeader_CustomerID', 'CustomerID', 'OrderDate', 'SalesOrderID'),
+    )
 
 class SalesOrderDetail(db.Model):
     __tablename__ = 'SalesOrderDetail'
     SalesOrderDetailID = Column(Integer, primary_key=True)
-    SalesOrderID = Column(Integer, ForeignKey('SalesOrderHeader.SalesOrderID'), nullable=False)
+    SalesOrderID = Column(Integer, ForeignKey('SalesOrderHeader.SalesOrderID'), nullable=False, index=True)
     CarrierTrackingNumber = Column(String, nullable=True)
     OrderQty = Column(Integer, nullable=False)
     ProductID = Column(Integer, ForeignKey('Product.ProductID'), nullable=False)
@@ -83,6 +88,10 @@ class IndividualCustomer(db.Model):
     StateProvinceName = Column(String, nullable=True)
     PostalCode = Column(String, nullable=True)
     CountryRegionName = Column(String, nullable=True)
+    __table_args__ = (
+        # Case-insensitive customer name searches.
+        Index('ix_IndividualCustomers_Name', func.lower(LastName), func.lower(FirstName)),
+    )
 
 class ProductCategory(db.Model):
     __tablename__ = 'ProductCategory'
@@ -115,4 +124,26 @@ class StoreCustomers(db.Model):
     City = Column(String, nullable=True)
     StateProvinceName = Column(String, nullable=True)
     PostalCode = Column(String, nullable=True)
-    CountryRegionName = Column(String, nullable=True)
\ No newline at end of file
+    CountryRegionName = Column(String, nullable=True)
+# Precomputed totals for the analytics endpoints, kept up to date as orders
+# are saved, edited and deleted (see analytics.py).
+class SalesRollup(db.Model):
+    __tablename__ = 'SalesRollup'
+    Grain = Column(String, primary_key=True)
+    Period = Column(String, primary_key=True)
+    TerritoryID = Column(Integer, primary_key=True)
+    ProductCategoryID = Column(Integer, primary_key=True)
+    Revenue = Column(Float, nullable=False, default=0.0)
+    Quantity = Column(Integer, nullable=False, default=0)
+    Lines = Column(Integer, nullable=False, default=0)
+
+class CustomerRollup(db.Model):
+    __tablename__ = 'CustomerRollup'
+    CustomerID = Column(Integer, primary_key=True)
+    Revenue = Column(Float, nullable=False, default=0.0)
+    Orders = Column(Integer, nullable=False, default=0)
+    Quantity = Column(Integer, nullable=False, default=0)
+    __table_args__ = (
+        # Top customers are read highest revenue first.
+        Index('ix_CustomerRollup_Revenue', 'Revenue'),
+    )
@@ -0,0 +1,369 @@
+import base64
+import json
+from datetime import datetime, timedelta
+from sqlalchemy import Boolean, DateTime, Float, Integer, delete, func, select, tuple_, update
+from sqlalchemy.orm import joinedload
+from .database import begin_write, db
+from . import models
+from .analytics import update_rollups
+from .extraction import DETAIL_COLUMNS, insert_details
+from .lookup import get_lookup_index
+from .metrics import log, span
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+# Header columns the server maintains; values sent by the client are ignored.
+SERVER_HEADER_FIELDS = {'SalesOrderID', 'RevisionNumber', 'SubTotal', 'TotalDue'}
+
+# Detail columns a client may edit directly. ProductID comes from the
+# ProductNumber, and LineTotal is always recomputed.
+EDITABLE_DETAIL_FIELDS = DETAIL_COLUMNS - {'SalesOrderID', 'ProductID', 'LineTotal'}
+
+
+class OrderQueryError(Exception):
+    """Raised for list/search parameters that can't be understood."""
+
+
+class OrderUpdateError(Exception):
+    """An update failure that maps directly onto an HTTP error response."""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+def encode_cursor(order):
+    """An opaque token for the position just after `order` in the listing."""
+    position = [order.OrderDate.isoformat(), order.SalesOrderID]
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_cursor(token):
+    try:
+        order_date, order_id = json.loads(base64.urlsafe_b64decode(token.encode()))
+        return datetime.fromisoformat(order_date), int(order_id)
+    except (ValueError, TypeError):
+        raise OrderQueryError('Invalid cursor.')
+
+
+def _date(args, name):
+    value = args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise OrderQueryError(f"'{name}' must be a date in YYYY-MM-DD format.")
+
+
+def _number(args, name, kind=float):
+    value = args.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        return kind(value)
+    except ValueError:
+        raise OrderQueryError(f"'{name}' must be a number.")
+
+
+def _customers_named(name):
+    """CustomerIDs of individual customers whose name matches `name`.
+
+    One word matches the last name; more than one matches the first and last
+    words against the first and last names. Case is ignored.
+    """
+    parts = name.lower().split()
+    condition = func.lower(models.IndividualCustomer.LastName) == parts[-1]
+    if len(parts) > 1:
+        condition &= func.lower(models.IndividualCustomer.FirstName) == parts[0]
+    return (
+        select(models.Customer.CustomerID)
+        .join(models.IndividualCustomer, models.Customer.PersonID == models.IndividualCustomer.BusinessEntityID)
+        .where(condition)
+    )
+
+
+def list_orders(args):
+    """Lists sales orders, newest first, one page at a time.
+
+    `args` holds the request's query parameters: `date_from` and `date_to`
+    (inclusive, YYYY-MM-DD), `customer_id`, `customer` (a name),
+    `number` (a SalesOrderNumber prefix), `total_min` and `total_max`,
+    `limit`, `cursor` (the `next_cursor` of the previous page) and
+    `details=false` to leave out the line items.
+
+    Pages are found by seeking past the cursor's (OrderDate, SalesOrderID)
+    rather than with OFFSET, so deep pages cost the same as the first one.
+    Returns (orders, next_cursor); next_cursor is None on the last page.
+    """
+    limit = _number(args, 'limit', int) or DEFAULT_PAGE_SIZE
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    header = models.SalesOrderHeader
+    query = select(header)
+
+    date_from = _date(args, 'date_from')
+    if date_from:
+        query = query.where(header.OrderDate >= date_from)
+    date_to = _date(args, 'date_to')
+    if date_to:
+        query = query.where(header.OrderDate < date_to + timedelta(days=1))
+    customer_id = _number(args, 'customer_id', int)
+    if customer_id is not None:
+        query = query.where(header.CustomerID == customer_id)
+    if args.get('customer', '').strip():
+        query = query.where(header.CustomerID.in_(_customers_named(args['customer'])))
+    prefix = args.get('number')
+    if prefix:
+        # A range rather than LIKE, so the unique index on SalesOrderNumber is used.
+        query = query.where(header.SalesOrderNumber >= prefix, header.SalesOrderNumber < prefix + '\uffff')
+    total_min = _number(args, 'total_min')
+    if total_min is not None:
+        query = query.where(header.TotalDue >= total_min)
+    total_max = _number(args, 'total_max')
+    if total_max is not None:
+        query = query.where(header.TotalDue <= total_max)
+
+    if args.get('cursor'):
+        query = query.where(tuple_(header.OrderDate, header.SalesOrderID) < decode_cursor(args['cursor']))
+    query = query.order_by(header.OrderDate.desc(), header.SalesOrderID.desc()).limit(limit + 1)
+
+    with_details = args.get('details', 'true').lower() not in ('0', 'false', 'no')
+    if with_details:
+        # Fetch the page's line items in the same query instead of one lazy load per order.
+        query = query.options(joinedload(header.details))
+    orders = db.session.scalars(query).unique().all()
+
+    next_cursor = encode_cursor(orders[limit - 1]) if len(orders) > limit else None
+    return [serialize_order(order, with_details) for order in orders[:limit]], next_cursor
+
+
+def get_order(order_id, session=None):
+    """Loads one order with its line items, or returns None."""
+    session = db.session if session is None else session
+    query = (
+        select(models.SalesOrderHeader)
+        .where(models.SalesOrderHeader.SalesOrderID == order_id)
+        .options(joinedload(models.SalesOrderHeader.details))
+    )
+    order = session.scalars(query).unique().first()
+    return serialize_order(order) if order else None
+
+
+def _columns(row):
+    return {column.name: getattr(row, column.name) for column in row.__table__.columns}
+
+
+def serialize_order(order, with_details=True):
+    """The order in the same SalesOrderHeader/SalesOrderDetail shape the upload returns."""
+    result = {'SalesOrderHeader': _columns(order)}
+    if with_details:
+        result['SalesOrderDetail'] = [
+            _columns(detail) for detail in sorted(order.details, key=lambda detail: detail.SalesOrderDetailID)
+        ]
+    return result
+
+
+def _parse_date(value):
+    try:
+        return datetime.strptime(value, '%a, %d %b %Y %H:%M:%S %Z')
+    except ValueError:
+        return datetime.strptime(value.split('T')[0], '%Y-%m-%d')
+
+
+def _coerce(column, value):
+    """Converts a value from the JSON body (numbers often arrive as strings) to the column's type."""
+    if value == '':
+        value = None
+    if value is None:
+        if not column.nullable and not column.primary_key:
+            raise OrderUpdateError(f"'{column.name}' is required.")
+        return None
+    try:
+        if isinstance(column.type, DateTime):
+            return _parse_date(value) if isinstance(value, str) else value
+        if isinstance(column.type, Boolean):
+            return value if isinstance(value, bool) else str(value).lower() in ('1', 'true', 'yes')
+        if isinstance(column.type, Integer):
+            return int(float(value))
+        if isinstance(column.type, Float):
+            return float(value)
+        return str(value)
+    except (TypeError, ValueError):
+        if isinstance(column.type, DateTime):
+            raise OrderUpdateError(f"Invalid date format for '{column.name}'. Please use YYYY-MM-DD.")
+        raise OrderUpdateError(f"Invalid value for '{column.name}'.")
+
+
+def _line_total(row):
+    discount = row.get('UnitPriceDiscount') or 0.0
+    return round(row['OrderQty'] * row['UnitPrice'] * (1 - discount), 4)
+
+
+def update_order(order_id, data, session=None):
+    """Applies an edit to an order as a diff and returns the updated order.
+
+    `data` has the shape the upload returns. Header fields that are present
+    are updated; the server-maintained ones are ignored. If
+    SalesOrderDetail is present it is the order's complete list of lines:
+    lines are matched to stored rows by SalesOrderDetailID. Only lines that
+    changed are updated, lines without a known ID are inserted, and stored
+    lines that are missing from the list are deleted. LineTotal, SubTotal
+    and TotalDue are recomputed here.
+
+    The client must send the RevisionNumber it last saw. The header update
+    only succeeds if that is still current, which also bumps it, so a stale
+    edit is rejected with a 409 instead of silently overwriting someone
+    else's. The analytics rollups are adjusted to match. Everything runs
+    in the caller's transaction (on `session`, by default the app's); the
+    caller commits, or rolls back if this raises.
+    Returns the updated order, with the new RevisionNumber the client needs
+    for its next edit.
+    """
+    session = db.session if session is None else session
+    header_table = models.SalesOrderHeader.__table__
+    detail_table = models.SalesOrderDetail.__table__
+    header_data = data.get('SalesOrderHeader') or {}
+    details_data = data.get('SalesOrderDetail')
+
+    if header_data.get('RevisionNumber') in (None, ''):
+        raise OrderUpdateError('RevisionNumber is required to update an order.', 428)
+    try:
+        expected_revision = int(header_data['RevisionNumber'])
+    except (TypeError, ValueError):
+        raise OrderUpdateError("Invalid value for 'RevisionNumber'.")
+
+    begin_write(session)
+    with span('load_order'):
+        current = session.execute(
+            select(header_table.c.TaxAmt, header_table.c.Freight).where(header_table.c.SalesOrderID == order_id)
+        ).first()
+        if current is None:
+            raise OrderUpdateError(f'SalesOrder with ID {order_id} not found.', 404)
+        existing = {
+            row['SalesOrderDetailID']: dict(row)
+            for row in session.execute(
+                select(*(detail_table.c[name] for name in DETAIL_COLUMNS | {'SalesOrderDetailID'}))
+                .where(detail_table.c.SalesOrderID == order_id)
+            ).mappings()
+        }
+
+    values = {
+        key: _coerce(header_table.c[key], value)
+        for key, value in header_data.items()
+        if key in header_table.c and key not in SERVER_HEADER_FIELDS
+    }
+
+    inserts, updates, final_lines, response_lines = [], [], [], []
+    if details_data is None:
+        final_lines = list(existing.values())
+    else:
+        with span('product_hydration'):
+            products = get_lookup_index().resolve_products(detail.get('ProductNumber') for detail in details_data)
+        unknown = sorted({str(detail.get('ProductNumber')) for detail in details_data if detail.get('ProductNumber') not in products})
+        if unknown:
+            raise OrderUpdateError(f"Unknown ProductNumber: {', '.join(unknown)}.")
+
+        for detail in details_data:
+            detail_id = detail.get('SalesOrderDetailID')
+            stored = existing.get(detail_id) if detail_id is not None else None
+            row = dict(stored) if stored else {}
+            for key in EDITABLE_DETAIL_FIELDS & detail.keys():
+                row[key] = _coerce(detail_table.c[key], detail[key])
+            product = products[detail['ProductNumber']]
+            row['ProductID'] = product.ProductID
+            row['SalesOrderID'] = order_id
+            for key in ('OrderQty', 'UnitPrice'):
+                if row.get(key) is None:
+                    raise OrderUpdateError(f"'{key}' is required.")
+
+            if stored is None:
+                row.pop('SalesOrderDetailID', None)
+                row['LineTotal'] = _line_total(row)
+                inserts.append(row)
+            else:
+                if any(row.get(key) != stored.get(key) for key in ('OrderQty', 'UnitPrice', 'UnitPriceDiscount')):
+                    row['LineTotal'] = _line_total(row)
+                if row != stored:
+                    updates.append(row)
+            final_lines.append(row)
+            response_lines.append({
+                **row,
+                'ProductNumber': product.ProductNumber,
+                'Name': product.Name,
+                'Color': product.Color,
+                'Size': product.Size,
+                'ListPrice': product.ListPrice,
+            })
+
+    sub_total = round(sum(line['LineTotal'] or 0.0 for line in final_lines), 4)
+    tax = values.get('TaxAmt', current.TaxAmt) or 0.0
+    freight = values.get('Freight', current.Freight) or 0.0
+    values.update(
+        SubTotal=sub_total,
+        TotalDue=round(sub_total + tax + freight, 4),
+        RevisionNumber=expected_revision + 1,
+    )
+
+    # The order comes out of the rollups as stored and goes back in as edited.
+    # If the compare-and-set below fails, the caller's rollback undoes this too.
+    with span('rollups'):
+        update_rollups([order_id], -1, session)
+
+    # Compare-and-set on the revision before any line is touched.
+    with span('update_header'):
+        updated = session.execute(
+            update(header_table)
+            .where(header_table.c.SalesOrderID == order_id, func.coalesce(header_table.c.RevisionNumber, 0) == expected_revision)
+            .values(**values)
+        )
+    if updated.rowcount == 0:
+        raise OrderUpdateError(
+            f'SalesOrder {order_id} was changed by someone else; reload it and apply your edit again.', 409
+        )
+
+    if details_data is not None:
+        deleted = existing.keys() - {row.get('SalesOrderDetailID') for row in final_lines}
+        with span('update_details'):
+            if deleted:
+                session.execute(delete(detail_table).where(detail_table.c.SalesOrderDetailID.in_(deleted)))
+            if updates:
+                session.execute(update(models.SalesOrderDetail), updates)
+            for row, detail_id in zip(inserts, insert_details(inserts, session)):
+                row['SalesOrderDetailID'] = detail_id
+        for row, line in zip(final_lines, response_lines):
+            line['SalesOrderDetailID'] = row['SalesOrderDetailID']
+        log('order_updated', order_id=order_id, inserted=len(inserts), updated=len(updates), deleted=len(deleted),
+            unchanged=len(final_lines) - len(inserts) - len(updates))
+
+    with span('rollups'):
+        update_rollups([order_id], 1, session)
+
+    with span('reload_order'):
+        order = get_order(order_id, session)
+    if details_data is not None:
+        # Lines come back in the client's order, hydrated like the upload response.
+        order['SalesOrderDetail'] = response_lines
+    return order
+
+
+def delete_order(order_id, session=None):
+    """Deletes an order and its lines, and takes it out of the analytics rollups.
+
+    Deleting an order that doesn't exist is not an error. The caller commits.
+    """
+    session = db.session if session is None else session
+    header_table = models.SalesOrderHeader.__table__
+    detail_table = models.SalesOrderDetail.__table__
+    begin_write(session)
+    # Lock the order first on databases that can, so a concurrent edit can't
+    # change the lines between reading them for the rollups and deleting them.
+    session.execute(select(header_table.c.SalesOrderID).where(header_table.c.SalesOrderID == order_id).with_for_update())
+    with span('rollups'):
+        update_rollups([order_id], -1, session)
+    # First delete the details, then the header
+    with span('delete'):
+        session.execute(delete(detail_table).where(detail_table.c.SalesOrderID == order_id))
+        session.execute(delete(header_table).where(header_table.c.SalesOrderID == order_id))
@@ -0,0 +1,227 @@
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from .extraction import ExtractionError, extract_invoice
+from .metrics import bind_trace, log, span
+
+PDF_MAGIC = b'%PDF'
+TIFF_MAGICS = (b'II*\x00', b'MM\x00*')
+
+# Header fields that normally appear at the end of a multi-page invoice,
+# so values from later pages win over earlier ones.
+TOTAL_FIELDS = ('SubTotal', 'TaxAmt', 'Freight', 'TotalDue')
+
+# PDFium must never be called from two threads at once, even for different
+# documents, and requests, batch workers and job workers all render PDFs.
+# Every pypdfium2 call in the process holds this lock. It is reentrant
+# because a PDF object's finalizer can run during garbage collection
+# triggered inside a locked call.
+_pdfium_lock = threading.RLock()
+
+
+def is_pdf(data):
+    return data[:4] == PDF_MAGIC
+
+
+def is_tiff(data):
+    return data[:4] in TIFF_MAGICS
+
+
+class _MemoryBudget:
+    """Blocks callers until the estimated bytes held by in-flight pages fit.
+
+    A single page larger than the whole budget is still let through on its
+    own, so an oversized page slows the document down instead of failing it.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._changed = threading.Condition()
+
+    def acquire(self, size):
+        with self._changed:
+            while self.used and self.used + size > self.limit:
+                self._changed.wait()
+            self.used += size
+
+    def release(self, size):
+        with self._changed:
+            self.used -= size
+            self._changed.notify_all()
+
+
+class PageSplitter:
+    """Splits multi-page PDFs and TIFFs and extracts their pages concurrently.
+
+    Pages are rasterized one at a time as workers become free, never all up
+    front. Each page's raw bitmap size is charged against `memory_limit`
+    before it is rendered. Documents longer than `max_pages` are rejected.
+    PDF pages are rendered at `dpi`; rendering needs the optional `pypdfium2`
+    package.
+    """
+
+    def __init__(self, max_pages=50, memory_limit=256 * 1024 * 1024, parallelism=4, dpi=200):
+        self.max_pages = max_pages
+        self.memory_limit = memory_limit
+        self.parallelism = parallelism
+        self.dpi = dpi
+
+    def is_multipage(self, data):
+        if is_pdf(data):
+            return True
+        if is_tiff(data):
+            with Image.open(io.BytesIO(data)) as img:
+                return getattr(img, 'n_frames', 1) > 1
+        return False
+
+    def _check_page_count(self, count):
+        if count > self.max_pages:
+            raise ExtractionError(f'Document has {count} pages; at most {self.max_pages} are allowed.', 413)
+
+    def _pdf_pages(self, data):
+        """Yields (estimated_bytes, render) pairs, one per PDF page."""
+        try:
+            import pypdfium2 as pdfium
+        except ImportError:
+            raise ExtractionError('PDF uploads need the pypdfium2 package to be installed.', 415)
+
+        with _pdfium_lock:
+            pdf = pdfium.PdfDocument(data)
+        try:
+            with _pdfium_lock:
+                page_count = len(pdf)
+            self._check_page_count(page_count)
+            for index in range(page_count):
+                with _pdfium_lock:
+                    page = pdf[index]
+                    width, height = page.get_size()
+                scale = self.dpi / 72.0
+                # Keep a single page's bitmap within the budget by lowering its resolution.
+                max_scale = (self.memory_limit / (3 * width * height)) ** 0.5
+                scale = min(scale, max_scale)
+                estimate = int(width * scale) * int(height * scale) * 3
+
+                def render(page=page, scale=scale):
+                    with _pdfium_lock:
+                        try:
+                            bitmap = page.render(scale=scale)
+                            # A copy, so the image doesn't share the bitmap's buffer and
+                            # the bitmap can be freed here rather than by a finalizer on
+                            # whichever thread drops the last reference.
+                            img = bitmap.to_pil().copy()
+                            bitmap.close()
+                        finally:
+                            page.close()
+                    img.info['dpi'] = (scale * 72.0, scale * 72.0)
+                    return img
+                yield estimate, render
+        finally:
+            with _pdfium_lock:
+                pdf.close()
+
+    def _tiff_pages(self, data):
+        """Yields (estimated_bytes, render) pairs, one per TIFF frame."""
+        img = Image.open(io.BytesIO(data))
+        try:
+            self._check_page_count(img.n_frames)
+            for index in range(img.n_frames):
+                img.seek(index)
+                estimate = img.width * img.height * len(img.getbands())
+
+                def render():
+                    frame = img.copy()
+                    frame.info['dpi'] = img.info.get('dpi')
+                    return frame
+                yield estimate, render
+        finally:
+            img.close()
+
+    def extract(self, data, model, preprocessor=None, report=None, usage=None):
+        """Extracts every page and merges the results into one invoice.
+
+        Token counts from every page's model call are added to `usage`.
+        """
+        pages = self._pdf_pages(data) if is_pdf(data) else self._tiff_pages(data)
+        budget = _MemoryBudget(self.memory_limit)
+        page_reports = []
+        page_usage = []
+
+        def extract_page(img, estimate):
+            tokens = {}
+            page_usage.append(tokens)
+            try:
+                if preprocessor is None:
+                    return extract_invoice(img, model, tokens)
+                with span('preprocess'):
+                    image_data, mime_type, preprocessing = preprocessor.process_image(img)
+                page_reports.append(preprocessing)
+            finally:
+                # The bitmap is no longer needed once it is encoded, so the
+                # budget is freed before the slow model call.
+                img.close()
+                budget.release(estimate)
+            return extract_invoice({'mime_type': mime_type, 'data': image_data}, model, tokens)
+
+        futures = []
+        with ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+            # Pages are rendered here, one at a time; see _pdfium_lock for PDFs.
+            for estimate, render in pages:
+                budget.acquire(estimate)
+                try:
+                    with span('render_page'):
+                        img = render()
+                except Exception:
+                    budget.release(estimate)
+                    raise
+                futures.append(executor.submit(bind_trace(extract_page), img, estimate))
+
+        results = []
+        for number, future in enumerate(futures, start=1):
+            try:
+                results.append(future.result())
+            except ExtractionError:
+                # A blank or unreadable continuation page shouldn't sink the document.
+                log('page_skipped', level='warning', page=number, reason='no data')
+        if usage is not None:
+            for tokens in page_usage:
+                for name, count in tokens.items():
+                    usage[name] = usage.get(name, 0) + count
+        if report is not None:
+            report['pages'] = len(futures)
+            if page_reports:
+                report['preprocessing'] = {
+                    'pages': len(page_reports),
+                    'output_bytes': sum(r['output_bytes'] for r in page_reports),
+                    'total_ms': round(sum(r['total_ms'] for r in page_reports), 2),
+                }
+        if not results:
+            raise ExtractionError('Failed to extract data from document.')
+        return merge_pages(results)
+
+
+def merge_pages(pages):
+    """Combines per-page extractions into a single invoice.
+
+    Header fields come from the first page that has them, except totals,
+    where the last page that states them wins. Line items from every page are
+    kept in page order. Customer and address details come from the first page
+    that mentions them.
+    """
+    header = {}
+    details = []
+    merged = {}
+    for page in pages:
+        for key, value in (page.get('SalesOrderHeader') or {}).items():
+            if value in (None, ''):
+                continue
+            if key not in header or key in TOTAL_FIELDS:
+                header[key] = value
+        details.extend(page.get('SalesOrderDetail') or [])
+        for key in ('CustomerName', 'BillingAddress', 'ShippingAddress'):
+            if page.get(key) and not merged.get(key):
+                merged[key] = page[key]
+    merged['SalesOrderHeader'] = header
+    merged['SalesOrderDetail'] = details
+    return merged
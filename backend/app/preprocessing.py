@@ -0,0 +1,144 @@
+import io
+import math
+import time
+from PIL import Image, ImageOps, ImageStat
+
+MIME_TYPES = {'JPEG': 'image/jpeg', 'PNG': 'image/png', 'WEBP': 'image/webp'}
+
+
+class Preprocessor:
+    """Shrinks an invoice image before it is sent to the model.
+
+    Works entirely on in-memory bytes. The steps, each of which can be
+    switched off, are: EXIF orientation fix, grayscale conversion, downscaling
+    to `target_dpi` and a `max_pixels` budget, cropping of blank margins,
+    deskewing, and re-encoding as `output_format`. `process` returns the new
+    bytes, their MIME type and a report with per-step timings and sizes.
+    """
+
+    def __init__(self, grayscale=True, max_pixels=2_500_000, target_dpi=200, crop=True,
+                 deskew=True, max_skew=5.0, output_format='JPEG', quality=80):
+        self.grayscale = grayscale
+        self.max_pixels = max_pixels
+        self.target_dpi = target_dpi
+        self.crop = crop
+        self.deskew = deskew
+        self.max_skew = max_skew
+        self.output_format = output_format.upper()
+        self.quality = quality
+        if self.output_format not in MIME_TYPES:
+            raise ValueError(f"Unsupported preprocessing format '{output_format}'.")
+
+    def process(self, data):
+        report = {'input_bytes': len(data), 'steps': {}}
+        start = time.perf_counter()
+        img, target_size = self._decode(data, report)
+        report['steps']['decode'] = round((time.perf_counter() - start) * 1000, 2)
+        return self._run(img, target_size, report, start)
+
+    def process_image(self, img):
+        """Like `process`, for an image that is already decoded (e.g. a PDF page)."""
+        report = {'input_bytes': None, 'input_size': list(img.size), 'steps': {}}
+        scale = self._scale(img.size, img.info.get('dpi'))
+        target_size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        return self._run(img, target_size, report, time.perf_counter())
+
+    def _run(self, img, target_size, report, total_start):
+        def timed(name, step, img):
+            start = time.perf_counter()
+            result = step(img)
+            report['steps'][name] = round((time.perf_counter() - start) * 1000, 2)
+            return result
+
+        # Downscale before the remaining steps so they all work on fewer pixels.
+        img = timed('downscale', lambda i: self._downscale(i, target_size), img)
+        img = timed('exif_transpose', ImageOps.exif_transpose, img)
+        if self.grayscale:
+            img = timed('grayscale', lambda i: i.convert('L'), img)
+        elif img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        if self.crop:
+            img = timed('crop', self._crop_margins, img)
+        if self.deskew:
+            img = timed('deskew', self._deskew, img)
+        output = timed('encode', self._encode, img)
+
+        report['output_size'] = list(img.size)
+        report['output_bytes'] = len(output)
+        if report['input_bytes'] is not None:
+            report['saved_bytes'] = report['input_bytes'] - len(output)
+        report['total_ms'] = round((time.perf_counter() - total_start) * 1000, 2)
+        return output, MIME_TYPES[self.output_format], report
+
+    def _decode(self, data, report):
+        """Decodes the image and works out the size it should be scaled to."""
+        img = Image.open(io.BytesIO(data))
+        report['input_size'] = list(img.size)
+        scale = self._scale(img.size, img.info.get('dpi'))
+        target_size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        if scale < 1.0:
+            # JPEGs can be decoded straight at a reduced size, which is far
+            # cheaper than decoding everything and resizing afterwards.
+            img.draft('L' if self.grayscale else 'RGB', target_size)
+        img.load()
+        return img, target_size
+
+    def _scale(self, size, dpi):
+        """The factor that brings an image down to the DPI and pixel budget."""
+        scale = 1.0
+        if self.target_dpi and dpi and dpi[0] and dpi[0] > self.target_dpi:
+            scale = self.target_dpi / float(dpi[0])
+        width, height = size
+        if self.max_pixels and width * height * scale * scale > self.max_pixels:
+            scale = math.sqrt(self.max_pixels / (width * height))
+        return scale
+
+    def _downscale(self, img, target_size):
+        if img.width <= target_size[0] and img.height <= target_size[1]:
+            return img
+        return img.resize(target_size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+    @staticmethod
+    def _ink_mask(img):
+        # Anything noticeably darker than paper counts as content.
+        return img.convert('L').point(lambda p: 255 if p < 200 else 0)
+
+    def _crop_margins(self, img):
+        box = self._ink_mask(img).getbbox()
+        if not box:
+            return img
+        pad = max(8, min(img.size) // 100)
+        left, top, right, bottom = box
+        box = (max(0, left - pad), max(0, top - pad), min(img.width, right + pad), min(img.height, bottom + pad))
+        return img.crop(box) if box != (0, 0, img.width, img.height) else img
+
+    def _deskew(self, img):
+        """Estimates skew from a projection profile and rotates it out.
+
+        Text lines produce the sharpest row profile (highest variance of row
+        ink density) when they are level, so the best of a sweep of small
+        rotations on a thumbnail gives the skew angle.
+        """
+        mask = self._ink_mask(img)
+        mask.thumbnail((800, 800))
+
+        def sharpness(angle):
+            rotated = mask.rotate(angle, resample=Image.Resampling.NEAREST, expand=True)
+            rows = rotated.resize((1, rotated.height), Image.Resampling.BOX)
+            return ImageStat.Stat(rows).var[0]
+
+        steps = int(self.max_skew / 0.5)
+        # Ties (e.g. a blank page) go to the smallest rotation.
+        best = max((step * 0.5 for step in range(-steps, steps + 1)), key=lambda angle: (sharpness(angle), -abs(angle)))
+        if abs(best) < 0.5:
+            return img
+        fill = 255 if img.mode == 'L' else (255, 255, 255)
+        return img.rotate(best, resample=Image.Resampling.BICUBIC, expand=True, fillcolor=fill)
+
+    def _encode(self, img):
+        buffer = io.BytesIO()
+        if self.output_format == 'PNG':
+            img.save(buffer, 'PNG', optimize=True)
+        else:
+            img.save(buffer, self.output_format, quality=self.quality, optimize=True)
+        return buffer.getvalue()
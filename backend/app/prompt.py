@@ -0,0 +1,97 @@
+from functools import cache
+from sqlalchemy import Boolean, DateTime, Float, Integer
+from . import models
+
+# Header columns the system fills in itself, so the model is never asked for them.
+SYSTEM_FIELDS = {'RevisionNumber', 'Status', 'OnlineOrderFlag'}
+
+# Top-level keys of the extraction besides the two tables.
+EXTRA_FIELDS = ('CustomerName', 'BillingAddress', 'ShippingAddress')
+
+
+def _json_type(column):
+    if isinstance(column.type, Boolean):
+        return 'boolean'
+    if isinstance(column.type, Integer):
+        return 'integer'
+    if isinstance(column.type, Float):
+        return 'number'
+    return 'string'
+
+
+def _extractable(column):
+    """True for columns that can be read off an invoice.
+
+    Keys and other surrogate IDs are assigned by the database or by lookups
+    after extraction, so they are left out.
+    """
+    return not (
+        column.primary_key or column.foreign_keys or column.name.endswith('ID') or column.name in SYSTEM_FIELDS
+    )
+
+
+@cache
+def field_schema():
+    """The fields the model should fill, as {section: [(name, column)]}.
+
+    Built from the SQLAlchemy metadata of SalesOrderHeader and
+    SalesOrderDetail. Detail lines carry the ProductNumber in place of the
+    ProductID, which is looked up when the order is saved.
+    """
+    header = [(column.name, column) for column in models.SalesOrderHeader.__table__.columns if _extractable(column)]
+    detail = [('ProductNumber', models.Product.__table__.columns['ProductNumber'])]
+    detail += [(column.name, column) for column in models.SalesOrderDetail.__table__.columns if _extractable(column)]
+    return {'SalesOrderHeader': header, 'SalesOrderDetail': detail}
+
+
+def _describe(name, column):
+    kind = 'date YYYY-MM-DD' if isinstance(column.type, DateTime) else _json_type(column)
+    return f"{name} ({kind}{', required' if not column.nullable else ''})"
+
+
+@cache
+def build_prompt():
+    """The extraction prompt, built once and reused for every request."""
+    sections = field_schema()
+    header = ', '.join(_describe(name, column) for name, column in sections['SalesOrderHeader'])
+    detail = ', '.join(_describe(name, column) for name, column in sections['SalesOrderDetail'])
+    return (
+        "You are an expert invoice data extractor. Extract every field below that appears on the invoice image "
+        "and return a single JSON object.\n"
+        f"- SalesOrderHeader: {header}. The invoice number is the SalesOrderNumber; "
+        "shipping & handling is Freight.\n"
+        f"- SalesOrderDetail: a list with one object per product line: {detail}. "
+        "Calculate LineTotal for each line.\n"
+        "- CustomerName: the customer's full name.\n"
+        "- BillingAddress: the billing address, or the shipping address if there is no separate one.\n"
+        "- ShippingAddress: the shipping address.\n"
+        "Use null for fields that are not on the invoice. Return ONLY the JSON object."
+    )
+
+
+@cache
+def response_schema():
+    """The same fields as an OpenAPI schema for Gemini's structured output mode."""
+    def section(fields):
+        return {
+            'type': 'object',
+            'properties': {
+                name: {'type': _json_type(column), 'nullable': column.nullable}
+                for name, column in fields
+            },
+            'required': [name for name, column in fields if not column.nullable],
+        }
+
+    sections = field_schema()
+    properties = {
+        'SalesOrderHeader': section(sections['SalesOrderHeader']),
+        'SalesOrderDetail': {'type': 'array', 'items': section(sections['SalesOrderDetail'])},
+    }
+    for name in EXTRA_FIELDS:
+        properties[name] = {'type': 'string', 'nullable': True}
+    return {'type': 'object', 'properties': properties, 'required': ['SalesOrderHeader', 'SalesOrderDetail']}
+
+
+def generation_config():
+    """Generation settings that make Gemini answer with bare JSON matching `response_schema`."""
+    return {'response_mime_type': 'application/json', 'response_schema': response_schema()}
@@ -0,0 +1,178 @@
+import json
+import queue
+import threading
+from .database import db
+from .extraction import (
+    ExtractionError, extract_document, get_extraction_cache, get_page_splitter,
+    get_preprocessor, save_extracted_data, transient_model_errors
+)
+from .metrics import bind_trace, log_exception
+
+_DECODER = json.JSONDecoder()
+
+
+class PartialInvoiceParser:
+    """Picks complete pieces out of a model response while it is streaming.
+
+    `feed` takes the next chunk of text and returns ('header', {...}) once
+    the SalesOrderHeader object has been closed, and ('detail', {...}) for
+    each SalesOrderDetail line as soon as its object is closed.
+    """
+
+    def __init__(self):
+        self.text = ''
+        self.header_sent = False
+        self.details_sent = 0
+        self._detail_pos = None
+        self._details_done = False
+
+    def _value_start(self, key):
+        at = self.text.find(f'"{key}"')
+        if at == -1:
+            return None
+        colon = self.text.find(':', at + len(key) + 2)
+        if colon == -1:
+            return None
+        start = colon + 1
+        while start < len(self.text) and self.text[start].isspace():
+            start += 1
+        return start if start < len(self.text) else None
+
+    def feed(self, chunk):
+        self.text += chunk
+        events = []
+        if not self.header_sent:
+            start = self._value_start('SalesOrderHeader')
+            if start is not None:
+                try:
+                    header, _ = _DECODER.raw_decode(self.text, start)
+                except json.JSONDecodeError:
+                    pass
+                else:
+                    self.header_sent = True
+                    events.append(('header', header))
+
+        if self._detail_pos is None:
+            start = self._value_start('SalesOrderDetail')
+            if start is not None and self.text[start] == '[':
+                self._detail_pos = start + 1
+        while self._detail_pos is not None and not self._details_done:
+            pos = self._detail_pos
+            while pos < len(self.text) and (self.text[pos].isspace() or self.text[pos] == ','):
+                pos += 1
+            if pos >= len(self.text):
+                break
+            if self.text[pos] == ']':
+                self._details_done = True
+                break
+            try:
+                detail, end = _DECODER.raw_decode(self.text, pos)
+            except json.JSONDecodeError:
+                break
+            self._detail_pos = end
+            events.append(('detail', {'index': self.details_sent, 'detail': detail}))
+            self.details_sent += 1
+        return events
+
+
+def format_event(app, event, payload):
+    """Formats one Server-Sent Event, serializing the payload like `jsonify`."""
+    return f"event: {event}\ndata: {app.json.dumps(payload)}\n\n"
+
+
+def _extract_and_save(app, data, filename, emit):
+    """Runs a whole upload on a worker thread, reporting progress through `emit`."""
+    with app.app_context():
+        try:
+            emit('received', {'filename': filename, 'bytes': len(data)})
+            parser = PartialInvoiceParser()
+            received_chars = 0
+
+            def progress(event, payload):
+                nonlocal parser, received_chars
+                if event == 'text':
+                    received_chars += len(payload)
+                    emit('tokens', {'text': payload, 'chars': received_chars})
+                    for name, piece in parser.feed(payload):
+                        emit(name, piece)
+                else:
+                    if event == 'escalated':
+                        # The next model's response streams in from the start.
+                        parser = PartialInvoiceParser()
+                        received_chars = 0
+                    emit(event, payload)
+
+            report = {}
+            extracted_data = extract_document(
+                data,
+                cache=get_extraction_cache(),
+                preprocessor=get_preprocessor(),
+                splitter=get_page_splitter(),
+                report=report,
+                progress=progress,
+            )
+            # Cache hits and multi-page documents aren't streamed, so their
+            # header and lines are sent in one go once they are known.
+            if not parser.header_sent:
+                emit('header', extracted_data.get('SalesOrderHeader') or {})
+            for index, detail in enumerate((extracted_data.get('SalesOrderDetail') or [])[parser.details_sent:], parser.details_sent):
+                emit('detail', {'index': index, 'detail': detail})
+
+            final_response = save_extracted_data(extracted_data, progress=emit)
+            emit('committed', {
+                'status': 'success',
+                'message': 'Data saved to database.',
+                'data': final_response,
+                'preprocessing': report.get('preprocessing'),
+                'tokens': report.get('tokens'),
+                'model': report.get('model'),
+            })
+        except ExtractionError as e:
+            db.session.rollback()
+            emit('error', {'error': e.message, 'status': e.status_code})
+        except transient_model_errors() as e:
+            db.session.rollback()
+            emit('error', {'error': f'The model is busy, please try again shortly: {str(e)}', 'status': 503})
+        except Exception as e:
+            db.session.rollback()
+            log_exception(e, filename=filename)
+            emit('error', {'error': f'An error occurred: {str(e)}', 'status': 500})
+        finally:
+            db.session.remove()
+
+
+def stream_upload(app, data, filename, heartbeat=15.0):
+    """Starts extracting and saving an upload; returns a generator of Server-Sent Events.
+
+    The work runs on its own thread so that a comment line can be sent every
+    `heartbeat` seconds while nothing else is happening, which keeps proxies
+    from timing out a quiet connection during a long model call. The stream
+    ends after a 'committed' or an 'error' event.
+    """
+    events = queue.Queue()
+    done = object()
+
+    def emit(event, payload):
+        events.put((event, payload))
+
+    def run():
+        try:
+            _extract_and_save(app, data, filename, emit)
+        finally:
+            events.put(done)
+
+    def stream():
+        while True:
+            try:
+                item = events.get(timeout=heartbeat)
+            except queue.Empty:
+                yield ': keep-alive\n\n'
+                continue
+            if item is done:
+                return
+            yield format_event(app, *item)
+
+    # Started here rather than on the first read of the stream, while the
+    # request's trace is still current, so the worker records into it.
+    threading.Thread(target=bind_trace(run), name='upload-stream', daemon=True).start()
+    return stream()
@@ -0,0 +1,67 @@
+import math
+from .lookup import get_lookup_index
+
+
+def _number(value):
+    """`value` as a float, or None when it is missing or not a number."""
+    if value is None or value == '' or isinstance(value, bool):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _line_total(detail):
+    line_total = _number(detail.get('LineTotal'))
+    if line_total is not None:
+        return line_total
+    quantity, price = _number(detail.get('OrderQty')), _number(detail.get('UnitPrice'))
+    if quantity is None or price is None:
+        return None
+    return quantity * price * (1 - (_number(detail.get('UnitPriceDiscount')) or 0.0))
+
+
+def _close(actual, expected, tolerance):
+    # Absolute only: a misread digit is off by a round amount however large the invoice.
+    return math.isclose(actual, expected, rel_tol=0, abs_tol=tolerance)
+
+
+def validate_extraction(extracted_data, lookup_index=None, tolerance=0.01):
+    """Cheap consistency checks on an extraction; returns a list of problems.
+
+    The line totals must add up to SubTotal, SubTotal + TaxAmt + Freight
+    must equal TotalDue (each within `tolerance`), and every ProductNumber
+    must exist in the Product table. A misread digit almost always breaks one
+    of these, so an empty list is a good sign the extraction can be trusted.
+    """
+    header = extracted_data.get('SalesOrderHeader') or {}
+    details = extracted_data.get('SalesOrderDetail') or []
+    if not header or not details:
+        return ['Missing SalesOrderHeader or SalesOrderDetail.']
+
+    problems = []
+    sub_total = _number(header.get('SubTotal'))
+    line_totals = [_line_total(detail) for detail in details]
+    if sub_total is None:
+        problems.append('SubTotal is missing.')
+    elif None in line_totals:
+        problems.append(f'{line_totals.count(None)} lines have no usable LineTotal.')
+    elif not _close(sum(line_totals), sub_total, tolerance):
+        problems.append(f'Line totals add up to {sum(line_totals):.2f}, not the SubTotal of {sub_total:.2f}.')
+
+    total_due = _number(header.get('TotalDue'))
+    if total_due is None:
+        problems.append('TotalDue is missing.')
+    elif sub_total is not None:
+        expected = sub_total + (_number(header.get('TaxAmt')) or 0.0) + (_number(header.get('Freight')) or 0.0)
+        if not _close(expected, total_due, tolerance):
+            problems.append(f'SubTotal + TaxAmt + Freight is {expected:.2f}, not the TotalDue of {total_due:.2f}.')
+
+    lookup_index = lookup_index or get_lookup_index()
+    numbers = [detail.get('ProductNumber') for detail in details]
+    known = lookup_index.resolve_products(numbers)
+    unknown = sorted({str(number) for number in numbers if number not in known})
+    if unknown:
+        problems.append(f"Unknown ProductNumber: {', '.join(unknown)}.")
+    return problems
@@ -0,0 +1,196 @@
+"""Synthetic reference data, invoices and workbooks of any size for the benchmarks."""
+import io
+import random
+import string
+from datetime import datetime, timedelta
+from PIL import Image, ImageDraw
+from sqlalchemy import insert
+from app.database import db
+from app import models
+
+FIRST_NAMES = ['Jon', 'Eugene', 'Ruben', 'Christy', 'Elizabeth', 'Julio', 'Janet', 'Marco', 'Rob', 'Shannon',
+               'Jacquelyn', 'Curtis', 'Lauren', 'Ian', 'Sydney', 'Chloe', 'Wyatt', 'Shannon', 'Clarence', 'Luke']
+LAST_NAMES = ['Yang', 'Huang', 'Torres', 'Zhu', 'Johnson', 'Ruiz', 'Alvarez', 'Mehta', 'Verhoff', 'Carlson',
+              'Suarez', 'Lu', 'Walker', 'Jenkins', 'Bennett', 'Young', 'Hill', 'Wang', 'Rai', 'Lal']
+CITIES = ['Rockhampton', 'Seattle', 'Bothell', 'Portland', 'Burnaby', 'Melbourne', 'Berlin', 'Paris']
+COLORS = ['Black', 'Red', 'Silver', 'Blue', 'Yellow', None]
+SIZES = ['S', 'M', 'L', 'XL', '44', '48', '52', '58', '62', None]
+
+
+def product_number(rng):
+    """A ProductNumber shaped like the real ones, e.g. BK-R93R-62."""
+    letters = string.ascii_uppercase
+    return (f"{rng.choice(letters)}{rng.choice(letters)}-{rng.choice(letters)}{rng.randint(10, 99)}"
+            f"{rng.choice(letters)}-{rng.randint(10, 99)}")
+
+
+class ReferenceData:
+    """Products, territories and customers to run scenarios against.
+
+    Generated from `seed`, so the same arguments always give the same data.
+    """
+
+    def __init__(self, products=500, customers=1000, territories=10, seed=0):
+        rng = random.Random(seed)
+        numbers = set()
+        while len(numbers) < products:
+            numbers.add(product_number(rng))
+        self.products = [
+            {
+                'ProductID': product_id,
+                'ProductNumber': number,
+                'Name': f"Product {number}",
+                'Color': rng.choice(COLORS),
+                'Size': rng.choice(SIZES),
+                'ListPrice': round(rng.uniform(2, 3500), 2),
+                'StandardCost': round(rng.uniform(1, 2000), 2),
+                'MakeFlag': rng.random() < 0.5,
+                'FinishedGoodsFlag': True,
+            }
+            for product_id, number in enumerate(sorted(numbers), start=1)
+        ]
+        self.territories = [
+            {'TerritoryID': territory_id, 'Name': f"Territory {territory_id}", 'CountryRegionCode': 'US', 'Group': 'North America'}
+            for territory_id in range(1, territories + 1)
+        ]
+        self.customers = []
+        self.individuals = []
+        for customer_id in range(11000, 11000 + customers):
+            person_id = customer_id - 10000
+            self.customers.append({
+                'CustomerID': customer_id,
+                'PersonID': person_id,
+                'TerritoryID': rng.randint(1, territories),
+                'AccountNumber': f"AW{customer_id:08d}",
+            })
+            self.individuals.append({
+                'BusinessEntityID': person_id,
+                'FirstName': rng.choice(FIRST_NAMES),
+                'LastName': f"{rng.choice(LAST_NAMES)}{customer_id}",
+                'AddressType': 'Home',
+                'AddressLine1': f"{rng.randint(1, 9999)} {rng.choice(LAST_NAMES)} St",
+                'City': rng.choice(CITIES),
+                'StateProvinceName': 'Queensland',
+                'PostalCode': str(rng.randint(1000, 99999)),
+                'CountryRegionName': 'Australia',
+            })
+
+    def seed_database(self):
+        """Writes the reference rows through the app's session and commits."""
+        db.session.execute(insert(models.SalesTerritory), self.territories)
+        db.session.execute(insert(models.Product), self.products)
+        db.session.execute(insert(models.Customer), self.customers)
+        db.session.execute(insert(models.IndividualCustomer), self.individuals)
+        db.session.commit()
+
+
+def invoice_payload(rng, reference, number, lines):
+    """An extraction result, as the model would return it, with `lines` line items."""
+    order_date = datetime(2024, 1, 1) + timedelta(days=rng.randint(0, 365))
+    details = []
+    for product in rng.sample(reference.products, min(lines, len(reference.products))):
+        quantity = rng.randint(1, 10)
+        details.append({
+            'ProductNumber': product['ProductNumber'],
+            'OrderQty': quantity,
+            'UnitPrice': product['ListPrice'],
+            'LineTotal': round(quantity * product['ListPrice'], 2),
+        })
+    sub_total = round(sum(detail['LineTotal'] for detail in details), 2)
+    tax = round(sub_total * 0.08, 2)
+    individual = rng.choice(reference.individuals)
+    address = f"{individual['AddressLine1']}, {individual['City']}, {individual['StateProvinceName']} {individual['PostalCode']}"
+    return {
+        'SalesOrderHeader': {
+            'SalesOrderNumber': number,
+            'OrderDate': order_date.strftime('%Y-%m-%d'),
+            'DueDate': (order_date + timedelta(days=12)).strftime('%Y-%m-%d'),
+            'ShipDate': (order_date + timedelta(days=7)).strftime('%Y-%m-%d'),
+            'AccountNumber': f"10-4030-{rng.randint(0, 999999):06d}",
+            'SubTotal': sub_total,
+            'TaxAmt': tax,
+            'Freight': 2.5,
+            'TotalDue': round(sub_total + tax + 2.5, 2),
+        },
+        'SalesOrderDetail': details,
+        'CustomerName': f"{individual['FirstName']} {individual['LastName']}",
+        'BillingAddress': address,
+        'ShippingAddress': address,
+    }
+
+
+def invoice_image(width=1700, height=2200, rows=30, seed=0, image_format='JPEG'):
+    """Encoded bytes of a page that looks roughly like a scanned invoice (letter size at 200 dpi by default)."""
+    rng = random.Random(seed)
+    img = Image.new('RGB', (width, height), 'white')
+    draw = ImageDraw.Draw(img)
+    draw.text((width // 12, height // 20), f"INVOICE SO{rng.randint(10000, 99999)}", fill='black')
+    top = height // 5
+    row_height = max(12, (height - top - height // 10) // max(rows, 1))
+    for row in range(rows):
+        y = top + row * row_height
+        draw.text((width // 12, y), f"{product_number(rng)}  Product line {row + 1}", fill='black')
+        draw.text((width * 2 // 3, y), f"{rng.randint(1, 10)} x {rng.uniform(2, 3500):.2f}", fill='black')
+        draw.line((width // 12, y + row_height - 2, width * 11 // 12, y + row_height - 2), fill=(200, 200, 200))
+    # A little scanner noise so the image doesn't compress unrealistically well.
+    for _ in range(width * height // 400):
+        draw.point((rng.randrange(width), rng.randrange(height)), fill=(rng.randint(180, 255),) * 3)
+    buffer = io.BytesIO()
+    img.save(buffer, image_format, dpi=(200, 200))
+    return buffer.getvalue()
+
+
+def write_workbook(path, reference, orders=1000, lines_per_order=3, seed=0):
+    """Writes a workbook with every sheet database_setup.py loads."""
+    import pandas as pd
+
+    rng = random.Random(seed)
+    product_ids = {product['ProductNumber']: product['ProductID'] for product in reference.products}
+    headers = []
+    details = []
+    for order_id in range(1, orders + 1):
+        payload = invoice_payload(rng, reference, f"SO{43658 + order_id}", lines_per_order)
+        header = payload['SalesOrderHeader']
+        headers.append({
+            'SalesOrderID': order_id,
+            'RevisionNumber': 8,
+            'OrderDate': header['OrderDate'],
+            'DueDate': header['DueDate'],
+            'ShipDate': header['ShipDate'],
+            'Status': 5,
+            'OnlineOrderFlag': rng.random() < 0.5,
+            'SalesOrderNumber': header['SalesOrderNumber'],
+            'AccountNumber': header['AccountNumber'],
+            'CustomerID': rng.choice(reference.customers)['CustomerID'],
+            'TerritoryID': rng.choice(reference.territories)['TerritoryID'],
+            'SubTotal': header['SubTotal'],
+            'TaxAmt': header['TaxAmt'],
+            'Freight': header['Freight'],
+            'TotalDue': header['TotalDue'],
+        })
+        for detail in payload['SalesOrderDetail']:
+            details.append({
+                'SalesOrderID': order_id,
+                'SalesOrderDetailID': len(details) + 1,
+                'OrderQty': detail['OrderQty'],
+                'ProductID': product_ids[detail['ProductNumber']],
+                'UnitPrice': detail['UnitPrice'],
+                'UnitPriceDiscount': 0.0,
+                'LineTotal': detail['LineTotal'],
+            })
+
+    sheets = {
+        'Product': pd.DataFrame(reference.products),
+        'ProductCategory': pd.DataFrame([{'ProductCategoryID': 1, 'Name': 'Bikes'}]),
+        'ProductSubCategory': pd.DataFrame([{'ProductSubcategoryID': 1, 'ProductCategoryID': 1, 'Name': 'Road Bikes'}]),
+        'SalesOrderHeader': pd.DataFrame(headers),
+        'SalesOrderDetail': pd.DataFrame(details),
+        'SalesTerritory': pd.DataFrame(reference.territories),
+        'Customers': pd.DataFrame(reference.customers),
+        'IndividualCustomers': pd.DataFrame(reference.individuals),
+        'StoreCustomers': pd.DataFrame([{'BusinessEntityID': 292, 'Name': 'Next-Door Bike Store', 'City': 'Seattle'}]),
+    }
+    with pd.ExcelWriter(path) as writer:
+        for name, frame in sheets.items():
+            frame.to_excel(writer, sheet_name=name, index=False)
+    return {name: len(frame) for name, frame in sheets.items()}
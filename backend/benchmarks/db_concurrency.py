@@ -0,0 +1,147 @@
+"""Measures concurrent write throughput with and without the SQLite tuning.
+
+Each writer thread saves orders the way an upload does: a duplicate check
+on SalesOrderNumber, then a header and its detail rows, in one transaction.
+Meanwhile reader threads keep listing the latest orders with their details,
+as the order list endpoint does.
+The same load runs against a fresh database file with SQLAlchemy's default
+engine ("baseline") and with the engine options, PRAGMAs and BEGIN mode
+from app/database.py ("tuned").
+
+    poetry run python benchmarks/db_concurrency.py --threads 8 --orders 200
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import create_engine, func, insert, select
+from sqlalchemy.exc import OperationalError
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app.database import WRITE_OPTIONS, db, engine_options, sqlite_pragmas, tune_sqlite  # noqa: E402
+from app import models  # noqa: E402
+
+HEADER = models.SalesOrderHeader.__table__
+DETAIL = models.SalesOrderDetail.__table__
+
+
+def save_order(engine, number, lines):
+    # Opened as a write transaction, like begin_write does for the app's saves.
+    with engine.execution_options(**WRITE_OPTIONS).begin() as connection:
+        exists = connection.execute(select(HEADER.c.SalesOrderID).where(HEADER.c.SalesOrderNumber == number)).first()
+        if exists:
+            return
+        order_id = connection.execute(insert(HEADER).values(
+            SalesOrderNumber=number, OrderDate=datetime(2024, 1, 15), DueDate=datetime(2024, 1, 27),
+            CustomerID=1, SubTotal=100.0 * lines, TaxAmt=8.0, Freight=2.5, TotalDue=100.0 * lines + 10.5,
+            RevisionNumber=0,
+        )).inserted_primary_key[0]
+        connection.execute(insert(DETAIL), [
+            {'SalesOrderID': order_id, 'OrderQty': 1, 'ProductID': 1, 'UnitPrice': 100.0, 'LineTotal': 100.0}
+            for _ in range(lines)
+        ])
+
+
+def list_orders(engine):
+    with engine.connect() as connection:
+        latest = select(HEADER.c.SalesOrderID).order_by(HEADER.c.OrderDate.desc(), HEADER.c.SalesOrderID.desc()).limit(50)
+        connection.execute(
+            select(HEADER, func.count(DETAIL.c.SalesOrderDetailID))
+            .outerjoin(DETAIL, DETAIL.c.SalesOrderID == HEADER.c.SalesOrderID)
+            .where(HEADER.c.SalesOrderID.in_(latest))
+            .group_by(HEADER.c.SalesOrderID)
+        ).all()
+
+
+def run(engine, threads, orders, lines, readers):
+    db.metadata.create_all(engine)
+    errors = []
+    reads = []
+    writing = threading.Event()
+    barrier = threading.Barrier(threads + readers)
+
+    def writer(index):
+        barrier.wait()
+        for n in range(orders):
+            try:
+                save_order(engine, f'SO-{index}-{n}', lines)
+            except OperationalError as e:
+                errors.append(str(e.orig))
+
+    def reader():
+        barrier.wait()
+        while writing.is_set():
+            try:
+                list_orders(engine)
+                reads.append(1)
+            except OperationalError as e:
+                errors.append(str(e.orig))
+
+    writing.set()
+    writers = [threading.Thread(target=writer, args=(i,)) for i in range(threads)]
+    pool = writers + [threading.Thread(target=reader) for _ in range(readers)]
+    start = time.perf_counter()
+    for thread in pool:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    seconds = time.perf_counter() - start
+    writing.clear()
+    for thread in pool:
+        thread.join()
+    engine.dispose()
+
+    with engine.connect() as connection:
+        saved = connection.execute(select(func.count()).select_from(HEADER)).scalar()
+    engine.dispose()
+    return {
+        'seconds': round(seconds, 3),
+        'orders_saved': saved,
+        'orders_failed': threads * orders - saved,
+        'orders_per_second': round(saved / seconds, 1),
+        'reads_per_second': round(len(reads) / seconds, 1),
+        'errors': len(errors),
+        'first_error': errors[0] if errors else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=8, help="concurrent writers")
+    parser.add_argument('--readers', type=int, default=4, help="concurrent readers listing orders")
+    parser.add_argument('--orders', type=int, default=200, help="orders saved per thread")
+    parser.add_argument('--lines', type=int, default=3, help="detail rows per order")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for mode in ('baseline', 'tuned'):
+            url = 'sqlite:///' + os.path.join(directory, f'{mode}.db')
+            if mode == 'baseline':
+                engine = create_engine(url)
+            else:
+                engine = create_engine(url, **engine_options(url, pool_size=args.threads + args.readers))
+                tune_sqlite(engine, sqlite_pragmas())
+            results[mode] = run(engine, args.threads, args.orders, args.lines, args.readers)
+            result = results[mode]
+            print(
+                f"{mode:>8}: {result['orders_per_second']:>8} orders/s, {result['reads_per_second']:>8} reads/s, "
+                f"{result['orders_saved']} saved, {result['errors']} lock errors in {result['seconds']}s"
+                + (f" (first error: {result['first_error']})" if result['first_error'] else '')
+            )
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'threads': args.threads, 'readers': args.readers, 'orders': args.orders, 'lines': args.lines, **results
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""Runs the benchmark scenarios against the fake model and writes the results as JSON.
+
+Each scenario runs in its own process, on its own temporary database, so
+that peak RSS and database state belong to that scenario alone.
+
+    cd backend
+    poetry run python -m benchmarks.run                      # every scenario
+    poetry run python -m benchmarks.run single_upload --latency 0.5
+    poetry run python -m benchmarks.run --output after.json --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Metrics where a lower number is better; everything else is higher-is-better.
+LOWER_IS_BETTER = ('p50', 'p95', 'p99', 'mean', 'max', 'seconds', 'load_s', 'peak_rss_mb', 'errors')
+
+
+def build_parser():
+    from .scenarios import SCENARIOS
+
+    parser = argparse.ArgumentParser(description="Benchmark the backend against a fake Gemini model.")
+    parser.add_argument('scenarios', nargs='*', choices=[[], *SCENARIOS], default=[],
+                        help=f"scenarios to run (default: all of {', '.join(SCENARIOS)})")
+    parser.add_argument('--requests', type=int, default=50, help="uploads or edits per scenario")
+    parser.add_argument('--concurrency', type=int, default=8, help="clients in concurrent_uploads")
+    parser.add_argument('--lines', type=int, default=5, help="line items per invoice")
+    parser.add_argument('--large-lines', type=int, default=500, help="line items per invoice in large_invoice")
+    parser.add_argument('--latency', type=float, default=0.2, help="seconds the fake model takes per call")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="share of fake model calls that fail")
+    parser.add_argument('--rpm', type=float, default=0,
+                        help="model requests per minute the app's rate limiter allows (default: unlimited)")
+    parser.add_argument('--escalation-rate', type=float, default=0.1,
+                        help="share of uploads the fast model gets wrong, sending them on to the pro model")
+    parser.add_argument('--products', type=int, default=2000, help="products in the seeded database")
+    parser.add_argument('--customers', type=int, default=5000, help="customers in the seeded database")
+    parser.add_argument('--seed-orders', type=int, default=5000, help="orders in the db_seed workbook")
+    parser.add_argument('--seed', type=int, default=0, help="random seed for generated data")
+    parser.add_argument('--output', default='benchmark-results.json', help="where to write the results")
+    parser.add_argument('--compare', help="earlier results file to compare against")
+    parser.add_argument('--verbose', action='store_true', help="show the app's own output")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--child-output', help=argparse.SUPPRESS)
+    return parser
+
+
+def run_child(options):
+    """Runs one scenario in this process and writes its metrics to --child-output."""
+    directory = tempfile.mkdtemp()
+    os.environ.update({
+        'MODEL_BACKEND': 'fake',
+        'DATABASE_URL': 'sqlite:///' + os.path.join(directory, 'bench.db'),
+        'JOBS_DATABASE': os.path.join(directory, 'jobs.db'),
+        # Every upload would otherwise be a cache hit on the same image.
+        'EXTRACTION_CACHE_SIZE': '0',
+        'MODEL_RPM': str(options.rpm),
+        'TESTING': 'false',
+    })
+    sys.path.insert(0, BACKEND_DIR)
+    from app.main import create_app
+    from .scenarios import SCENARIOS, Context
+
+    context = Context(create_app(), options)
+    result = SCENARIOS[options.child](context)
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result['peak_rss_mb'] = round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+    with open(options.child_output, 'w') as f:
+        json.dump(result, f)
+
+
+def run_scenario(name, argv, verbose):
+    with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+        output = f.name
+    try:
+        command = [sys.executable, '-m', 'benchmarks.run', *argv, '--child', name, '--child-output', output]
+        output_stream = None if verbose else subprocess.DEVNULL
+        completed = subprocess.run(command, cwd=BACKEND_DIR, stdout=output_stream, stderr=output_stream)
+        if completed.returncode != 0:
+            return {'error': f'scenario exited with status {completed.returncode}; rerun with --verbose'}
+        with open(output) as f:
+            return json.load(f)
+    finally:
+        os.unlink(output)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def _flatten(metrics, prefix=''):
+    for key, value in metrics.items():
+        if isinstance(value, dict):
+            yield from _flatten(value, f'{prefix}{key}.')
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield f'{prefix}{key}', value
+
+
+def compare(results, baseline):
+    """Prints each metric next to the baseline's, flagging changes of more than 10%."""
+    for name, metrics in results['scenarios'].items():
+        before = dict(_flatten(baseline.get('scenarios', {}).get(name, {})))
+        if not before:
+            continue
+        print(f"\n{name} (vs {baseline.get('git_commit') or 'baseline'})")
+        for key, value in _flatten(metrics):
+            old = before.get(key)
+            if old in (None, 0):
+                continue
+            change = (value - old) / old * 100
+            worse = change > 0 if key.endswith(LOWER_IS_BETTER) else change < 0
+            flag = ' <-- regression' if worse and abs(change) > 10 else ''
+            print(f"  {key:<28} {old:>12} -> {value:<12} ({change:+.1f}%){flag}")
+
+
+def main():
+    options = build_parser().parse_args()
+    if options.child:
+        run_child(options)
+        return
+
+    from .scenarios import SCENARIOS
+
+    # Forward every option except the positional scenario names to the child processes.
+    argv = [arg for arg in sys.argv[1:] if arg not in SCENARIOS]
+    results = {
+        'started_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'git_commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'options': {key: value for key, value in vars(options).items()
+                    if key not in ('scenarios', 'output', 'compare', 'verbose', 'child', 'child_output')},
+        'scenarios': {},
+    }
+    for name in options.scenarios or SCENARIOS:
+        print(f"Running {name}...", flush=True)
+        start = time.perf_counter()
+        results['scenarios'][name] = metrics = run_scenario(name, argv, options.verbose)
+        print(f"  done in {time.perf_counter() - start:.1f}s: {json.dumps(metrics)}")
+
+    with open(options.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {options.output}")
+
+    if options.compare:
+        with open(options.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+"""Benchmark scenarios. Each one runs against a freshly seeded app and returns its metrics."""
+import io
+import itertools
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from app.database import db
+from app.fake_model import FakeGenerativeModel
+from .datagen import ReferenceData, invoice_image, invoice_payload, write_workbook
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of `values`."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[rank]
+
+
+def summarize(latencies, errors, seconds, served_by=None):
+    latencies_ms = [latency * 1000 for latency in latencies]
+    return {
+        **({'served_by': served_by} if served_by else {}),
+        'requests': len(latencies),
+        'errors': errors,
+        'seconds': round(seconds, 3),
+        'throughput_per_s': round(len(latencies) / seconds, 2) if seconds else None,
+        'latency_ms': {
+            'p50': round(percentile(latencies_ms, 50), 2),
+            'p95': round(percentile(latencies_ms, 95), 2),
+            'p99': round(percentile(latencies_ms, 99), 2),
+            'mean': round(sum(latencies_ms) / len(latencies_ms), 2),
+            'max': round(max(latencies_ms), 2),
+        } if latencies_ms else None,
+    }
+
+
+class Context:
+    """What a scenario needs: the app, its reference data and the run's options."""
+
+    def __init__(self, app, options):
+        self.app = app
+        self.options = options
+        self.reference = ReferenceData(options.products, options.customers, seed=options.seed)
+        self._numbers = itertools.count(1)
+        self._uploads = itertools.count(1)
+        self._lock = threading.Lock()
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            self.reference.seed_database()
+
+    def next_order_number(self):
+        with self._lock:
+            return f"SO-BENCH-{next(self._numbers)}"
+
+    def use_fake_model(self, lines):
+        """Points the app at a fake model that returns a new invoice with `lines` lines per call.
+
+        Every model in the cascade but the last gets the totals wrong
+        `escalation_rate` of the time, so that share of uploads is escalated.
+        """
+        rng = random.Random(self.options.seed)
+        lock = threading.Lock()
+        final_model = self.app.config['MODEL_CASCADE'][-1]
+
+        def response(model_name):
+            with lock:
+                payload = invoice_payload(rng, self.reference, self.next_order_number(), lines)
+                if model_name != final_model and rng.random() < self.options.escalation_rate:
+                    payload['SalesOrderHeader']['SubTotal'] += 1
+            return payload
+
+        self.app.config['MODEL_FACTORY'] = lambda name, **kwargs: FakeGenerativeModel(
+            name, response=lambda: response(name), latency=self.options.latency,
+            failure_rate=self.options.failure_rate, **kwargs
+        )
+
+    def upload(self, client, image):
+        # Bytes after the JPEG end marker are ignored by decoders but make every
+        # upload distinct, so concurrent ones aren't coalesced into one model call.
+        image += f'upload-{next(self._uploads)}'.encode()
+        start = time.perf_counter()
+        response = client.post('/api/upload', data={'file': (io.BytesIO(image), 'invoice.jpg')},
+                               content_type='multipart/form-data')
+        return time.perf_counter() - start, response
+
+
+def _run_uploads(context, requests, concurrency, lines):
+    context.use_fake_model(lines)
+    image = invoice_image(rows=min(lines, 60), seed=context.options.seed)
+    latencies = []
+    errors = 0
+    served_by = {}
+    lock = threading.Lock()
+
+    def one(_):
+        nonlocal errors
+        latency, response = context.upload(context.app.test_client(), image)
+        with lock:
+            latencies.append(latency)
+            if response.status_code != 200:
+                errors += 1
+            else:
+                model = response.get_json()['model']['served_by']
+                served_by[model] = served_by.get(model, 0) + 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(requests)))
+    return summarize(latencies, errors, time.perf_counter() - start, served_by)
+
+
+def single_upload(context):
+    """Sequential uploads through /api/upload: preprocessing, model call, save."""
+    return _run_uploads(context, context.options.requests, 1, context.options.lines)
+
+
+def concurrent_uploads(context):
+    """The same uploads from `concurrency` clients at once."""
+    return _run_uploads(context, context.options.requests, context.options.concurrency, context.options.lines)
+
+
+def large_invoice(context):
+    """Uploads of invoices with `large_lines` line items each."""
+    requests = max(5, context.options.requests // 5)
+    return _run_uploads(context, requests, 1, context.options.large_lines)
+
+
+def update_churn(context):
+    """Repeated small edits of one order through PATCH /api/sales_order/<id>.
+
+    Each edit changes two quantities, adds a line and removes a line, the
+    way someone correcting an extraction would.
+    """
+    context.use_fake_model(context.options.lines * 4)
+    client = context.app.test_client()
+    _, response = context.upload(client, invoice_image(seed=context.options.seed))
+    order = response.get_json()['data']
+    rng = random.Random(context.options.seed)
+
+    latencies = []
+    errors = 0
+    start = time.perf_counter()
+    for _ in range(context.options.requests):
+        details = order['SalesOrderDetail']
+        for detail in rng.sample(details, min(2, len(details))):
+            detail['OrderQty'] = rng.randint(1, 10)
+        details.pop(rng.randrange(len(details)))
+        product = rng.choice(context.reference.products)
+        details.append({'ProductNumber': product['ProductNumber'], 'OrderQty': 1, 'UnitPrice': product['ListPrice']})
+
+        edit_start = time.perf_counter()
+        response = client.patch(f"/api/sales_order/{order['SalesOrderHeader']['SalesOrderID']}", json=order)
+        latencies.append(time.perf_counter() - edit_start)
+        if response.status_code == 200:
+            order = response.get_json()['data']
+        else:
+            errors += 1
+    return summarize(latencies, errors, time.perf_counter() - start)
+
+
+def db_seed(context):
+    """A full database_setup.py load of a generated workbook, then an incremental reload."""
+    import database_setup
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'workbook.xlsx')
+        rows = write_workbook(path, context.reference, orders=context.options.seed_orders, seed=context.options.seed)
+        total_rows = sum(rows.values())
+
+        start = time.perf_counter()
+        database_setup.setup_database(path)
+        full = time.perf_counter() - start
+
+        start = time.perf_counter()
+        database_setup.setup_database(path, incremental=True)
+        incremental = time.perf_counter() - start
+
+    return {
+        'rows': total_rows,
+        'full_load_s': round(full, 3),
+        'full_rows_per_s': round(total_rows / full, 1),
+        'incremental_load_s': round(incremental, 3),
+        'incremental_rows_per_s': round(total_rows / incremental, 1),
+    }
+
+
+SCENARIOS = {
+    'single_upload': single_upload,
+    'concurrent_uploads': concurrent_uploads,
+    'large_invoice': large_invoice,
+    'update_churn': update_churn,
+    'db_seed': db_seed,
+}
@@ -0,0 +1,125 @@
+"""Measures how long the backend takes to import and start, in fresh processes.
+
+Each probe runs in a new interpreter, so nothing is already imported, and
+is repeated `--runs` times after a warm-up run. The median is reported
+along with which of the heavy dependencies the probe ended up loading. With `--baseline`
+the same probes also run against an earlier commit (exported with
+`git archive`), and the change is printed.
+
+    poetry run python benchmarks/startup.py
+    poetry run python benchmarks/startup.py --baseline HEAD~1 --runs 9
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that are slow to import and only needed for some of the work.
+HEAVY_MODULES = ('google.generativeai', 'google.api_core', 'grpc', 'pandas', 'numpy', 'PIL')
+
+# What each probe times. `app` is set at import time by older trees and
+# built by create_app in newer ones, so app_ready accepts either.
+PROBES = {
+    'import_app': 'import app.main',
+    'app_ready': "import app.main\ngetattr(app.main, 'app', None) or app.main.create_app()",
+    'import_database_setup': 'import database_setup',
+}
+
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+exec(compile({code!r}, '<probe>', 'exec'))
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'loaded': [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def probe(tree, code, env):
+    completed = subprocess.run(
+        [sys.executable, '-c', CHILD.format(code=code, heavy=HEAVY_MODULES)],
+        cwd=tree, env=env, capture_output=True, text=True,
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(f'probe failed in {tree}:\n{completed.stderr}')
+    # The app prints while starting; the result is the last line.
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def measure(tree, runs, env):
+    results = {}
+    for name, code in PROBES.items():
+        # A first run compiles the tree's bytecode and warms the OS file cache.
+        probe(tree, code, env)
+        samples = [probe(tree, code, env) for _ in range(runs)]
+        results[name] = {
+            'median_ms': round(statistics.median(sample['seconds'] for sample in samples) * 1000, 1),
+            'min_ms': round(min(sample['seconds'] for sample in samples) * 1000, 1),
+            'loaded': samples[-1]['loaded'],
+        }
+    return results
+
+
+def export(ref, directory):
+    """Writes the backend directory as it was at `ref` into `directory`; returns its path."""
+    top, prefix = subprocess.run(['git', 'rev-parse', '--show-toplevel', '--show-prefix'], cwd=BACKEND_DIR,
+                                 capture_output=True, text=True, check=True).stdout.splitlines()
+    archive = os.path.join(directory, 'baseline.tar')
+    # Run from the top of the repository; git archive rejects a tree path from a subdirectory.
+    subprocess.run(['git', 'archive', '--format=tar', '-o', archive, f'{ref}:{prefix}'], cwd=top, check=True)
+    tree = os.path.join(directory, 'baseline')
+    with tarfile.open(archive) as tar:
+        tar.extractall(tree)
+    return tree
+
+
+def report(label, results):
+    print(label)
+    for name, result in results.items():
+        loaded = ', '.join(result['loaded']) or 'none'
+        print(f"  {name:<22} {result['median_ms']:>8.1f} ms median, {result['min_ms']:>8.1f} ms min; heavy modules: {loaded}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help="fresh processes per probe")
+    parser.add_argument('--baseline', help="git commit to compare against, e.g. HEAD~1")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        # A throwaway database and the fake model, so probes never touch real data or the API.
+        env = {
+            **os.environ,
+            'MODEL_BACKEND': 'fake',
+            'DATABASE_URL': 'sqlite:///' + os.path.join(directory, 'startup.db'),
+            'JOBS_DATABASE': os.path.join(directory, 'jobs.db'),
+            'EXTRACTION_CACHE_PATH': '',
+        }
+        results = {'current': measure(BACKEND_DIR, args.runs, env)}
+        if args.baseline:
+            results['baseline'] = measure(export(args.baseline, directory), args.runs, env)
+
+    if 'baseline' in results:
+        report(f"baseline ({args.baseline})", results['baseline'])
+    report('current', results['current'])
+    if 'baseline' in results:
+        print('change')
+        for name, result in results['current'].items():
+            before = results['baseline'][name]['median_ms']
+            after = result['median_ms']
+            print(f"  {name:<22} {before:>8.1f} -> {after:<8.1f} ms ({(after - before) / before * 100:+.1f}%, "
+                  f"{before / after:.1f}x faster)")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'runs': args.runs, 'baseline_ref': args.baseline, **results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,70 +1,233 @@
-import pandas as pd
+import argparse
 import os
-from app.main import app
-from app.database import db
+import time
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from dotenv import load_dotenv
+from flask import Flask
+from sqlalchemy import Boolean, DateTime, Float, Integer, String, insert, or_
+from app.analytics import rebuild_rollups
+from app.database import configure_database, db
 from app.models import (
-    Product, ProductCategory, ProductSubCategory, SalesOrderHeader, 
+    Product, ProductCategory, ProductSubCategory, SalesOrderHeader,
     SalesOrderDetail, SalesTerritory, Customer, IndividualCustomer, StoreCustomers
 )
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateIndex
+
+EXCEL_PATH = os.path.join(os.path.dirname(__file__), 'data', 'Business Analytics - Case Study Data.xlsx')
+# The database the API uses by default (see app/main.py)
+DATABASE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app', 'database.db')
+
+# Define the mapping from sheet name to model
+SHEET_TO_MODEL = {
+    'Product': Product,
+    'ProductCategory': ProductCategory,
+    'ProductSubCategory': ProductSubCategory,
+    'SalesOrderHeader': SalesOrderHeader,
+    'SalesOrderDetail': SalesOrderDetail,
+    'SalesTerritory': SalesTerritory,
+    'Customers': Customer,
+    'IndividualCustomers': IndividualCustomer,
+    'StoreCustomers': StoreCustomers
+}
+
+TRUE_VALUES = {'true', '1', 'yes', 'y', 't'}
+FALSE_VALUES = {'false', '0', 'no', 'n', 'f'}
 
-def setup_database():
+
+def read_sheet(excel_path, sheet_name):
+    """Reads one sheet and sanitizes its column names to match model attributes.
+
+    Runs in a worker process, so it returns the read time alongside the frame.
     """
-    This function drops all existing tables, creates new ones based on the models,
-    and then populates them from the Excel file.
+    start = time.perf_counter()
+    df = pd.read_excel(excel_path, sheet_name=sheet_name)
+    df.columns = df.columns.str.replace(' ', '').str.replace('[^A-Za-z0-9_]', '', regex=True)
+    return df, time.perf_counter() - start
+
+
+def _to_bool(series):
+    if pd.api.types.is_bool_dtype(series):
+        return series
+    if pd.api.types.is_numeric_dtype(series):
+        return series.map(lambda value: None if pd.isna(value) else bool(value))
+    lowered = series.astype('string').str.strip().str.lower()
+    return lowered.map(lambda value: True if value in TRUE_VALUES else False if value in FALSE_VALUES else None)
+
+
+def coerce_frame(df, model):
+    """Converts a sheet to the column types declared on `model`.
+
+    Each column is converted in one vectorized step. Missing values (NaN, NaT,
+    blank cells) become None so they are written as NULL. Returns the rows
+    as a list of dicts holding plain Python values, ready for executemany.
     """
-    with app.app_context():
-        print("Dropping all tables...")
-        db.drop_all()
+    columns = model.__table__.columns
+    unknown = [name for name in df.columns if name not in columns]
+    if unknown:
+        print(f"  Ignoring columns not on {model.__tablename__}: {', '.join(unknown)}")
+        df = df.drop(columns=unknown)
+
+    converted = {}
+    for name in df.columns:
+        series = df[name]
+        column_type = columns[name].type
+        if isinstance(column_type, DateTime):
+            series = pd.to_datetime(series, errors='coerce')
+        elif isinstance(column_type, Boolean):
+            series = _to_bool(series)
+        elif isinstance(column_type, Integer):
+            series = pd.to_numeric(series, errors='coerce').round().astype('Int64')
+        elif isinstance(column_type, Float):
+            series = pd.to_numeric(series, errors='coerce').astype('float64')
+        elif isinstance(column_type, String):
+            # Numeric-looking text (postal codes, account numbers) stays text.
+            series = series.map(lambda value: None if pd.isna(value) else str(value))
+        converted[name] = series.astype(object).where(series.notna(), None)
+
+    return pd.DataFrame(converted, index=df.index).to_dict(orient='records')
+
+
+def _chunks(rows, size):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+def _upsert_statement(table):
+    """INSERT ... ON CONFLICT (pk) DO UPDATE that only touches changed rows."""
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    statement = dialect_insert(table)
+    primary_keys = [column.name for column in table.primary_key.columns]
+    updatable = [column for column in table.columns if column.name not in primary_keys]
+    return statement.on_conflict_do_update(
+        index_elements=primary_keys,
+        set_={column.name: statement.excluded[column.name] for column in updatable},
+        where=or_(*(column.is_distinct_from(statement.excluded[column.name]) for column in updatable)),
+    )
+
+
+def write_rows(model, rows, chunk_size, incremental):
+    """Writes the rows through Core executemany in chunks and commits once."""
+    table = model.__table__
+    if not rows:
+        return
+    primary_keys = [column.name for column in table.primary_key.columns]
+    has_keys = all(name in rows[0] for name in primary_keys)
+
+    if incremental and has_keys:
+        statement = _upsert_statement(table)
+    else:
+        if incremental:
+            # Surrogate-key tables (e.g. IndividualCustomers) have no key in the
+            # sheet to match on, so they are replaced wholesale.
+            print(f"  {table.name} has no primary key column in the sheet; replacing its rows.")
+            db.session.execute(table.delete())
+        statement = insert(table)
+
+    for chunk in _chunks(rows, chunk_size):
+        db.session.execute(statement, chunk)
+    db.session.commit()
+
+
+def create_setup_app():
+    """A bare Flask app bound to the API's database.
+
+    The API's own app (app.main.create_app) would also build the model
+    client, caches and routes, none of which a load needs.
+    """
+    load_dotenv()
+    app = Flask(__name__)
+    configure_database(app, DATABASE_PATH)
+    return app
+
+
+def setup_database(excel_path=EXCEL_PATH, incremental=False, workers=None, chunk_size=5000):
+    """
+    Populates the database from the Excel file.
+
+    By default all tables are dropped and recreated first. With `incremental`
+    the tables are kept and each sheet is upserted, so only new or changed
+    rows are written. Sheets are read in parallel worker processes, and then
+    written one at a time in foreign-key order because SQLite allows a
+    single writer. Finally the analytics rollups are rebuilt from the loaded
+    orders.
+    """
+    with create_setup_app().app_context():
+        if incremental:
+            print("Incremental load: keeping existing tables.")
+        else:
+            print("Dropping all tables...")
+            db.drop_all()
         print("Creating all tables from models...")
         db.create_all()
+        if incremental:
+            # create_all skips existing tables along with their indexes, so
+            # indexes added to the models since the last load are created here.
+            # IF NOT EXISTS rather than checkfirst, because SQLite reflection
+            # doesn't report expression indexes like the customer name one.
+            with db.engine.begin() as connection:
+                for table in db.metadata.sorted_tables:
+                    for index in table.indexes:
+                        connection.execute(CreateIndex(index, if_not_exists=True))
 
-        excel_path = os.path.join(os.path.dirname(__file__), 'data', 'Business Analytics - Case Study Data.xlsx')
-        
-        try:
-            xls = pd.ExcelFile(excel_path)
-            print("Excel file loaded successfully.")
-        except FileNotFoundError:
+        if not os.path.exists(excel_path):
             print(f"Error: The file at {excel_path} was not found.")
             return
 
-        # Define the mapping from sheet name to model and sanitize function
-        sheet_to_model = {
-            'Product': Product,
-            'ProductCategory': ProductCategory,
-            'ProductSubCategory': ProductSubCategory,
-            'SalesOrderHeader': SalesOrderHeader,
-            'SalesOrderDetail': SalesOrderDetail,
-            'SalesTerritory': SalesTerritory,
-            'Customers': Customer,
-            'IndividualCustomers': IndividualCustomer,
-            'StoreCustomers': StoreCustomers
-        }
-
-        for sheet_name, model in sheet_to_model.items():
-            print(f"Processing sheet: {sheet_name}")
-            try:
-                df = pd.read_excel(xls, sheet_name=sheet_name)
-                # Sanitize column names to match model attributes
-                df.columns = df.columns.str.replace(' ', '').str.replace('[^A-Za-z0-9_]', '', regex=True)
-                
-                # Convert DataFrame to a list of dictionaries and insert row by row
-                for record in df.to_dict(orient='records'):
-                    # The keys in `record` must match the attribute names in the model `model`
-                    obj = model(**record)
-                    db.session.add(obj)
-                
-                db.session.commit()
-                print(f"Successfully populated {model.__tablename__} table.")
-                
-            except IntegrityError as e:
-                db.session.rollback()
-                print(f"An integrity error occurred while processing {sheet_name}. This might be due to duplicate primary keys or other constraints. Error: {e}")
-            except Exception as e:
-                db.session.rollback()
-                print(f"Could not process sheet {sheet_name}. Error: {e}")
+        total_start = time.perf_counter()
+        table_order = {table.name: i for i, table in enumerate(db.metadata.sorted_tables)}
+        sheets = sorted(SHEET_TO_MODEL.items(), key=lambda item: table_order[item[1].__tablename__])
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {sheet_name: executor.submit(read_sheet, excel_path, sheet_name) for sheet_name, _ in sheets}
+            print(f"Reading {len(sheets)} sheets in parallel...")
+
+            for sheet_name, model in sheets:
+                print(f"Processing sheet: {sheet_name}")
+                try:
+                    df, read_seconds = futures[sheet_name].result()
+
+                    start = time.perf_counter()
+                    rows = coerce_frame(df, model)
+                    coerce_seconds = time.perf_counter() - start
+
+                    start = time.perf_counter()
+                    write_rows(model, rows, chunk_size, incremental)
+                    write_seconds = time.perf_counter() - start
+
+                    print(
+                        f"Successfully populated {model.__tablename__} table: {len(rows)} rows "
+                        f"(read {read_seconds:.2f}s, convert {coerce_seconds:.2f}s, write {write_seconds:.2f}s)."
+                    )
+
+                except IntegrityError as e:
+                    db.session.rollback()
+                    print(f"An integrity error occurred while processing {sheet_name}. This might be due to duplicate primary keys or other constraints. Error: {e}")
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Could not process sheet {sheet_name}. Error: {e}")
+
+        print(f"Loaded all sheets in {time.perf_counter() - total_start:.2f}s.")
+
+        start = time.perf_counter()
+        sales_rows, customer_rows = rebuild_rollups()
+        db.session.commit()
+        print(
+            f"Built analytics rollups: {sales_rows} sales rows, {customer_rows} customer rows "
+            f"in {time.perf_counter() - start:.2f}s."
+        )
 
     print("Database setup complete.")
 
 if __name__ == '__main__':
-    setup_database() 
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Create and populate the database from the Excel workbook.")
+    parser.add_argument('--incremental', action='store_true', help="upsert changed rows instead of dropping every table")
+    parser.add_argument('--workers', type=int, default=None, help="processes used to read sheets in parallel")
+    parser.add_argument('--chunk-size', type=int, default=5000, help="rows per executemany batch")
+    parser.add_argument('--excel', default=EXCEL_PATH, help="path to the workbook")
+    args = parser.parse_args()
+    setup_database(args.excel, incremental=args.incremental, workers=args.workers, chunk_size=args.chunk_size)
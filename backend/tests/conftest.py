@@ -0,0 +1,89 @@
+import io
+import pytest
+from PIL import Image
+from sqlalchemy import insert
+from app import models
+from app.database import db
+from app.fake_model import FakeGenerativeModel
+from app.main import create_app
+
+PRODUCTS = [
+    {'ProductID': 1, 'ProductNumber': 'BK-R93R-62', 'Name': 'Road-150 Red, 62', 'ListPrice': 50.0, 'ProductSubcategoryID': 1},
+    {'ProductID': 2, 'ProductNumber': 'FR-R92B-58', 'Name': 'HL Road Frame - Black, 58', 'ListPrice': 20.0, 'ProductSubcategoryID': 2},
+    {'ProductID': 3, 'ProductNumber': 'BK-0100', 'Name': 'Bike Zero', 'ListPrice': 10.0, 'ProductSubcategoryID': 1},
+    {'ProductID': 4, 'ProductNumber': 'BK-O100', 'Name': 'Bike Oh', 'ListPrice': 10.0, 'ProductSubcategoryID': 1},
+]
+
+
+def invoice(number, lines=(('BK-R93R-62', 2, 50.0),), tax=8.0, freight=2.5, order_date='2024-01-15'):
+    """An extraction whose totals add up, as a model that read the invoice correctly would return it."""
+    details = [
+        {'ProductNumber': product_number, 'OrderQty': quantity, 'UnitPrice': price, 'LineTotal': quantity * price}
+        for product_number, quantity, price in lines
+    ]
+    sub_total = sum(detail['LineTotal'] for detail in details)
+    return {
+        'SalesOrderHeader': {
+            'SalesOrderNumber': number,
+            'OrderDate': order_date,
+            'DueDate': order_date,
+            'TerritoryID': 1,
+            'SubTotal': sub_total,
+            'TaxAmt': tax,
+            'Freight': freight,
+            'TotalDue': sub_total + tax + freight,
+        },
+        'SalesOrderDetail': details,
+        'CustomerName': 'Jon Yang',
+    }
+
+
+def image_bytes(shade=255):
+    """A small PNG; images with different shades get different cache keys."""
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 64), (shade, shade, shade)).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    for name, value in {
+        'MODEL_BACKEND': 'fake',
+        'DATABASE_URL': f"sqlite:///{tmp_path / 'test.db'}",
+        'JOBS_DATABASE': str(tmp_path / 'jobs.db'),
+        'EXTRACTION_AUTOSTART': 'false',
+        'EXTRACTION_CACHE_SIZE': '0',
+        'PREPROCESS_ENABLED': 'false',
+        'REQUEST_LOG': 'false',
+        'MODEL_RETRY_BACKOFF': '0',
+        'TESTING': 'false',
+    }.items():
+        monkeypatch.setenv(name, value)
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        db.session.execute(insert(models.SalesTerritory), [{'TerritoryID': 1, 'Name': 'Northwest'}])
+        db.session.execute(insert(models.ProductCategory), [{'ProductCategoryID': 1, 'Name': 'Bikes'},
+                                                            {'ProductCategoryID': 2, 'Name': 'Components'}])
+        db.session.execute(insert(models.ProductSubCategory), [
+            {'ProductSubcategoryID': 1, 'ProductCategoryID': 1, 'Name': 'Road Bikes'},
+            {'ProductSubcategoryID': 2, 'ProductCategoryID': 2, 'Name': 'Road Frames'},
+        ])
+        db.session.execute(insert(models.Product), PRODUCTS)
+        db.session.execute(insert(models.Customer), [{'CustomerID': 1, 'PersonID': 100, 'TerritoryID': 1}])
+        db.session.execute(insert(models.IndividualCustomer), [
+            {'BusinessEntityID': 100, 'FirstName': 'Jon', 'LastName': 'Yang'},
+        ])
+        db.session.commit()
+        db.session.remove()
+    yield app
+    with app.app_context():
+        db.engine.dispose()
+
+
+@pytest.fixture
+def use_model(app):
+    """Sets the response every model gives: use_model(response, **FakeGenerativeModel options)."""
+    def use(response=None, **kwargs):
+        app.config['MODEL_FACTORY'] = lambda name, **options: FakeGenerativeModel(name, response, **kwargs, **options)
+    return use
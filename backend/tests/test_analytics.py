@@ -0,0 +1,88 @@
+import pytest
+from sqlalchemy import select
+from app import models
+from app.analytics import rebuild_rollups
+from app.database import db
+from app.extraction import save_extracted_data
+from conftest import invoice
+
+
+def _rollups():
+    """The live rollup rows; rows left at zero by update_rollups are skipped, as the queries do."""
+    sales = {
+        (row.Grain, row.Period, row.TerritoryID, row.ProductCategoryID): (round(row.Revenue, 4), row.Quantity, row.Lines)
+        for row in db.session.scalars(select(models.SalesRollup))
+        if row.Lines
+    }
+    customers = {
+        row.CustomerID: (round(row.Revenue, 4), row.Orders, row.Quantity)
+        for row in db.session.scalars(select(models.CustomerRollup))
+        if row.Orders
+    }
+    return sales, customers
+
+
+def _rebuilt():
+    """The rollups as rebuild_rollups computes them from scratch, without keeping them."""
+    try:
+        rebuild_rollups()
+        return _rollups()
+    finally:
+        db.session.rollback()
+
+
+@pytest.fixture
+def order_ids(app):
+    with app.app_context():
+        ids = [
+            save_extracted_data(invoice('SO1', lines=(('BK-R93R-62', 2, 50.0), ('FR-R92B-58', 1, 20.0))))
+            ['SalesOrderHeader']['SalesOrderID'],
+            save_extracted_data(invoice('SO2', lines=(('BK-R93R-62', 1, 50.0),), order_date='2024-02-03'))
+            ['SalesOrderHeader']['SalesOrderID'],
+        ]
+        db.session.remove()
+    return ids
+
+
+def test_saving_orders_adds_them(app, order_ids):
+    with app.app_context():
+        sales, customers = _rollups()
+        assert sales[('month', '2024-01', 1, 1)] == (100.0, 2, 1)
+        assert sales[('month', '2024-01', 1, 2)] == (20.0, 1, 1)
+        assert sales[('day', '2024-02-03', 1, 1)] == (50.0, 1, 1)
+        assert customers[1] == (170.0, 2, 4)
+        assert (sales, customers) == _rebuilt()
+
+
+def test_editing_an_order_moves_it(app, order_ids):
+    client = app.test_client()
+    order = client.get(f'/api/sales_order/{order_ids[0]}').get_json()
+    line = order['SalesOrderDetail'][0]
+    response = client.patch(f'/api/sales_order/{order_ids[0]}', json={
+        'SalesOrderHeader': {'RevisionNumber': 0, 'OrderDate': '2024-03-01'},
+        'SalesOrderDetail': [{'SalesOrderDetailID': line['SalesOrderDetailID'], 'ProductNumber': 'BK-R93R-62',
+                              'OrderQty': 5, 'UnitPrice': 50.0}],
+    })
+    assert response.status_code == 200, response.get_json()
+
+    with app.app_context():
+        sales, customers = _rollups()
+        assert ('month', '2024-01', 1, 1) not in sales
+        assert ('month', '2024-01', 1, 2) not in sales
+        assert sales[('month', '2024-03', 1, 1)] == (250.0, 5, 1)
+        assert customers[1] == (300.0, 2, 6)
+        assert (sales, customers) == _rebuilt()
+
+
+def test_deleting_orders_takes_them_away(app, order_ids):
+    client = app.test_client()
+    assert client.delete(f'/api/sales_order/{order_ids[0]}').status_code == 200
+
+    with app.app_context():
+        sales, customers = _rollups()
+        assert customers[1] == (50.0, 1, 1)
+        assert (sales, customers) == _rebuilt()
+
+    assert client.delete(f'/api/sales_order/{order_ids[1]}').status_code == 200
+    with app.app_context():
+        assert _rollups() == ({}, {}) == _rebuilt()
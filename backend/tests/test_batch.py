@@ -0,0 +1,64 @@
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from app import models
+from app.batch import process_batch
+from app.database import db
+from conftest import image_bytes, invoice
+
+
+def _documents(count):
+    return [(f'invoice-{index}.png', image_bytes(shade=200 + index)) for index in range(count)]
+
+
+def _responses(*payloads):
+    """A model response that hands out `payloads` in turn, one per call."""
+    remaining = iter(payloads)
+    lock = threading.Lock()
+
+    def respond():
+        with lock:
+            return next(remaining)
+    return respond
+
+
+def test_bad_documents_fail_on_their_own(app, use_model):
+    app.config['MODEL_CASCADE'] = ['gemini-2.5-flash']
+    use_model(_responses(invoice('SO1'), 'not json', invoice('SO1'), invoice('SO2')))
+
+    with app.app_context():
+        results = process_batch(_documents(4), parallelism=1, commit_size=10)
+        numbers = db.session.scalars(db.select(models.SalesOrderHeader.SalesOrderNumber)).all()
+
+    assert [result['status'] for result in results] == ['success', 'error', 'error', 'success']
+    assert results[2]['status_code'] == 409
+    assert 'data' not in results[1] and 'data' not in results[2]
+    assert sorted(numbers) == ['SO1', 'SO2']
+
+
+def test_database_is_not_locked_while_the_group_is_extracting(app, use_model):
+    app.config['MODEL_CASCADE'] = ['gemini-2.5-flash']
+    with app.app_context():
+        path = db.engine.url.database
+    locked = []
+    payloads = iter([invoice('SO1'), invoice('SO2'), invoice('SO3')])
+
+    def respond():
+        # Give the batch time to write the documents extracted so far.
+        time.sleep(0.05)
+        with closing(sqlite3.connect(path, timeout=0, isolation_level=None)) as conn:
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                conn.execute('ROLLBACK')
+                locked.append(False)
+            except sqlite3.OperationalError:
+                locked.append(True)
+        return next(payloads)
+
+    use_model(respond)
+    with app.app_context():
+        results = process_batch(_documents(3), parallelism=1, commit_size=10)
+
+    assert [result['status'] for result in results] == ['success'] * 3
+    assert locked == [False] * 3
@@ -0,0 +1,87 @@
+import pytest
+from app import cache as cache_module
+from app.cache import ExtractionCache, cache_key
+from app.extraction import extract_document
+from app.fake_model import DEFAULT_RESPONSE, FakeGenerativeModel
+from conftest import image_bytes
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replaces time.time(), which the cache stamps and ages entries with, by a settable clock."""
+    now = [1000.0]
+    monkeypatch.setattr(cache_module.time, 'time', lambda: now[0])
+    return now
+
+
+def test_cache_key_depends_on_image_model_and_prompt():
+    key = cache_key(b'image', 'gemini-2.5-flash', 'prompt')
+    assert key == cache_key(b'image', 'gemini-2.5-flash', 'prompt')
+    assert key != cache_key(b'other image', 'gemini-2.5-flash', 'prompt')
+    assert key != cache_key(b'image', 'gemini-2.5-pro', 'prompt')
+    assert key != cache_key(b'image', 'gemini-2.5-flash', 'new prompt')
+    # The separators keep the parts from running into each other.
+    assert cache_key(b'image', 'ab', 'c') != cache_key(b'image', 'a', 'bc')
+
+
+def test_hits_are_copies():
+    cache = ExtractionCache()
+    cache.set('key', {'SalesOrderDetail': []})
+    cache.get('key')['SalesOrderDetail'].append('edited')
+    assert cache.get('key') == {'SalesOrderDetail': []}
+
+
+def test_entries_expire_after_ttl(clock):
+    cache = ExtractionCache(ttl=60)
+    cache.set('key', {'value': 1})
+
+    clock[0] += 59
+    assert cache.get('key') == {'value': 1}
+    clock[0] += 2
+    assert cache.get('key') is None
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['size']) == (1, 1, 0)
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ExtractionCache(max_entries=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c')) == (1, 3)
+    assert cache.stats()['evictions'] == 1
+
+
+def test_disk_tier_survives_a_new_cache_and_honours_ttl(tmp_path, clock):
+    path = str(tmp_path / 'cache.db')
+    ExtractionCache(ttl=60, path=path).set('key', {'value': 1})
+
+    cache = ExtractionCache(ttl=60, path=path)
+    assert cache.get('key') == {'value': 1}
+    assert cache.stats()['disk_hits'] == 1
+
+    clock[0] += 61
+    assert ExtractionCache(ttl=60, path=path).get('key') is None
+
+
+def test_repeated_document_is_served_from_the_cache(app):
+    calls = []
+    app.config['MODEL_CASCADE'] = ['gemini-2.5-flash']
+
+    def respond():
+        calls.append(1)
+        return DEFAULT_RESPONSE
+
+    app.config['MODEL_FACTORY'] = lambda name, **options: FakeGenerativeModel(name, respond, **options)
+    cache = ExtractionCache()
+
+    with app.app_context():
+        first = extract_document(image_bytes(), cache=cache)
+        second = extract_document(image_bytes(), cache=cache)
+        extract_document(image_bytes(shade=0), cache=cache)
+
+    assert first == second
+    assert len(calls) == 2
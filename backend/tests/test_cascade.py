@@ -0,0 +1,103 @@
+import io
+import pytest
+from types import SimpleNamespace
+from app.database import db
+from app.extraction import ExtractionError, run_cascade
+from app.fake_model import FakeGenerativeModel
+from app.lookup import get_lookup_index
+from conftest import image_bytes, invoice
+
+FLASH, PRO = SimpleNamespace(model_name='gemini-2.5-flash'), SimpleNamespace(model_name='gemini-2.5-pro')
+
+
+def _extract(results):
+    """extract(model, tokens) returning, or raising, `results[model name]`."""
+    def extract(model, tokens):
+        tokens['input_tokens'] = 10
+        result = results[model.model_name]
+        if isinstance(result, Exception):
+            raise result
+        return result
+    return extract
+
+
+def _misread():
+    data = invoice('SO1')
+    data['SalesOrderHeader']['TotalDue'] += 100
+    return data
+
+
+def test_valid_result_is_not_escalated(app):
+    usage, report = {}, {}
+    with app.app_context():
+        result = run_cascade([FLASH, PRO], _extract({'gemini-2.5-flash': invoice('SO1')}), usage, report)
+
+    assert result == invoice('SO1')
+    assert report['model']['served_by'] == 'gemini-2.5-flash'
+    assert not report['model']['escalated']
+    assert usage == {'input_tokens': 10}
+
+
+def test_result_failing_validation_escalates(app):
+    usage, report = {}, {}
+    with app.app_context():
+        result = run_cascade([FLASH, PRO], _extract({'gemini-2.5-flash': _misread(), 'gemini-2.5-pro': invoice('SO1')}),
+                             usage, report)
+
+    assert result == invoice('SO1')
+    assert report['model']['served_by'] == 'gemini-2.5-pro'
+    assert report['model']['escalated']
+    assert report['model']['attempts'][0]['problems']
+    assert report['model']['attempts'][1]['problems'] == []
+    # Both calls are paid for.
+    assert usage == {'input_tokens': 20}
+
+
+def test_unparseable_result_escalates(app):
+    report = {}
+    with app.app_context():
+        result = run_cascade(
+            [FLASH, PRO],
+            _extract({'gemini-2.5-flash': ExtractionError('No JSON found.'), 'gemini-2.5-pro': invoice('SO1')}),
+            {}, report,
+        )
+
+    assert result == invoice('SO1')
+    assert report['model']['attempts'][0]['problems'] == ['No JSON found.']
+
+
+def test_last_model_is_used_whatever_its_problems(app):
+    report = {}
+    with app.app_context():
+        result = run_cascade([FLASH, PRO], _extract({'gemini-2.5-flash': _misread(), 'gemini-2.5-pro': _misread()}),
+                             {}, report)
+        with pytest.raises(ExtractionError):
+            run_cascade(
+                [FLASH, PRO],
+                _extract({'gemini-2.5-flash': _misread(), 'gemini-2.5-pro': ExtractionError('No JSON found.')}),
+                {}, {},
+            )
+
+    assert result == _misread()
+    assert report['model']['served_by'] == 'gemini-2.5-pro'
+    assert report['model']['attempts'][1]['problems']
+
+
+def test_upload_escalates_to_pro(app):
+    responses = {'gemini-2.5-flash': _misread(), 'gemini-2.5-pro': invoice('SO1')}
+    app.config['MODEL_FACTORY'] = lambda name, **options: FakeGenerativeModel(name, responses[name], **options)
+
+    response = app.test_client().post('/api/upload', data={'file': (io.BytesIO(image_bytes()), 'invoice.png')})
+
+    assert response.status_code == 200, response.get_json()
+    body = response.get_json()
+    assert body['model']['served_by'] == 'gemini-2.5-pro'
+    assert body['model']['escalated']
+    assert body['data']['SalesOrderHeader']['SalesOrderNumber'] == 'SO1'
+
+
+def test_validation_does_not_leave_a_transaction_open(app):
+    with app.app_context():
+        get_lookup_index().invalidate()
+        get_lookup_index().resolve_products(['BK-R93R-62'])
+        assert not db.session().in_transaction()
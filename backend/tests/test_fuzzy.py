@@ -0,0 +1,51 @@
+from app.fuzzy import TrigramIndex, literal_code, normalize_code
+from app.lookup import get_lookup_index
+
+
+def _product_numbers(*numbers):
+    index = TrigramIndex(normalize_code, literal_code)
+    for key, number in enumerate(numbers, start=1):
+        index.add(key, number)
+    return index
+
+
+def test_misread_product_number_ranks_first():
+    index = _product_numbers('BK-R93R-62', 'BK-R93R-44', 'FR-R92B-58')
+
+    matches = index.search('8K-R93R-6Z')
+    assert matches[0] == (1, 1.0)
+    assert all(score < 1.0 for _, score in matches[1:])
+    assert index.search('BKR93R62')[0] == (1, 1.0)
+
+
+def test_colliding_product_numbers_are_all_kept():
+    index = _product_numbers('BK-0100', 'BK-O100')
+
+    assert dict(index.search('BK-0100'))[1] == 1.0
+    assert dict(index.search('BK-0100'))[2] < 1.0
+    assert dict(index.search('bk-o100'))[2] == 1.0
+    assert dict(index.search('bk-o100'))[1] < 1.0
+
+
+def test_collision_that_matches_neither_literally_is_a_tie():
+    matches = _product_numbers('BK-0100', 'BK-O100').search('BK-D100')
+    assert len(matches) == 2
+    assert matches[0][1] == matches[1][1] < 1.0
+
+
+def test_fuzzy_product(app):
+    with app.app_context():
+        lookups = get_lookup_index()
+        product, score = lookups.fuzzy_product('8K-R93R-6Z')
+        assert (product.ProductNumber, score) == ('BK-R93R-62', 1.0)
+        product, score = lookups.fuzzy_product('BK-O100')
+        assert (product.ProductNumber, score) == ('BK-O100', 1.0)
+        # Either product could be meant, so neither is picked.
+        assert lookups.fuzzy_product('BK-D100') is None
+        assert lookups.fuzzy_product('XX-9999') is None
+
+
+def test_fuzzy_customer(app):
+    with app.app_context():
+        assert get_lookup_index().fuzzy_customer('Jon Yanq')[0] == 1
+        assert get_lookup_index().fuzzy_customer('Someone Else') is None
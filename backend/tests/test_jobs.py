@@ -0,0 +1,103 @@
+import time
+from app.jobs import DONE, FAILED, QUEUED, RUNNING, JobQueue, get_worker_pool
+from app.model_client import ModelBusyError
+from conftest import image_bytes
+
+
+def test_expired_lease_is_taken_over(tmp_path):
+    path = str(tmp_path / 'jobs.db')
+    first, second = JobQueue(path, lease=0.05), JobQueue(path, lease=0.05)
+    job_id = first.enqueue(b'image')
+
+    assert first.claim()['id'] == job_id
+    assert second.claim() is None
+
+    time.sleep(0.1)
+    job = second.claim()
+    assert job['id'] == job_id
+    assert job['attempts'] == 2
+    # The worker that lost the lease can no longer record an outcome.
+    assert not first.complete(job_id, '{}')
+    assert second.complete(job_id, '{}')
+    assert second.get(job_id)['status'] == DONE
+
+
+def test_heartbeat_keeps_the_lease(tmp_path):
+    path = str(tmp_path / 'jobs.db')
+    first, second = JobQueue(path, lease=0.2), JobQueue(path, lease=0.2)
+    first.enqueue(b'image')
+    first.claim()
+    for _ in range(3):
+        time.sleep(0.1)
+        first.heartbeat()
+        assert second.claim() is None
+
+
+def test_job_is_failed_after_max_attempts_expired_leases(tmp_path):
+    queue = JobQueue(str(tmp_path / 'jobs.db'), lease=0.01, max_attempts=2)
+    job_id = queue.enqueue(b'image')
+    other_id = queue.enqueue(b'image')
+
+    assert queue.claim()['id'] == job_id
+    time.sleep(0.05)
+    assert queue.claim()['id'] == job_id
+    time.sleep(0.05)
+
+    # The job is given up on, and the next one is claimed in the same call.
+    assert queue.claim()['id'] == other_id
+    job = queue.get(job_id)
+    assert job['status'] == FAILED
+    assert job['status_code'] == 500
+    assert job['attempts'] == 2
+
+
+def _pool(app):
+    pool = get_worker_pool(app)
+    pool.stop()
+    return pool
+
+
+def test_api_errors_are_not_retried_on_top_of_the_model_client(app, use_model):
+    app.config['MODEL_CASCADE'] = ['gemini-2.5-flash']
+    app.extensions['model_client'].max_retries = 1
+    use_model(failure_rate=1.0)
+    pool = _pool(app)
+    job_id = pool.queue.enqueue(image_bytes())
+
+    pool.process(pool.queue.claim())
+
+    job = pool.queue.get(job_id)
+    assert job['status'] == FAILED
+    assert job['status_code'] == 503
+    assert job['attempts'] == 1
+
+
+def test_busy_model_sends_the_job_back_to_the_queue(app):
+    class BusyModel:
+        def __init__(self, model_name, **kwargs):
+            self.model_name = model_name
+
+        def generate_content(self, contents, **kwargs):
+            raise ModelBusyError('Too many model calls in progress; try again shortly.')
+
+    app.config['MODEL_FACTORY'] = BusyModel
+    pool = _pool(app)
+    job_id = pool.queue.enqueue(image_bytes())
+
+    pool.process(pool.queue.claim())
+
+    assert pool.queue.get(job_id)['status'] == QUEUED
+
+
+def test_job_is_saved(app, use_model):
+    use_model()
+    pool = _pool(app)
+    job_id = pool.queue.enqueue(image_bytes())
+    job = pool.queue.claim()
+    assert job['status'] == RUNNING
+
+    pool.process(job)
+
+    job = pool.queue.get(job_id)
+    assert job['status'] == DONE, job['error']
+    assert job['status_code'] == 200
@@ -0,0 +1,58 @@
+import pytest
+from app.database import db
+from app.extraction import save_extracted_data
+from conftest import invoice
+
+
+@pytest.fixture
+def order_id(app):
+    with app.app_context():
+        order = save_extracted_data(invoice('SO1', lines=(('BK-R93R-62', 2, 50.0), ('FR-R92B-58', 1, 20.0))))
+        db.session.remove()
+    return order['SalesOrderHeader']['SalesOrderID']
+
+
+def _patch(app, order_id, header, details=None):
+    data = {'SalesOrderHeader': header}
+    if details is not None:
+        data['SalesOrderDetail'] = details
+    return app.test_client().patch(f'/api/sales_order/{order_id}', json=data)
+
+
+def test_edit_without_revision_is_rejected(app, order_id):
+    response = _patch(app, order_id, {'Freight': 5.0})
+    assert response.status_code == 428
+
+
+def test_stale_edit_is_rejected(app, order_id):
+    assert _patch(app, order_id, {'RevisionNumber': 0, 'Freight': 5.0}).status_code == 200
+
+    response = _patch(app, order_id, {'RevisionNumber': 0, 'Freight': 7.0})
+    assert response.status_code == 409
+    order = app.test_client().get(f'/api/sales_order/{order_id}').get_json()
+    assert order['SalesOrderHeader']['Freight'] == 5.0
+    assert order['SalesOrderHeader']['RevisionNumber'] == 1
+
+
+def test_edit_recomputes_totals_and_bumps_the_revision(app, order_id):
+    order = app.test_client().get(f'/api/sales_order/{order_id}').get_json()
+    first = order['SalesOrderDetail'][0]
+    details = [
+        {'SalesOrderDetailID': first['SalesOrderDetailID'], 'ProductNumber': 'BK-R93R-62', 'OrderQty': 3,
+         'UnitPrice': 50.0},
+        {'ProductNumber': 'FR-R92B-58', 'OrderQty': 2, 'UnitPrice': 20.0},
+    ]
+
+    response = _patch(app, order_id, {'RevisionNumber': 0}, details)
+
+    assert response.status_code == 200, response.get_json()
+    header = response.get_json()['data']['SalesOrderHeader']
+    assert header['RevisionNumber'] == 1
+    assert header['SubTotal'] == 190.0
+    assert header['TotalDue'] == 200.5
+    stored = app.test_client().get(f'/api/sales_order/{order_id}').get_json()['SalesOrderDetail']
+    assert sorted(line['LineTotal'] for line in stored) == [40.0, 150.0]
+
+
+def test_edit_of_missing_order(app):
+    assert _patch(app, 999, {'RevisionNumber': 0}).status_code == 404
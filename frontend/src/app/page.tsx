@@ -47,6 +47,34 @@ interface ExtractedData {
   ShippingAddress: string;
 }
 
+// Progress messages for the events sent by /api/upload/stream
+const STAGE_LABELS: { [event: string]: string } = {
+  received: "Uploaded, preparing image...",
+  preprocessed: "Reading invoice...",
+  tokens: "Reading invoice...",
+  header: "Reading line items...",
+  detail: "Reading line items...",
+  hydrated: "Saving order...",
+  escalated: "Double-checking with a more accurate model...",
+};
+
+// Splits a Server-Sent Events buffer into complete events and the unfinished rest.
+function parseEvents(buffer: string) {
+  const blocks = buffer.split("\n\n");
+  const rest = blocks.pop() ?? "";
+  const events = blocks.flatMap((block) => {
+    let event = "message";
+    const data: string[] = [];
+    for (const line of block.split("\n")) {
+      if (line.startsWith("event: ")) event = line.slice(7);
+      else if (line.startsWith("data: ")) data.push(line.slice(6));
+    }
+    // Comment-only blocks are keep-alives.
+    return data.length ? [{ event, data: JSON.parse(data.join("\n")) }] : [];
+  });
+  return { events, rest };
+}
+
 export default function Home() {
   const [selectedFile, setSelectedFile] = useState<File | null>(null);
   const [extractedData, setExtractedData] = useState<ExtractedData | null>(
@@ -54,6 +82,7 @@ export default function Home() {
   );
   const [isEditing, setIsEditing] = useState(false);
   const [isLoading, setIsLoading] = useState(false);
+  const [stage, setStage] = useState<string | null>(null);
 
   const handleFileChange = (event: React.ChangeEvent<HTMLInputElement>) => {
     if (event.target.files) {
@@ -62,29 +91,77 @@ export default function Home() {
     }
   };
 
+  const handleStreamEvent = (event: string, data: any) => {
+    if (STAGE_LABELS[event]) setStage(STAGE_LABELS[event]);
+    switch (event) {
+      case "header":
+        setExtractedData({
+          SalesOrderHeader: data,
+          SalesOrderDetail: [],
+          CustomerInfo: "",
+          BillingAddress: "",
+          ShippingAddress: "",
+        });
+        break;
+      case "detail":
+      case "hydrated":
+        setExtractedData((current) => {
+          if (!current) return current;
+          const details = [...current.SalesOrderDetail];
+          details[data.index] = data.detail;
+          return { ...current, SalesOrderDetail: details };
+        });
+        break;
+      case "escalated":
+        // The partial result failed validation; the next model starts over.
+        setExtractedData(null);
+        break;
+      case "committed":
+        setExtractedData(data.data);
+        break;
+      case "error":
+        console.error("Upload failed:", data.error);
+        setExtractedData(null);
+        break;
+    }
+  };
+
   const handleUpload = async () => {
     if (!selectedFile) return;
     setIsLoading(true);
+    setStage("Uploading...");
 
     const formData = new FormData();
     formData.append("file", selectedFile);
 
     try {
-      const response = await fetch("http://127.0.0.1:5000/api/upload", {
+      // The streaming endpoint sends partial results as they are extracted,
+      // and keeps the connection busy so proxies don't time it out.
+      const response = await fetch("http://127.0.0.1:5000/api/upload/stream", {
         method: "POST",
         body: formData,
       });
 
-      const result = await response.json();
-      if (response.ok && result.status === "success") {
-        setExtractedData(result.data);
-      } else {
+      if (!response.ok || !response.body) {
+        const result = await response.json();
         console.error("Upload failed:", result.error);
+        return;
+      }
+
+      const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+      let buffer = "";
+      while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        const { events, rest } = parseEvents(buffer + value);
+        buffer = rest;
+        events.forEach(({ event, data }) => handleStreamEvent(event, data));
       }
     } catch (error) {
       console.error("Error during upload:", error);
     } finally {
       setIsLoading(false);
+      setStage(null);
     }
   };
 
@@ -127,7 +204,7 @@ export default function Home() {
       const response = await fetch(
         `http://127.0.0.1:5000/api/sales_order/${extractedData.SalesOrderHeader.SalesOrderID}`,
         {
-          method: "PUT",
+          method: "PATCH",
           headers: {
             "Content-Type": "application/json",
           },
@@ -138,6 +215,12 @@ export default function Home() {
       const result = await response.json();
       if (response.ok && result.status === "success") {
         console.log("Data saved successfully");
+        // Carries the new RevisionNumber and the recomputed totals.
+        setExtractedData({
+          ...extractedData,
+          SalesOrderHeader: result.data.SalesOrderHeader,
+          SalesOrderDetail: result.data.SalesOrderDetail,
+        });
         setIsEditing(false);
       } else {
         console.error("Failed to save data:", result.error);
@@ -228,7 +311,7 @@ export default function Home() {
                   {isLoading ? (
                     <>
                       <Loader2 className="mr-2 h-4 w-4 animate-spin" />{" "}
-                      Extracting...
+                      {stage ?? "Extracting..."}
                     </>
                   ) : (
                     <>
@@ -257,23 +340,29 @@ export default function Home() {
                     {extractedData.SalesOrderHeader.SalesOrderNumber}
                   </CardDescription>
                 </div>
-                <div className="flex space-x-2">
-                  {!isEditing ? (
-                    <Button onClick={() => setIsEditing(true)}>
-                      <Edit className="mr-2 h-4 w-4" /> Edit
+                {isLoading ? (
+                  <div className="flex items-center text-sm text-gray-500 dark:text-gray-400">
+                    <Loader2 className="mr-2 h-4 w-4 animate-spin" /> {stage}
+                  </div>
+                ) : (
+                  <div className="flex space-x-2">
+                    {!isEditing ? (
+                      <Button onClick={() => setIsEditing(true)}>
+                        <Edit className="mr-2 h-4 w-4" /> Edit
+                      </Button>
+                    ) : (
+                      <Button onClick={handleSave}>
+                        <Save className="mr-2 h-4 w-4" /> Save
+                      </Button>
+                    )}
+                    <Button variant="destructive" onClick={handleDelete}>
+                      <Trash2 className="mr-2 h-4 w-4" /> Delete
                     </Button>
-                  ) : (
-                    <Button onClick={handleSave}>
-                      <Save className="mr-2 h-4 w-4" /> Save
+                    <Button variant="outline" onClick={handleCancel}>
+                      <XCircle className="mr-2 h-4 w-4" /> New Upload
                     </Button>
-                  )}
-                  <Button variant="destructive" onClick={handleDelete}>
-                    <Trash2 className="mr-2 h-4 w-4" /> Delete
-                  </Button>
-                  <Button variant="outline" onClick={handleCancel}>
-                    <XCircle className="mr-2 h-4 w-4" /> New Upload
-                  </Button>
-                </div>
+                  </div>
+                )}
               </CardHeader>
               <CardContent className="grid grid-cols-1 md:grid-cols-3 gap-6">
                 <div className="space-y-1">